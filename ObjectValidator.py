@@ -14,19 +14,71 @@
 
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError, FlexibleChecksumError
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import sys
 import logging
 import json
 import time
 import os
+import threading
+import concurrent.futures
+import multiprocessing
+import collections
+import heapq
+import queue
+import itertools
+import bisect
+import contextlib
+import cProfile
+import tracemalloc
+import ctypes
+import ctypes.util
+import errno
+import select
+import signal
+import struct
+import hmac
+import base64
+import fnmatch
+import re
+import socket
+
+try:
+    import blake3  # Optional, multi-threaded hashing of large buffers
+except ImportError:
+    blake3 = None
+try:
+    import pyarrow  # Optional, reads ORC and Parquet S3 Inventory reports
+except ImportError:
+    pyarrow = None
+try:
+    import tomllib  # Python 3.11 and later, reads a --config in TOML
+except ImportError:
+    tomllib = None
+try:
+    import yaml  # Optional, reads a --config in YAML
+except ImportError:
+    yaml = None
+import csv
+import gzip
+import io
+import tempfile
+import atexit
+import datetime
+import urllib.parse
+import sqlite3
+import http.server
+import importlib.util
 
 #region Command Line Parms
 
 # Command Line Parms
-# 1 - Mode (1=make sig, 2=validate sig) I.E. 1
+# 1 - Mode (1=make sig, 2=validate sig, 3=migrate sig, 4=publish/verify a --spool) I.E. 1
 # 2 - Source (1=Local File, 2=S3) I.E. 1
 # 3 - Walacor API endpoint root I.E. https://dev-platform.epcone.com
 # 4 - Walacor API user I.E. rain
@@ -34,19 +86,72 @@ import os
 # 6 - Log File Name I.E. S3DirHash_Log.txt
 # 7 - Log Level (10,20,30,40,50)
 # 8 - Root (the root location to work from) I.E. /ai-ml-model-artifacts
-# 9 - Specific Model I.E. attention_a6_korea
+# 9 - Specific Model, only these dirs are done, names (not paths) or glob patterns separated by commas I.E. attention_a6_korea,attention_b*
 # 10 - s3 endpoint I.E. Something specific if not a standard S3 endpoint (Might not be necessary)
 # 11 - s3 Access Key 
 # 12 - s3 Secret Key
 # 13 - s3 region I.E. us-gov-west-1
 # 14 - s3 bucket I.E. ultra-walacor
 
+# Command Line Options (--name=value, may appear anywhere on the command line before a literal --, after it all are positional)
+# --workers - Number of directories hashed at once I.E. 8 (default 1, sequential)
+# --s3-range-size - Size in MB of each ranged GET when hashing one S3 object I.E. 8
+# --s3-range-workers - Ranged GETs in flight for one S3 object I.E. 4 (1 = single GET stream)
+# --s3-range-buffer - Cap in MB on fetched but not yet hashed bytes for one S3 object I.E. 64
+# --hash-format - Contents hash format for new hashes (1=single stream, 2=tree, 3=S3 stored checksums, S3 only) I.E. 2 (default 1)
+# --hash-algorithm - Contents hash algorithm for new hashes (sha256, sha512_256, blake2b, blake3) I.E. blake3 (default sha256)
+# --file-workers - Number of file chunks hashed at once inside a directory, tree format only I.E. 4
+# --cache - Local SQLite file of per-file hashes, only changed files are read again, tree format only I.E. ObjectValidator_Cache.db
+# --paranoid - Ignore cached file hashes and read every byte (the cache is still refreshed)
+# --deep-audit - Format 3 reads every S3 object anyway and checks its stored checksum against the bytes
+# --dedup-etag - Hash S3 objects with the same ETag and size once, their file hash is reused, tree format only
+# --walacor-batch - Records sent per Walacor submit I.E. 100 (1 = submit each record on its own)
+# --walacor-page-size - Records per page when prefetching every ObjectHash record I.E. 1000
+# --no-prefetch - Look each directory up in Walacor on its own instead of prefetching every record
+# --walacor-pool - Keep-alive connections kept open to the Walacor endpoint I.E. 10
+# --walacor-timeout - Seconds to wait on a Walacor request I.E. 60
+# --walacor-retries - Retries, with backoff, of a Walacor request that got 429/5xx or no answer, a submit only after no connect or 429/503 with Retry-After I.E. 5
+# --walacor-async - Send Walacor submissions from a background thread while the next dirs hash
+# --read-buffer - Size in MB of each local file read I.E. 10
+# --read-ahead - Buffers read ahead of the hashing by a reader thread, 0 = no reader thread I.E. 2
+# --keep-page-cache - Leave hashed local file pages in the page cache instead of dropping them
+# --scan-workers - Local dir listings read ahead in parallel while the files are hashed I.E. 8 (default 1)
+# --metrics-json - Write a JSON run summary of the metrics here I.E. ObjectValidator_Metrics.json
+# --metrics-prom - Write the metrics as a Prometheus textfile here I.E. /var/lib/node_exporter/objectvalidator.prom
+# --metrics-prom-dirs - Counters in the Prometheus metrics per dir (a dir label), not only for the run
+# --profile - Write a cProfile of the main thread here, for pstats/snakeviz I.E. ObjectValidator.prof
+# --tracemalloc - Trace memory allocations, the peak and top allocation sites go in the JSON summary
+# --checkpoint - Local SQLite journal of finished dirs, a restarted run skips them I.E. ObjectValidator_Checkpoint.db
+# --shard-count - Number of shards the dirs under the root are split into, by a stable hash of the dir name I.E. 4
+# --shard-index - The shard this run does, 0 to shard-count - 1 I.E. 0
+# --summary - Write a JSON result summary of the run here, summaries of the shards can be merged I.E. Shard0.json
+# --s3-adaptive - Ramp the S3 GETs in flight up while throughput grows, back off on throttling or latency spikes
+# --s3-max-inflight - Most S3 GETs and HEADs in flight at once, across every dir and object, with --s3-adaptive I.E. 64
+# --s3-bandwidth - Cap in MB/s on the bytes fetched from S3, 0 = no cap I.E. 200
+# --s3-inventory - S3 Inventory manifest.json to list the bucket from instead of ListObjectsV2, a local path or s3://bucket/key I.E. s3://inventory-bucket/ultra-walacor/daily/2024-01-01T01-00Z/manifest.json
+# --sample-window - Validate a rotating share of the dirs per run, each at least once in this many days, oldest verified first, whole dirs only I.E. 7
+# --sample-size - Dirs validated per run with --sample-window (default the dirs / the window days, more when more are due) I.E. 500
+# --manifest-store - Keep a per-file manifest of every dir here, a failed validation names the changed files, a local dir or s3://bucket/prefix I.E. s3://ultra-walacor-manifests/ov
+# --spool - Modes 1 and 2 only hash, into this signed spool file, mode 4 publishes (mode 1 spool) or verifies (mode 2 spool) it in Walacor I.E. Node1.spool
+# --spool-key - File holding the secret key spools are signed with, needed with --spool I.E. /etc/objectvalidator/spool.key
+# --schema-cache - Local file remembering for a day that the Walacor schema is in place, so it is not checked every run I.E. ObjectValidator_Schema.json
+# --watch - Keep running and rehash only the dirs that change (modes 1 and 2), inotify for local, polling for S3
+# --watch-debounce - Seconds a dir has to be quiet before it is rehashed I.E. 30
+# --watch-interval - Seconds between S3 listings (or local scans where inotify is not there) I.E. 300
+# --serve - Run as a service on host:port that takes generation and validation jobs over HTTP, parameter 1 is not used I.E. 127.0.0.1:8470
+# --serve-jobs - Service jobs run at once I.E. 2
+# --serve-queue - Service jobs that can wait for a turn, more are turned away with a 429 I.E. 16
+# --config - TOML or YAML file of the sources to do in this run, with shared Walacor settings, parameters 2 and 8 to 14 are not used I.E. ObjectValidator.toml
+# --merge-summaries - Merge shard summaries into one and exit 0 only if every shard is there and passed, no positional parameters needed I.E. Shard0.json,Shard1.json
+
 #endregion
 
 #region Walacor
 
-def W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash):
+def W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash, intHashFormat=1, sHashAlgorithm='sha256', sManifestHash='', fChecked=None, state=None):
+    # fChecked is when the dir was hashed, if not now (a spool), state is the pass's RunState
     sNameHashRecord = W_GetNameHash(dir_hash)
+    fChecked = fChecked or get_EpochTime()
 
     if not sNameHashRecord:
         #New Record
@@ -54,26 +159,72 @@ def W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash):
         sNameHashRecord['Version'] = 1
         sNameHashRecord['NameHash'] = dir_hash
         sNameHashRecord['ContentsHash'] = dir_contents_hash
-        sNameHashRecord['LastSourceCheck'] = get_EpochTime()
+        sNameHashRecord['HashFormat'] = intHashFormat
+        sNameHashRecord['HashAlgorithm'] = sHashAlgorithm
+        sNameHashRecord['ManifestHash'] = sManifestHash
+        sNameHashRecord['LastSourceCheck'] = fChecked
 
-        W_UpdateNameHash(sNameHashRecord)
+        W_UpdateNameHash(sNameHashRecord, sdir, state)
         logger.warning('Dir Contents Hash not found, Creating new record - ' + sdir + ' - ' + dir_contents_hash)
     else:
         sNameHashRecordUpdate = {}
         sNameHashRecordUpdate['UID'] = sNameHashRecord['UID'] 
-        sNameHashRecordUpdate['LastSourceCheck'] = get_EpochTime()
+        sNameHashRecordUpdate['LastSourceCheck'] = fChecked
 
-        if sNameHashRecord['ContentsHash'] == dir_contents_hash:
+        if W_RecordHashSpec(sNameHashRecord) != (intHashFormat, sHashAlgorithm):
+            # A different format or algorithm always gives a different hash, this is not a content change
+            logger.warning('Dir Hash Format changed, Updating version - ' + sdir + ' - ' + W_HashSpecName(*W_RecordHashSpec(sNameHashRecord)) + ' to ' + W_HashSpecName(intHashFormat, sHashAlgorithm) + ' - ' + dir_contents_hash)
+            sNameHashRecordUpdate['Version'] = sNameHashRecord['Version'] + 1
+            sNameHashRecordUpdate['ContentsHash'] = dir_contents_hash
+            sNameHashRecordUpdate['HashFormat'] = intHashFormat
+            sNameHashRecordUpdate['HashAlgorithm'] = sHashAlgorithm
+        elif sNameHashRecord['ContentsHash'] == dir_contents_hash:
             logger.info('Dir Contents Hash is the same, Updating source Check Date - ' + sdir + ' - ' + dir_contents_hash)
         else:
             logger.warning('Dir Contents Hash is different, Updating version - ' + sdir + ' - ' + dir_contents_hash)
             sNameHashRecordUpdate['Version'] = sNameHashRecord['Version'] + 1
             sNameHashRecordUpdate['ContentsHash'] = dir_contents_hash
 
-        W_UpdateNameHash(sNameHashRecordUpdate)
+        if sManifestHash and sNameHashRecord.get('ManifestHash') != sManifestHash:
+            # Also fills in the manifest of a record made before there was one
+            sNameHashRecordUpdate['ManifestHash'] = sManifestHash
 
-def W_ManageValidation(sdir, dir_hash, dir_contents_hash):
-    sNameHashRecord = W_GetNameHash(dir_hash)
+        W_UpdateNameHash(sNameHashRecordUpdate, sdir, state)
+
+def W_ManageMigration(sdir, dir_hash, dir_contents_hash, new_contents_hash, intHashFormat, sHashAlgorithm, sNameHashRecord, sManifestHash='', state=None):
+    # dir_contents_hash was made with the record's own format and algorithm,
+    # the record is only moved to the new one when that still validates
+    if not sNameHashRecord:
+        logger.critical('Dir Contents Hash not found, Migration Failed - ' + sdir)
+        return 1
+
+    if sNameHashRecord['ContentsHash'] != dir_contents_hash:
+        logger.critical('Dir Contents Hash is different, Migration Failed - ' + sdir)
+        manifest_compare(sdir, sNameHashRecord, state)
+        return 1
+
+    sNameHashRecordUpdate = {}
+    sNameHashRecordUpdate['UID'] = sNameHashRecord['UID']
+    sNameHashRecordUpdate['Version'] = sNameHashRecord['Version'] + 1
+    sNameHashRecordUpdate['ContentsHash'] = new_contents_hash
+    sNameHashRecordUpdate['HashFormat'] = intHashFormat
+    sNameHashRecordUpdate['HashAlgorithm'] = sHashAlgorithm
+    sNameHashRecordUpdate['LastVerification'] = get_EpochTime()
+
+    if sManifestHash:
+        # The old manifest's file digests are of the old format and algorithm
+        sNameHashRecordUpdate['ManifestHash'] = sManifestHash
+
+    logger.warning('Dir Contents Hash validated, Migrating - ' + sdir + ' - ' + W_HashSpecName(*W_RecordHashSpec(sNameHashRecord)) + ' to ' + W_HashSpecName(intHashFormat, sHashAlgorithm) + ' - ' + new_contents_hash)
+    W_UpdateNameHash(sNameHashRecordUpdate, sdir, state)
+
+    return 0
+
+def W_ManageValidation(sdir, dir_hash, dir_contents_hash, sNameHashRecord=None, fChecked=None, state=None):
+    # The record may already have been looked up to find its hash format,
+    # fChecked is when the dir was hashed, if not now (a spool)
+    if sNameHashRecord is None:
+        sNameHashRecord = W_GetNameHash(dir_hash)
 
     intRet = 0
 
@@ -93,14 +244,85 @@ def W_ManageValidation(sdir, dir_hash, dir_contents_hash):
 
         if sNameHashRecord['ContentsHash'] == dir_contents_hash:
             logger.warning('Dir Contents Hash is the same, validation successful, updating validation date - ' + sdir)
-            sNameHashRecordUpdate['LastVerification'] = get_EpochTime()
-            W_UpdateNameHash(sNameHashRecordUpdate)
+            sNameHashRecordUpdate['LastVerification'] = fChecked or get_EpochTime()
+            W_UpdateNameHash(sNameHashRecordUpdate, sdir, state)
         else:
             logger.critical('Dir Contents Hash is different, Validation Failed - ' + sdir)
+            manifest_compare(sdir, sNameHashRecord, state)
             intRet = 1
 
     return intRet
 
+class W_SubmitRetry(Retry):
+    # Only a 429 or 503 that says when to come back is taken as not processed (no 413)
+    RETRY_AFTER_STATUS_CODES = frozenset({429, 503})
+
+def W_Setup():
+    # One session for the run so connections to Walacor are pooled and kept alive.
+    # Lookups, the login and the schema calls are sent again on a 429/5xx or no answer,
+    # a schema sent twice is only a new version of it
+    retries = Retry(
+        total = walacor_retries,
+        backoff_factor = 0.5,
+        status_forcelist = [429, 500, 502, 503, 504],
+        allowed_methods = None,  # The lookups are POSTs too
+        respect_retry_after_header = True,
+        raise_on_status = False
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=walacor_pool_size, max_retries=retries)
+
+    # A submit creates records. After a 5xx or a read timeout the batch may already be
+    # stored, and sending it again would store it twice, so it is only sent again when
+    # it never got there (a connect error) or Walacor said to come back (429/503 with Retry-After)
+    submit_retries = W_SubmitRetry(
+        total = walacor_retries,
+        connect = walacor_retries,
+        read = 0,
+        other = 0,
+        backoff_factor = 0.5,
+        status_forcelist = [],
+        allowed_methods = None,
+        respect_retry_after_header = True,
+        raise_on_status = False
+    )
+    submit_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=submit_retries)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.mount(walacor_endpoint + '/envelopes/submit', submit_adapter)
+    return session
+
+def W_Session():
+    global walacor_session
+
+    with walacor_lock:
+        if walacor_session is None:
+            walacor_session = W_Setup()
+
+    return walacor_session
+
+def W_Request(sCall, sMethod, url, **kwargs):
+    # Every Walacor call goes through here so its time and retries are measured
+    fStart = time.perf_counter()
+
+    try:
+        response = W_Session().request(sMethod, url, timeout=walacor_timeout, **kwargs)
+    except requests.RequestException:
+        metrics_count('walacor_errors_total', call=sCall)
+        raise
+    finally:
+        metrics_observe('walacor_request_seconds', time.perf_counter() - fStart, call=sCall)
+
+    metrics_count('walacor_requests_total', call=sCall, status=str(response.status_code))
+
+    # urllib3 keeps the retries it made on the raw response
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+        metrics_count('walacor_retries_total', len(retries.history), call=sCall)
+
+    return response
+
 def WGet_Bearer(serverurl, username, password):
     # Define the URL and headers
     headers = {
@@ -117,7 +339,7 @@ def WGet_Bearer(serverurl, username, password):
     }
 
     # Make the POST request to get the token
-    response = requests.post(serverurl + '/auth/login', headers=headers, data=json.dumps(payload))
+    response = W_Request('login', 'POST', serverurl + '/auth/login', headers=headers, data=json.dumps(payload))
 
     # Check if the request was successful
     if response.status_code == 200:
@@ -135,34 +357,21 @@ def WGet_Bearer(serverurl, username, password):
         logger.error(f"Failed to retrieve token: {response.status_code} - {response.text}")
 
 def W_EnsureLoggedIn():
-    bolNeedNew = False
-
-    if not walacor_Bearer:
-        bolNeedNew = True
-
-    if walacor_Bearer_Expiration < get_EpochTime():
-        bolNeedNew = True
+    # The background writer and the main thread can both get here
+    with walacor_login_lock:
+        bolNeedNew = False
 
-    if bolNeedNew:
-        WGet_Bearer(walacor_endpoint,walacor_user,walacor_password)
-
-def W_EnsureSchema():
-
-    if W_CheckForSchema():
-        return
+        if not walacor_Bearer:
+            bolNeedNew = True
 
-    W_EnsureLoggedIn()
+        if walacor_Bearer_Expiration < get_EpochTime():
+            bolNeedNew = True
 
-    # Define the URL and headers
-    headers = {
-        'Content-Type': 'application/json',
-        'ETId' : '50',
-        'SV' : '1',
-        'Authorization' : walacor_Bearer
-    }
+        if bolNeedNew:
+            WGet_Bearer(walacor_endpoint,walacor_user,walacor_password)
 
-    # Define the payload 
-    payload = {
+def W_SchemaPayload():
+    return {
                 "ETId": 50,
                 "SV": 1,
                 "Schema": {
@@ -203,6 +412,26 @@ def W_EnsureSchema():
                             "DataType": "DATETIME(EPOCH)",
                             "Required": False,
                             "Description": "When a contentshash is verfied for a Namehash this is updated"
+                        },
+                        {
+                            "FieldName": "HashFormat",
+                            "DataType": "INTEGER",
+                            "Required": False,
+                            "Description": "Format used to build the contentshash (1=single stream, 2=tree), empty is 1"
+                        },
+                        {
+                            "FieldName": "HashAlgorithm",
+                            "DataType": "TEXT",
+                            "MaxLength": 64,
+                            "Required": False,
+                            "Description": "Hash algorithm used to build the contentshash (sha256, sha512_256, blake2b, blake3), empty is sha256"
+                        },
+                        {
+                            "FieldName": "ManifestHash",
+                            "DataType": "TEXT",
+                            "MaxLength": 64,
+                            "Required": False,
+                            "Description": "sha256 of the per-file manifest kept in the manifest store, empty is no manifest"
                         }
                     ],
                     "Indexes": [
@@ -217,9 +446,33 @@ def W_EnsureSchema():
                     ], 
                 }
     }
+
+def W_EnsureSchema():
+
+    if W_SchemaCached():
+        logger.info('Schema check cached - ' + schema_cache_path)
+        return
+
+    if W_CheckForSchema():
+        W_SchemaCacheStore()
+        return
+
+    W_EnsureLoggedIn()
+
+    # Define the URL and headers
+    headers = {
+        'Content-Type': 'application/json',
+        'ETId' : '50',
+        'SV' : '1',
+        'Authorization' : walacor_Bearer
+    }
+
+    # Define the payload 
+    payload = W_SchemaPayload()
+
      # Make the POST request to get the token
     
-    response = requests.post(walacor_endpoint + '/schemas/', headers=headers, data=json.dumps(payload))
+    response = W_Request('submit_schema', 'POST', walacor_endpoint + '/schemas/', headers=headers, data=json.dumps(payload))
 
     # Check if the request was successful
     if response.status_code == 200:
@@ -230,11 +483,46 @@ def W_EnsureSchema():
         if sUID:
             # Store the token in a file for later use
             logger.info("Schema stored sucessfully - " + sUID)
+            W_SchemaCacheStore()
         else:
             logger.debug("Schema not stored sucessfully - " + sUID)
     else:
         logger.error(f"Failed to submit schema: {jresponse['success']} - {jresponse['error']}")
 
+def W_SchemaCacheKey():
+    # A new endpoint or a change to the schema needs a new check
+    return hashlib.sha256((walacor_endpoint + json.dumps(W_SchemaPayload(), sort_keys=True)).encode('utf-8')).hexdigest()
+
+def W_SchemaCached():
+    # True when --schema-cache saw the schema in place less than SCHEMA_CACHE_SECONDS ago
+    if not schema_cache_path:
+        return False
+
+    try:
+        with open(schema_cache_path, 'r') as file:
+            dCache = json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    return get_EpochTime() - dCache.get(W_SchemaCacheKey(), 0) < SCHEMA_CACHE_SECONDS
+
+def W_SchemaCacheStore():
+    if not schema_cache_path:
+        return
+
+    try:
+        with open(schema_cache_path, 'r') as file:
+            dCache = json.load(file)
+    except (OSError, ValueError):
+        dCache = {}
+
+    dCache[W_SchemaCacheKey()] = get_EpochTime()
+
+    try:
+        metrics_write_file(schema_cache_path, json.dumps(dCache, indent=2) + '\n')
+    except OSError as e:
+        logger.warning('Schema check not cached - ' + str(e))
+
 def W_CheckForSchema():
     W_EnsureLoggedIn()
 
@@ -246,10 +534,18 @@ def W_CheckForSchema():
     }
 
      # Make the get request    
-    response = requests.get(walacor_endpoint + '/schemas/envelopeTypes/1500000/details', headers=headers, data='')
+    response = W_Request('check_schema', 'GET', walacor_endpoint + '/schemas/envelopeTypes/1500000/details', headers=headers, data='')
 
     # Check if the request was successful
     if response.status_code == 200:
+        # An older schema without the newer fields gets submitted again as a new version
+        lFields = [field['FieldName'] for field in W_SchemaPayload()['Schema']['Fields']]
+        lMissing = [sField for sField in lFields if '"' + sField + '"' not in response.text]
+
+        if lMissing:
+            logger.warning('Schema is missing fields, updating - ' + ', '.join(lMissing))
+            return False
+
         return True
     else:
         return False
@@ -260,11 +556,130 @@ def W_BlankNameHash():
         'ContentsHash' : '',
         'Version' : 0,
         'LastSourceCheck' : None,
-        'LastVerification' : None
+        'LastVerification' : None,
+        'HashFormat' : 1,
+        'HashAlgorithm' : 'sha256',
+        'ManifestHash' : ''
         }
 
+def W_RecordHashFormat(sNameHashRecord):
+    # Records written before HashFormat existed are single stream
+    if not sNameHashRecord or not sNameHashRecord.get('HashFormat'):
+        return HASH_FORMAT_STREAM
+
+    return int(sNameHashRecord['HashFormat'])
+
+def W_RecordHashAlgorithm(sNameHashRecord):
+    # Records written before HashAlgorithm existed are sha256
+    if not sNameHashRecord or not sNameHashRecord.get('HashAlgorithm'):
+        return 'sha256'
+
+    return sNameHashRecord['HashAlgorithm']
+
+def W_RecordHashSpec(sNameHashRecord):
+    return W_RecordHashFormat(sNameHashRecord), W_RecordHashAlgorithm(sNameHashRecord)
+
+def W_RecordEpoch(value):
+    # A DATETIME(EPOCH) field in seconds, 0 when empty. Values in milliseconds are scaled
+    if not value:
+        return 0.0
+
+    fValue = float(value)
+    return fValue / 1000 if fValue > 100000000000 else fValue
+
+def W_HashSpecName(intHashFormat, sHashAlgorithm):
+    return str(intHashFormat) + '/' + sHashAlgorithm
+
+def W_HashSpecError(intHashFormat, sHashAlgorithm):
+    # Why this host cannot hash a dir in this format and algorithm, '' when it can
+    if intHashFormat not in (HASH_FORMAT_STREAM, HASH_FORMAT_TREE, HASH_FORMAT_CHECKSUM):
+        return 'Unknown hash format - ' + str(intHashFormat)
+
+    if intHashFormat == HASH_FORMAT_CHECKSUM and source_type != 2:
+        return 'Hash format 3 is made from S3 checksums, it is for S3 only'
+
+    try:
+        new_hash(sHashAlgorithm)
+    except ValueError as e:
+        return str(e)
+
+    return ''
+
+def W_RecordHashSpecs(ldirs, dRecords, sWhat='Validation'):
+    # (the dirs to hash, the format and algorithm of each one's record, the dirs that cannot be).
+    # A record this host cannot hash again (blake3 not installed, an unknown algorithm,
+    # format 3 on a local source) fails its own dir, the other dirs are still done
+    lHash = []
+    lHashSpecs = []
+    lFailed = []
+
+    for sdir in ldirs:
+        spec = W_RecordHashSpec(dRecords[sdir])
+        sError = W_HashSpecError(*spec)
+
+        if sError:
+            set_dir_context(sdir)
+            logger.critical(sError + ', ' + sWhat + ' Failed - ' + sdir)
+            set_dir_context('')
+            lFailed.append(sdir)
+        else:
+            lHash.append(sdir)
+            lHashSpecs.append(spec)
+
+    return lHash, lHashSpecs, lFailed
+
+def W_PrefetchNameHashes():
+    # Loads every ObjectHash summary record, a page at a time, into an index by NameHash
+    global walacor_NameHash_Index
+
+    W_EnsureLoggedIn()
+
+    # Define the URL and headers
+    headers = {
+        'Content-Type': 'application/json',
+        'ETId' : '1500000',
+        'Authorization' : walacor_Bearer
+    }
+
+    dIndex = {}
+    intPage = 1
+
+    while True:
+        response = W_Request('prefetch', 'POST', walacor_endpoint + '/query/get?fromSummary=true&pageNo=' + str(intPage) + '&pageSize=' + str(walacor_page_size), headers=headers, data=json.dumps({}))
+
+        if response.status_code != 200:
+            # Fall back to looking up each directory on its own
+            logger.error(f"Failed to Prefetch NameHashes, using single lookups {response.status_code} - {response.text}")
+            walacor_NameHash_Index = None
+            return
+
+        ldata = json.loads(response.text)['data'] or []
+        intNew = 0
+
+        for record in ldata:
+            if record['NameHash'] not in dIndex:
+                dIndex[record['NameHash']] = record
+                intNew += 1
+
+        # A short page is the last one, a page with nothing new means paging is not honoured
+        if len(ldata) < walacor_page_size or intNew == 0:
+            break
+
+        intPage += 1
+
+    walacor_NameHash_Index = dIndex
+    logger.info('NameHashes Prefetched - ' + str(len(dIndex)))
+
 def W_GetNameHash(sNameHash):
 
+    if walacor_NameHash_Index is not None:
+        if sNameHash in walacor_NameHash_Index:
+            logger.info("NameHash Found - " + walacor_NameHash_Index[sNameHash]['UID'])
+            return walacor_NameHash_Index[sNameHash]
+        else:
+            logger.info("NameHash Not Found - " + sNameHash)
+            return ''
+
     W_EnsureLoggedIn()
 
     # Define the URL and headers
@@ -281,7 +696,7 @@ def W_GetNameHash(sNameHash):
     
      # Make the POST request to get the query
     
-    response = requests.post(walacor_endpoint + '/query/get?fromSummary=true', headers=headers, data=json.dumps(payload))
+    response = W_Request('query', 'POST', walacor_endpoint + '/query/get?fromSummary=true', headers=headers, data=json.dumps(payload))
 
     # Check if the request was successful
     if response.status_code == 200:
@@ -295,11 +710,52 @@ def W_GetNameHash(sNameHash):
             logger.info("NameHash Not Found - " + sNameHash)
             return ''
     else:
-        logger.error(f"Failed to Query {jresponse['success']} - {jresponse['error']}")
+        logger.error(f"Failed to Query {response.status_code} - {response.text}")
         return ''
     
-def W_UpdateNameHash(sNameHashRecord):
+def W_UpdateNameHash(sNameHashRecord, sdir='', state=None):
+    # Records are queued and sent walacor_batch_size at a time, a dir that is not
+    # stored goes in the not_persisted of the RunState that queued it
+    checkpoint_record_queued(sdir)
+    walacor_Pending.append((sdir, sNameHashRecord, state or run_state))
+
+    if len(walacor_Pending) >= walacor_batch_size:
+        W_FlushNameHashes()
+
+def W_FlushNameHashes():
+    # Jobs of the service flush at the same time, a batch is taken and handed on under the lock
+    while True:
+        with walacor_pending_lock:
+            if not walacor_Pending:
+                return
+
+            lBatch = walacor_Pending[:walacor_batch_size]
+            del walacor_Pending[:walacor_batch_size]
+
+            if walacor_writer is not None:
+                # One writer thread keeps the submissions in order
+                walacor_writes.append(walacor_writer.submit(W_SubmitNameHashes, lBatch))
+                continue
+
+        W_SubmitNameHashes(lBatch)
 
+def W_WaitForWrites():
+    # Flushes what is queued and waits for the background writer to finish it,
+    # and for every write handed to it before, whoever queued them
+    W_FlushNameHashes()
+
+    with walacor_pending_lock:
+        lWrites = list(walacor_writes)
+
+    try:
+        for future in lWrites:
+            future.result()
+    finally:
+        with walacor_pending_lock:
+            walacor_writes[:] = [future for future in walacor_writes if not future.done()]
+
+def W_SubmitNameHashes(lBatch):
+    # lBatch is a list of (sdir, record, RunState), dirs that are not persisted go to its not_persisted
     W_EnsureLoggedIn()
 
     # Define the URL and headers
@@ -310,24 +766,43 @@ def W_UpdateNameHash(sNameHashRecord):
     }
     
     payload = {
-        'Data': [
-            sNameHashRecord
-        ]
+        'Data': [record for sdir, record, state in lBatch]
     }
 
     # Make the POST request to get the query
-    response = requests.post(walacor_endpoint + '/envelopes/submit', headers=headers, data=json.dumps(payload))
+    try:
+        response = W_Request('submit', 'POST', walacor_endpoint + '/envelopes/submit', headers=headers, data=json.dumps(payload))
+    except requests.RequestException as e:
+        # Not known to be stored, the dirs are done again on the next run
+        logger.error('Failed to submit - ' + str(e))
+        response = None
 
     # Check if the request was successful
-    if response.status_code == 200:
+    if response is not None and response.status_code == 200:
         jresponse = json.loads(response.text)
-        
-        if jresponse['data']:
-            sUID = jresponse['data']['UID'][0]
-            logger.info("NameHash Submitted - " + sUID)
+        lUIDs = jresponse['data']['UID'] if jresponse['data'] else []
+
+        for (sdir, record, state), sUID in zip(lBatch, lUIDs):
+            logger.info("NameHash Submitted - " + sdir + ' - ' + sUID)
+
+        metrics_count('walacor_records_submitted_total', len(lUIDs))
+        checkpoint_records_sent([sdir for sdir, record, state in lBatch[:len(lUIDs)]], True)
+
+        # Anything without a UID back was not stored
+        for sdir, record, state in lBatch[len(lUIDs):]:
+            logger.error("NameHash Not Submitted - " + sdir)
+            state.not_persisted.append(sdir)
+
+        checkpoint_records_sent([sdir for sdir, record, state in lBatch[len(lUIDs):]], False)
 
     else:
-        logger.error(f"Failed to submit {jresponse['success']} - {jresponse['error']}")
+        if response is not None:
+            logger.error(f"Failed to submit {response.status_code} - {response.text}")
+        for sdir, record, state in lBatch:
+            logger.error("NameHash Not Submitted - " + sdir)
+            state.not_persisted.append(sdir)
+
+        checkpoint_records_sent([sdir for sdir, record, state in lBatch], False)
 
 #endregion
 
@@ -341,88 +816,347 @@ def s3_setup():
         retries = {
             'max_attempts': 10,
             'mode': 'standard'
-        }
+        },
+        # S3 compatible endpoints rarely have a DNS name per bucket
+        s3 = {'addressing_style': 'path'} if s3_endpoint else None
     )
-    return boto3.client('s3', config=config, aws_access_key_id=s3_access, aws_secret_access_key=s3_secret)
+    return boto3.client('s3', config=config, endpoint_url=s3_endpoint or None, aws_access_key_id=s3_access, aws_secret_access_key=s3_secret)
+
+def s3_list_directories(s3_client, bucket_name, prefix='', sNamePrefix=''):
+    # The dirs under prefix, only those whose name starts with sNamePrefix are listed
+    if s3_inventory_path:
+        return [sdir for sdir in inventory_list_directories(prefix) if sdir.startswith(sNamePrefix)]
 
-def s3_list_directories(s3_client, bucket_name, prefix=''):
     paginator = s3_client.get_paginator('list_objects_v2')
     directories = set()
 
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix + '/', Delimiter='/'):
+    for page in s3_measure_pages(paginator.paginate(Bucket=bucket_name, Prefix=prefix + '/' + sNamePrefix, Delimiter='/'), 'list_directories'):
         for common_prefix in page.get('CommonPrefixes', []):
-            strPrefix = common_prefix['Prefix'].replace(prefix + '/', '')[:-1]
+            # Only the leading prefix comes off, a dir name can have it inside too
+            strPrefix = common_prefix['Prefix'][len(prefix) + 1:-1]
             directories.add(strPrefix)
 
     return list(directories)
 
-def s3_hash_dir_contents(s3_client, s3_bucket, ldirs):
-    sha2_hash = hashlib.sha256()
-    continuation_token = ''
+def s3_list_objects(s3_client, s3_bucket, s3_prefix):
+    # Yields the objects under a prefix in key order, one listing page held at a time
+    if s3_inventory_path:
+        yield from inventory_list_objects(s3_prefix)
+        return
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+
+    for page in s3_measure_pages(paginator.paginate(Bucket=s3_bucket, Prefix=s3_prefix), 'list_objects'):
+        # An empty prefix has no Contents at all
+        for obj in page.get('Contents', []):
+            yield obj
 
-    objects2 = []
+def s3_measure_pages(pages, sCall):
+    # Passes the listing pages through, timing the wait on each one
+    pages = iter(pages)
 
     while True:
-        if len(ldirs) == 0:
+        fStart = time.perf_counter()
+        page = next(pages, None)
+        if page is None:
             break
 
-        s3_dir = ldirs[0] + '/'
+        metrics_observe('s3_list_seconds', time.perf_counter() - fStart, call=sCall)
+        metrics_count('s3_list_requests_total', call=sCall)
+        metrics_count('s3_list_keys_total', page.get('KeyCount', 0), call=sCall)
+        s3_count_retries(page, sCall)
+
+        yield page
+
+def s3_get_object(sCall, **kwargs):
+    response = s3_client.get_object(**kwargs)
+
+    metrics_count('s3_get_requests_total', call=sCall)
+    s3_count_retries(response, sCall)
+
+    return response
+
+def s3_fetch(sCall, fnConsume, **kwargs):
+    # GETs an object (or a range of one) and passes the body to fnConsume a piece at a time.
+    # The GET waits for a slot from the adaptive limiter and keeps under the bandwidth cap
+    intRead = 1024 * 1024 if s3_bandwidth else 1024 * 1024 * 10  # Smaller reads keep a cap smooth
+    intBytes = 0
+    bThrottled = False
+    fFirstByte = 0.0
+
+    if s3_limiter is not None:
+        s3_limiter.acquire()
+
+    fStart = time.perf_counter()
+
+    try:
+        response = s3_get_object(sCall, **kwargs)
+        fFirstByte = time.perf_counter() - fStart
+        bThrottled = response.get('ResponseMetadata', {}).get('RetryAttempts', 0) > 0
+        body = response['Body']
 
         while True:
-            if continuation_token:
-                objects = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=s3_dir, ContinuationToken=continuation_token)
-            else:
-                objects = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=s3_dir)
+            chunk = body.read(intRead)
+            if not chunk:
+                break
 
-            # for page in page_iterator:
-            #     for obj in page.get('Contents', []):
-            #         objects.append(obj['Key'])
+            s3_bandwidth_wait(len(chunk))
+            fnConsume(chunk)
+            intBytes += len(chunk)
+            metrics_count('s3_get_bytes_total', len(chunk))
 
-            # objects.sort()
+    except ClientError as e:
+        # The retries ran out on a throttled request
+        bThrottled = e.response.get('Error', {}).get('Code') in S3_THROTTLE_CODES
+        raise
+    finally:
+        metrics_observe('s3_get_seconds', time.perf_counter() - fStart, call=sCall)
 
-            for obj in objects['Contents']:
-                key = obj['Key']
+        if bThrottled:
+            metrics_count('s3_throttled_total', call=sCall)
 
-                if not key.endswith('/'):
-                    if not key in objects2:
-                        objects2.append(key)
+        if s3_limiter is not None:
+            s3_limiter.release(fFirstByte, intBytes, bThrottled)
 
-                # if key.endswith('/'):
-                #     if key != s3_dir:
-                #         ldirs.append(key)
-                # else:
-                #     if not key in objects2:
-                #         objects2.append(key)
+def s3_bandwidth_wait(intBytes):
+    # Leaky bucket, a second's worth of bytes may go at once, past that the reader sleeps
+    global s3_bandwidth_next
 
-            if objects.get('IsTruncated'):  # Check if there are more objects
-                continuation_token = objects.get('NextContinuationToken')
+    if not s3_bandwidth:
+        return
+
+    with s3_bandwidth_lock:
+        fNow = time.monotonic()
+        s3_bandwidth_next = max(s3_bandwidth_next, fNow - 1.0) + intBytes / s3_bandwidth
+        fSleep = s3_bandwidth_next - fNow - 1.0
+
+    if fSleep > 0:
+        time.sleep(fSleep)
+
+def s3_pool_size(intWorkers):
+    # Threads of a pool that sends S3 requests.  With --s3-adaptive the limiter decides
+    # how many are in flight, so the pool is as big as the limit can get
+    if s3_limiter is not None:
+        return max(intWorkers, s3_limiter.intMax)
+
+    return intWorkers
+
+class AdaptiveLimiter:
+    # Limits the S3 GETs in flight, across every thread, to a limit it finds as it goes:
+    #   slow start - the limit doubles each window while throughput keeps growing
+    #   then - one more per window while throughput keeps growing, one less when it fell after a raise
+    #   throttled (503 SlowDown and the like) - the limit halves
+    #   time to first byte over 4 times its baseline - the limit drops by a quarter
+    # The limit goes down at most once a window, and stays between 1 and intMax
+    WINDOW = 2.0
+
+    def __init__(self, intStart, intMax):
+        self.cond = threading.Condition()
+        self.intMax = max(1, intMax)
+        self.fLimit = float(max(1, min(intStart, self.intMax)))
+        self.intInFlight = 0
+        self.intPeak = 0
+        self.intBytes = 0
+        self.fWindowStart = time.monotonic()
+        self.fLastRate = 0.0
+        self.bSlowStart = True
+        self.bRaised = False
+        self.fLastDecrease = 0.0
+        self.fLatency = None
+        self.fBaseline = None
+
+    def acquire(self):
+        with self.cond:
+            while self.intInFlight >= int(self.fLimit):
+                self.cond.wait()
+
+            self.intInFlight += 1
+            self.intPeak = max(self.intPeak, self.intInFlight)
+
+    def release(self, fFirstByte, intBytes, bThrottled):
+        with self.cond:
+            self.intInFlight -= 1
+            self.intBytes += intBytes
+
+            if bThrottled:
+                self.decrease(0.5, 'throttled')
+            elif fFirstByte > 0:
+                # A baseline that only drifts up slowly, so a spike does not become the norm
+                self.fLatency = fFirstByte if self.fLatency is None else self.fLatency * 0.9 + fFirstByte * 0.1
+                self.fBaseline = self.fLatency if self.fBaseline is None else min(self.fLatency, self.fBaseline * 1.01)
+
+                if self.fLatency > self.fBaseline * 4 and self.fLatency > 0.05:
+                    self.decrease(0.75, 'latency ' + str(round(self.fLatency, 3)) + 's')
+
+            self.adjust()
+            self.cond.notify_all()
+
+    def decrease(self, fFactor, sReason):
+        fNow = time.monotonic()
+        if fNow - self.fLastDecrease < self.WINDOW:
+            return
+
+        self.fLastDecrease = fNow
+        self.bSlowStart = False
+        self.bRaised = False
+        self.set_limit(max(1.0, self.fLimit * fFactor), sReason)
+
+    def adjust(self):
+        fNow = time.monotonic()
+        fElapsed = fNow - self.fWindowStart
+        if fElapsed < self.WINDOW:
+            return
+
+        fRate = self.intBytes / fElapsed
+        bSaturated = self.intPeak >= int(self.fLimit)
+
+        if fNow - self.fLastDecrease >= self.WINDOW:
+            if bSaturated and fRate >= self.fLastRate * 1.05:
+                # Still growing, and the limit was what held it back
+                self.bRaised = True
+                self.set_limit(min(self.intMax, self.fLimit * 2 if self.bSlowStart else self.fLimit + 1), 'throughput ' + str(round(fRate / 1024 / 1024, 1)) + ' MB/s')
+            elif self.bRaised and fRate < self.fLastRate * 0.95:
+                # The last raise did not pay
+                self.bSlowStart = False
+                self.bRaised = False
+                self.set_limit(max(1.0, self.fLimit - 1), 'throughput fell ' + str(round(fRate / 1024 / 1024, 1)) + ' MB/s')
             else:
-                break
-        
-        ldirs.pop(0)
-    
-    objects2.sort()
+                self.bRaised = False
+
+        self.fLastRate = fRate
+        self.intBytes = 0
+        self.intPeak = self.intInFlight
+        self.fWindowStart = fNow
+
+    def set_limit(self, fLimit, sReason):
+        if int(fLimit) != int(self.fLimit):
+            logger.info('S3 - GETs in flight ' + str(int(self.fLimit)) + ' to ' + str(int(fLimit)) + ' - ' + sReason)
+            metrics_count('s3_limit_changes_total', direction='up' if fLimit > self.fLimit else 'down')
+
+        self.fLimit = fLimit
+
+def s3_count_retries(response, sCall):
+    intRetries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if intRetries:
+        metrics_count('s3_retries_total', intRetries, call=sCall)
+
+def s3_list_files(s3_client, s3_bucket, ldirs):
+    # Yields the file objects under every dir in ldirs in key order, without duplicates.
+    # ListObjectsV2 returns keys in UTF-8 binary order, which is the order sort() gives the keys
+    objects = heapq.merge(*[s3_list_objects(s3_client, s3_bucket, s3_dir + '/') for s3_dir in ldirs], key=lambda obj: obj['Key'])
+    sLastKey = None
+
+    for obj in objects:
+        key = obj['Key']
+
+        # Skip "folder" markers, and keys seen under an overlapping dir
+        if key.endswith('/') or key == sLastKey:
+            continue
 
-    for obj in objects2:
-        logger.debug('S3 - Hash File - ' + obj)
+        sLastKey = key
+        yield obj
 
-        s3_hash_object_stream(s3_bucket, obj, sha2_hash)
-        #s3_hash_object_local(s3_bucket, obj, sha2_hash)
+def s3_hash_dir_contents(s3_client, s3_bucket, ldirs, intHashFormat=1, sHashAlgorithm='sha256', lManifest=None):
+    # lManifest, when given, gets (relative path, size, file digest) for every object
+    s3_base = ldirs[0] + '/'
+    objects = s3_list_files(s3_client, s3_bucket, ldirs)
+
+    if intHashFormat == HASH_FORMAT_TREE:
+        return tree_hash_leaves((s3_tree_leaf(s3_bucket, s3_base, obj, sHashAlgorithm) for obj in objects), s3_hash_chunk, sHashAlgorithm, lManifest)
+
+    sha2_hash = new_hash(sHashAlgorithm)
+
+    for obj in objects:
+        logger.debug('S3 - Hash File - ' + obj['Key'])
+
+        if lManifest is not None:
+            tee = HashTee(sha2_hash, new_hash(sHashAlgorithm))
+            s3_hash_object_stream(s3_bucket, obj['Key'], tee, obj.get('Size'), obj.get('ETag'))
+            lManifest.append((obj['Key'][len(s3_base):], tee.intBytes, tee.hash_objects[1].digest()))
+            continue
+
+        s3_hash_object_stream(s3_bucket, obj['Key'], sha2_hash, obj.get('Size'), obj.get('ETag'))
+        #s3_hash_object_local(s3_bucket, obj['Key'], sha2_hash)
 
     return sha2_hash.hexdigest()
 
-def s3_hash_object_stream(s3_bucket, s3_key, hash_object):
+def s3_tree_leaf(s3_bucket, s3_base, obj, sHashAlgorithm):
+    if s3_dedup_etag and obj.get('ETag'):
+        # Every key with the same ETag and size is taken to be the same content
+        sCacheKey = cache_key(sHashAlgorithm, 's3-etag', obj['ETag'], obj['Size'])
+    else:
+        sCacheKey = cache_key(sHashAlgorithm, 's3', s3_bucket, obj['Key'], obj.get('ETag'), obj['Size'], obj.get('LastModified'))
+    return (obj['Key'][len(s3_base):], (s3_bucket, obj['Key'], obj.get('ETag')), obj['Size'], sCacheKey)
 
-    # Streaming data from S3
-    response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
-    body = response['Body']
+def s3_hash_object_stream(s3_bucket, s3_key, hash_object, intSize=None, sETag=None):
+    metrics_count('s3_objects_total')
 
-    # Read the data in chunks
-    while True:
-        chunk = body.read(1024 * 1024 * 10)  # Read 10 MB at a time
-        if not chunk:
-            break
-        hash_object.update(chunk)
+    if intSize is not None:
+        metrics_observe('s3_object_bytes', intSize)
+
+    with metrics_timer('s3_object_seconds'):
+        if intSize is not None and s3_range_workers > 1 and intSize > s3_range_size:
+            # Big enough to be worth fetching in parallel ranges
+            s3_hash_object_ranged(s3_bucket, s3_key, hash_object, intSize, sETag)
+            return
+
+        # Streaming data from S3
+        s3_fetch('object', hash_object.update, Bucket=s3_bucket, Key=s3_key)
+
+def s3_get_range(s3_bucket, s3_key, intStart, intEnd, sETag=None):
+    kwargs = {
+        'Bucket': s3_bucket,
+        'Key': s3_key,
+        'Range': 'bytes=' + str(intStart) + '-' + str(intEnd)
+    }
+
+    if sETag:
+        # Fail rather than mix bytes from two versions of the object
+        kwargs['IfMatch'] = sETag
+
+    lParts = []
+    s3_fetch('range', lParts.append, **kwargs)
+
+    return b''.join(lParts)
+
+def s3_hash_object_ranged(s3_bucket, s3_key, hash_object, intSize, sETag=None):
+    # Several ranged GETs are in flight while the finished ones are hashed in order,
+    # the bytes fed to the hash are the same as a single GET stream
+    intInFlight = max(1, min(s3_pool_size(s3_range_workers), s3_range_buffer // s3_range_size))
+    pending = collections.deque()
+    intOffset = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=intInFlight) as executor:
+        while intOffset < intSize or pending:
+            # Keep the pipeline full without going over the buffer cap
+            while intOffset < intSize and len(pending) < intInFlight:
+                intEnd = min(intOffset + s3_range_size, intSize) - 1
+                pending.append(executor.submit(bind_dir_context(s3_get_range), s3_bucket, s3_key, intOffset, intEnd, sETag))
+                intOffset = intEnd + 1
+
+            hash_object.update(pending.popleft().result())
+
+def s3_hash_chunk(s3_object, intOffset, intLength, sHashAlgorithm='sha256'):
+    s3_bucket, s3_key, sETag = s3_object
+    logger.debug('S3 - Hash Chunk - ' + s3_key + ' - ' + str(intOffset))
+
+    if intLength == 0:
+        # Ranged GETs on an empty object are not satisfiable
+        return new_hash(sHashAlgorithm).digest()
+
+    chunk_hash = new_hash(sHashAlgorithm)
+    kwargs = {
+        'Bucket': s3_bucket,
+        'Key': s3_key,
+        'Range': 'bytes=' + str(intOffset) + '-' + str(intOffset + intLength - 1)
+    }
+
+    if sETag:
+        kwargs['IfMatch'] = sETag
+
+    s3_fetch('chunk', chunk_hash.update, **kwargs)
+
+    return chunk_hash.digest()
 
 def s3_hash_object_local(s3_bucket, s3_key, hash_object):
 
@@ -453,197 +1187,3391 @@ def s3_hash_object_local(s3_bucket, s3_key, hash_object):
 
 #endregion
 
-#region Filesystem
+#region S3 Checksums
+
+# Format 3 builds an S3 dir's contents hash from the SHA-256 checksums S3 keeps for objects
+# uploaded with additional checksums.  They come from a HEAD, no bytes are downloaded:
+#   file hash = hash('s3-checksum|SHA256|' + checksum type + '|' + ChecksumSHA256)
+# A FULL_OBJECT checksum is the SHA-256 of the object, a COMPOSITE one (multipart) the
+# SHA-256 of its parts' SHA-256s.  An object without a SHA-256 checksum gets the tree format
+# file hash of its bytes.  The contents hash is then made as in the tree format.  What a
+# dir was validated from is its trust:
+#   checksum - every file from a stored checksum, S3 checked the bytes on upload
+#   mixed - some files from stored checksums, the others read
+#   bytes - every file read
+#   audited - --deep-audit read every file and checked the stored checksums against them
+# Local files have no stored checksums, format 3 is for S3 only.
+
+def checksum_hash_dir_contents(s3_client, s3_bucket, ldirs, sHashAlgorithm='sha256', lManifest=None):
+    # Returns (contents hash, trust)
+    s3_base = ldirs[0] + '/'
+    root_hash = new_hash(sHashAlgorithm)
+    sLastPath = None
+    intChecksums = 0
+    intRead = 0
+    executor = None
+    intFileWorkers = s3_pool_size(file_workers)
+
+    if intFileWorkers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=intFileWorkers)
+
+    try:
+        for lBatch in batched(s3_list_files(s3_client, s3_bucket, ldirs), TREE_BATCH_SIZE):
+            lChecksums = checksum_map(executor, s3_head_checksum, s3_bucket, lBatch)
+
+            if checksum_deep_audit:
+                lAudited = checksum_map(executor, s3_audit_checksum, s3_bucket, lBatch, lChecksums)
+
+                for obj, checksum, audited in zip(lBatch, lChecksums, lAudited):
+                    if checksum != audited:
+                        # The file hash is made from the bytes, so the dir fails
+                        logger.critical('Stored checksum does not match the bytes - ' + obj['Key'] + ' - ' + checksum[1] + ' - ' + audited[1])
+                        metrics_count('s3_checksum_mismatches_total')
+
+                lChecksums = lAudited
+
+            # Objects without a checksum are read, as in the tree format
+            lLeaves = [s3_tree_leaf(s3_bucket, s3_base, obj, sHashAlgorithm) for obj, checksum in zip(lBatch, lChecksums) if checksum is None]
+            dRead = dict(tree_hash_batch(lLeaves, s3_hash_chunk, sHashAlgorithm, executor))
+
+            for obj, checksum in zip(lBatch, lChecksums):
+                sPath = obj['Key'][len(s3_base):]
+
+                if checksum is None:
+                    file_hash = dRead[sPath]
+                    intRead += 1
+                else:
+                    file_hash = new_hash(sHashAlgorithm)
+                    file_hash.update(('s3-checksum|SHA256|' + checksum[0] + '|' + checksum[1]).encode('utf-8'))
+                    file_hash = file_hash.digest()
+                    intChecksums += 1
+
+                if sLastPath is not None and sPath <= sLastPath:
+                    raise ValueError('Tree leaves out of order - ' + sLastPath + ' - ' + sPath)
+                sLastPath = sPath
+
+                bPath = sPath.encode('utf-8')
+                root_hash.update(len(bPath).to_bytes(8, 'big') + bPath + file_hash)
+
+                if lManifest is not None:
+                    lManifest.append((sPath, obj['Size'], file_hash))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    metrics_count('s3_checksum_objects_total', intChecksums, source='checksum')
+    metrics_count('s3_checksum_objects_total', intRead, source='bytes')
+
+    if checksum_deep_audit:
+        sTrust = 'audited'
+    elif intRead == 0:
+        sTrust = 'checksum'
+    elif intChecksums == 0:
+        sTrust = 'bytes'
+    else:
+        sTrust = 'mixed'
 
-def fs_hash_files_in_dir(directory):
-    sha2_hash = hashlib.sha256()
-    
-    objects2 = []
+    logger.info('Dir Trust - ' + ldirs[0] + ' - ' + sTrust + ' - ' + str(intChecksums) + ' from stored checksums, ' + str(intRead) + ' read')
+    return root_hash.hexdigest(), sTrust
 
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            file_path = os.path.join(dirpath, filename)
+def checksum_map(executor, fn, s3_bucket, *iterables):
+    if executor is not None:
+        return list(executor.map(bind_dir_context(fn), itertools.repeat(s3_bucket), *iterables))
 
-            if os.path.isfile(file_path):
+    return list(map(fn, itertools.repeat(s3_bucket), *iterables))
 
-                if not file_path in objects2:
-                    objects2.append(file_path)
+def s3_head_checksum(s3_bucket, obj):
+    # Returns (checksum type, ChecksumSHA256) stored with the object, None when it has none
+    lAlgorithms = obj.get('ChecksumAlgorithm')
 
-    objects2.sort()
+    if lAlgorithms is not None and 'SHA256' not in lAlgorithms:
+        # The listing already says there is no SHA-256 to ask for
+        return None
 
-    for obj in objects2:
-        logger.debug('FS - Hash File - ' + obj)
-        with open(obj, 'rb') as file:  # Open in binary mode = rb
-            while True:
-                # Read a chunk of data
-                chunk = file.read(1024 * 1024 * 10)  # Read 1024 bytes at a time
-                if not chunk:
-                    break  # End of file
-                # Process the chunk (e.g., print the byte data)
-                sha2_hash.update(chunk)
-                #sha2_hash.update(chunk)
+    kwargs = {
+        'Bucket': s3_bucket,
+        'Key': obj['Key'],
+        'ChecksumMode': 'ENABLED'
+    }
 
-    return sha2_hash.hexdigest()
+    if obj.get('ETag'):
+        # The checksum of the version that was listed
+        kwargs['IfMatch'] = obj['ETag']
 
-#endregion
+    # HEADs count against the S3 request rate too, they wait for a slot as GETs do
+    bThrottled = False
+    fLatency = 0.0
 
-#region Utility
+    if s3_limiter is not None:
+        s3_limiter.acquire()
 
-def get_parameter(intParmPos):
-    if (len(sys.argv) - 1) < intParmPos or sys.argv[intParmPos] is None:
-        return None  # Return None if the parameter is not provided
-    else:
-        return sys.argv[intParmPos]  # Return the parameter if it exists
+    fStart = time.perf_counter()
 
-def yenc_encode(string):
-    encoded = bytearray()
-    for char in string:
-        encoded.append((ord(char) + 42) % 256)
-    return encoded
+    try:
+        response = s3_client.head_object(**kwargs)
+        fLatency = time.perf_counter() - fStart
+        bThrottled = response.get('ResponseMetadata', {}).get('RetryAttempts', 0) > 0
+    except ClientError as e:
+        bThrottled = e.response.get('Error', {}).get('Code') in S3_THROTTLE_CODES
+        raise
+    finally:
+        metrics_observe('s3_head_seconds', time.perf_counter() - fStart)
 
-def yenc_decode(encoded):
-    decoded = ""
-    for byte in encoded:
-        decoded += chr((byte - 42) % 256)
-    return decoded
+        if bThrottled:
+            metrics_count('s3_throttled_total', call='head')
 
-def setup_logger(log_file, log_level):
-    intLogLevel = int(log_level)
+        if s3_limiter is not None:
+            s3_limiter.release(fLatency, 0, bThrottled)
 
-    logger = logging.getLogger('my_logger')
-    logger.setLevel(intLogLevel)
+    metrics_count('s3_head_requests_total')
+    s3_count_retries(response, 'head')
 
-    # Create file handler
-    if log_file != '':
-        file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(intLogLevel)
+    sChecksum = response.get('ChecksumSHA256')
+    if not sChecksum:
+        return None
 
-    # Create console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(intLogLevel)
+    # Older endpoints do not give the type, a composite checksum ends in -<parts>
+    return response.get('ChecksumType') or ('COMPOSITE' if '-' in sChecksum else 'FULL_OBJECT'), sChecksum
 
-    # Create formatter
-    formatter = logging.Formatter('%(asctime)s.%(msecs)03d - %(levelname)s - %(message)s', '%Y%m%d - %H:%M:%S')
+def s3_audit_checksum(s3_bucket, obj, checksum):
+    # Returns the checksum worked out from the object's bytes, in the form of the stored one
+    if checksum is None:
+        return None
 
-    # Add formatter to handlers
-    if log_file != '':
-        file_handler.setFormatter(formatter)
-    console_handler.setFormatter(formatter)
+    sType, sStored = checksum
+    kwargs = {
+        'Bucket': s3_bucket,
+        'Key': obj['Key']
+    }
 
-    # Add handlers to the logger
-    if log_file != '':
-        logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    if obj.get('ETag'):
+        kwargs['IfMatch'] = obj['ETag']
 
-    return logger
+    if sType != 'COMPOSITE':
+        sha2_hash = hashlib.sha256()
 
-def get_EpochTime():
-    return time.time()
+        try:
+            s3_fetch('audit', sha2_hash.update, **kwargs)
+        except FlexibleChecksumError:
+            # botocore checks a whole object GET against the stored checksum itself
+            return sType, 'bytes do not match'
 
-def hash_string(strIn):
-    sha2_dir_hash = hashlib.sha256()
-    sha2_dir_hash.update(yenc_encode(strIn))
-    return sha2_dir_hash.hexdigest()
+        return sType, base64.b64encode(sha2_hash.digest()).decode('ascii')
 
-#endregion
+    lPartDigests = []
+    intOffset = 0
 
-walacor_Bearer = ''
-walacor_Bearer_Expiration = 0.0
+    for intPartSize in s3_part_sizes(s3_bucket, obj['Key']):
+        part_hash = hashlib.sha256()
 
-if __name__ == "__main__":
-    
-    prog_mode = int(get_parameter(1))
-    source_type = int(get_parameter(2))
-    walacor_endpoint = get_parameter(3)
-    walacor_user = get_parameter(4)
-    walacor_password = get_parameter(5)
-    log_filename = get_parameter(6)
-    log_level = int(get_parameter(7))
-    source_root = get_parameter(8)
-    focus_model = get_parameter(9)
+        if intPartSize:
+            s3_fetch('audit', part_hash.update, Range='bytes=' + str(intOffset) + '-' + str(intOffset + intPartSize - 1), **kwargs)
+
+        lPartDigests.append(part_hash.digest())
+        intOffset += intPartSize
+
+    sValue = base64.b64encode(hashlib.sha256(b''.join(lPartDigests)).digest()).decode('ascii')
+
+    if '-' in sStored:
+        sValue += '-' + str(len(lPartDigests))
+
+    return sType, sValue
+
+def s3_part_sizes(s3_bucket, s3_key):
+    # The sizes of a multipart object's parts, in order
+    lSizes = []
+    intMarker = 0
+
+    while True:
+        response = s3_client.get_object_attributes(Bucket=s3_bucket, Key=s3_key, ObjectAttributes=['ObjectParts'], MaxParts=1000, PartNumberMarker=intMarker)
+        parts = response.get('ObjectParts', {})
+        lSizes.extend(part['Size'] for part in parts.get('Parts', []))
+
+        if not parts.get('IsTruncated'):
+            return lSizes
+
+        intMarker = parts['NextPartNumberMarker']
+
+#endregion
+
+#region S3 Inventory
+
+# With --s3-inventory the keys come from an S3 Inventory report instead of ListObjectsV2,
+# only the bytes that are hashed are fetched.  The report's keys under the root are loaded
+# into a temporary SQLite table, which gives them back per prefix in UTF-8 binary order,
+# the order ListObjectsV2 has them in.  Size, ETag and LastModified are made to look like
+# a listing's, so cache keys and If-Match work the same.  A report is only as new as its
+# date, keys made since then are not seen.
+
+INVENTORY_FIELDS = {
+    # CSV fileSchema name, ORC/Parquet column name
+    'Bucket': 'bucket',
+    'Key': 'key',
+    'Size': 'size',
+    'LastModifiedDate': 'last_modified_date',
+    'ETag': 'e_tag',
+    'IsLatest': 'is_latest',
+    'IsDeleteMarker': 'is_delete_marker'
+}
+
+def inventory_read_file(sLocation, sKey=None):
+    # A manifest (sKey None) or a data file named by its key in the destination bucket.
+    # s3://bucket/key is fetched, a local manifest's data files are looked for above it
+    if sLocation.startswith('s3://'):
+        sBucket, sManifestKey = sLocation[5:].split('/', 1)
+        return s3_client.get_object(Bucket=sBucket, Key=sKey or sManifestKey)['Body'].read()
+
+    if sKey is None:
+        with open(sLocation, 'rb') as file:
+            return file.read()
+
+    # A local copy keeps the bucket layout under some dir above the manifest
+    sDir = os.path.dirname(os.path.abspath(sLocation))
+    while True:
+        for sPath in (os.path.join(sDir, sKey), os.path.join(sDir, 'data', os.path.basename(sKey))):
+            if os.path.isfile(sPath):
+                with open(sPath, 'rb') as file:
+                    return file.read()
+
+        if os.path.dirname(sDir) == sDir:
+            raise FileNotFoundError('Inventory file not found above ' + sLocation + ' - ' + sKey)
+        sDir = os.path.dirname(sDir)
+
+def inventory_rows(sManifest):
+    # Yields a dict per row of every data file in the report, with the CSV field names
+    manifest = json.loads(inventory_read_file(sManifest))
+    sFormat = manifest['fileFormat'].upper()
+
+    if sFormat in ('ORC', 'PARQUET') and pyarrow is None:
+        raise ValueError('S3 Inventory in ' + sFormat + ' needs the pyarrow package (pip install pyarrow)')
+
+    for dFile in manifest['files']:
+        logger.info('S3 Inventory - Reading - ' + dFile['key'])
+        data = inventory_read_file(sManifest, dFile['key'])
+
+        if sFormat == 'CSV':
+            # Keys are URL encoded, the file is gzipped and has no header
+            lFields = [sField.strip() for sField in manifest['fileSchema'].split(',')]
+            for lRow in csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)), encoding='utf-8', newline='')):
+                row = dict(zip(lFields, lRow))
+                row['Key'] = urllib.parse.unquote_plus(row['Key'])
+                yield row
+        else:
+            if sFormat == 'ORC':
+                from pyarrow import orc
+                table = orc.ORCFile(pyarrow.BufferReader(data)).read()
+            else:
+                from pyarrow import parquet
+                table = parquet.read_table(pyarrow.BufferReader(data))
+
+            for batch in table.to_batches(max_chunksize=10000):
+                for row in batch.to_pylist():
+                    yield {sField: row.get(sColumn) for sField, sColumn in INVENTORY_FIELDS.items() if sColumn in row}
+
+def inventory_load(sManifest, sRoot):
+    # Loads the keys under sRoot into a temporary SQLite file, returns the top level dirs
+    global inventory_db_path
+
+    intHandle, inventory_db_path = tempfile.mkstemp(prefix='ObjectValidator_Inventory_', suffix='.db')
+    os.close(intHandle)
+    atexit.register(os.remove, inventory_db_path)
+
+    conn = sqlite3.connect(inventory_db_path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('CREATE TABLE Object (Key TEXT PRIMARY KEY, Size INTEGER, ETag TEXT, LastModified TEXT)')
+
+    sPrefix = sRoot + '/'
+    setDirs = set()
+    intRows = 0
+
+    for lBatch in batched(inventory_rows(sManifest), 10000):
+        lObjects = []
+
+        for row in lBatch:
+            # Only the current version of keys in our bucket under the root
+            if row.get('Bucket') not in (None, s3_bucket) or not row['Key'].startswith(sPrefix):
+                continue
+            if str(row.get('IsLatest', 'true')).lower() == 'false' or str(row.get('IsDeleteMarker', 'false')).lower() == 'true':
+                continue
+
+            sRest = row['Key'][len(sPrefix):]
+            if '/' in sRest:
+                setDirs.add(sRest.split('/', 1)[0])
+
+            lObjects.append((row['Key'], int(row['Size'] or 0), row.get('ETag') or '', inventory_timestamp(row.get('LastModifiedDate'))))
+
+        conn.executemany('INSERT OR REPLACE INTO Object (Key, Size, ETag, LastModified) VALUES (?, ?, ?, ?)', lObjects)
+        intRows += len(lObjects)
+
+    conn.commit()
+    conn.close()
+
+    metrics_count('inventory_objects_total', intRows)
+    logger.info('S3 Inventory loaded - ' + str(intRows) + ' objects in ' + str(len(setDirs)) + ' dirs')
+
+    return setDirs
+
+def inventory_timestamp(value):
+    # ISO text (CSV) or a datetime (ORC/Parquet), kept as ISO text in UTC
+    if value is None or value == '':
+        return ''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.astimezone(datetime.timezone.utc).isoformat()
+
+    return datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00')).astimezone(datetime.timezone.utc).isoformat()
+
+def inventory_connect():
+    # One connection per thread, S3 dirs are hashed on several threads
+    conn = getattr(inventory_thread, 'conn', None)
+
+    if conn is None:
+        conn = inventory_thread.conn = sqlite3.connect(inventory_db_path)
+
+    return conn
+
+def inventory_list_directories(prefix):
+    if prefix != source_root:
+        raise ValueError('S3 Inventory is loaded for root ' + source_root + ', not ' + prefix)
+
+    return sorted(inventory_dirs)
+
+def inventory_list_objects(s3_prefix):
+    # Yields the objects under a prefix in key order, as list_objects_v2 gives them
+    cursor = inventory_connect().execute('SELECT Key, Size, ETag, LastModified FROM Object WHERE Key >= ? ORDER BY Key', (s3_prefix,))
+
+    while True:
+        lRows = cursor.fetchmany(1000)
+        if not lRows:
+            return
+
+        for sKey, intSize, sETag, sLastModified in lRows:
+            if not sKey.startswith(s3_prefix):
+                return
+
+            yield {
+                'Key': sKey,
+                'Size': intSize,
+                'ETag': '"' + sETag.strip('"') + '"' if sETag else None,
+                'LastModified': datetime.datetime.fromisoformat(sLastModified) if sLastModified else None
+            }
+
+#endregion
+
+#region Filesystem
+
+def fs_hash_files_in_dir(directory, intHashFormat=1, sHashAlgorithm='sha256', lManifest=None):
+    # lManifest, when given, gets (relative path, size, file digest) for every file
+    sha2_hash = new_hash(sHashAlgorithm)
+    intBase = len(os.path.join(directory, ''))
+
+    if intHashFormat == HASH_FORMAT_TREE:
+        return tree_hash_leaves((fs_tree_leaf(obj, intBase, sHashAlgorithm) for obj in fs_list_files(directory)), fs_hash_chunk, sHashAlgorithm, lManifest)
+
+    for obj in fs_list_files(directory):
+        logger.debug('FS - Hash File - ' + obj)
+
+        if lManifest is not None:
+            tee = HashTee(sha2_hash, new_hash(sHashAlgorithm))
+            fs_hash_range(obj, tee)
+            lManifest.append((obj[intBase:].replace(os.sep, '/'), tee.intBytes, tee.hash_objects[1].digest()))
+            continue
+
+        fs_hash_range(obj, sha2_hash)
+
+    return sha2_hash.hexdigest()
+
+def fs_tree_leaf(obj, intBase, sHashAlgorithm):
+    # Stat only when the file's turn comes, the listings hold names (follows symlinks)
+    stat = os.stat(obj)
+    sCacheKey = cache_key(sHashAlgorithm, 'fs', stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+    return (obj[intBase:].replace(os.sep, '/'), obj, stat.st_size, sCacheKey)
+
+def fs_list_files(directory):
+    # Yields the path of every file under directory, in the order sorted() gives them,
+    # holding only the names in the listings of the dirs on the way down.
+    # A dir sorts as its name + '/', which is where its files fall among its siblings.
+    # Symlinked files are hashed, symlinked dirs are not followed, like os.walk
+    executor = None
+
+    if fs_scan_workers > 1:
+        # Listings of the next sibling dirs are read ahead while the current one is hashed
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=fs_scan_workers)
+
+    try:
+        intFiles = 0
+
+        for obj in fs_walk_listing(directory, fs_scan_dir(directory), executor):
+            intFiles += 1
+            yield obj
+
+        metrics_count('fs_files_total', intFiles)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def fs_walk_listing(sPath, lNames, executor):
+    lDirs = [os.path.join(sPath, sName[:-1]) for sName in lNames if sName.endswith('/')] if executor is not None else []
+    pending = collections.deque()
+    intNext = 0
+
+    for sName in lNames:
+        if not sName.endswith('/'):
+            yield os.path.join(sPath, sName)
+            continue
+
+        sSubPath = os.path.join(sPath, sName[:-1])
+
+        # Keep fs_scan_workers listings in flight ahead of the walk
+        while intNext < len(lDirs) and len(pending) < fs_scan_workers:
+            pending.append(executor.submit(bind_dir_context(fs_scan_dir), lDirs[intNext]))
+            intNext += 1
+
+        lSubNames = pending.popleft().result() if pending else fs_scan_dir(sSubPath)
+
+        yield from fs_walk_listing(sSubPath, lSubNames, executor)
+
+def fs_scan_dir(sPath):
+    # Returns the sorted names of the files and dirs in sPath, a dir to walk is its name + '/'.
+    # Only the names are kept, a DirEntry is several times the size of its name.
+    # A dir that can not be listed is left out, as os.walk does
+    lNames = []
+
+    with metrics_timer('fs_enumerate_seconds'):
+        try:
+            with os.scandir(sPath) as iterEntries:
+                for entry in iterEntries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            lNames.append(entry.name + '/')
+                    elif entry.is_file():
+                        lNames.append(entry.name)
+        except OSError as e:
+            logger.warning('FS - Can not list - ' + sPath + ' - ' + str(e))
+            metrics_count('fs_list_errors_total')
+
+        lNames.sort()
+
+    return lNames
+
+def fs_hash_chunk(file_path, intOffset, intLength, sHashAlgorithm='sha256'):
+    logger.debug('FS - Hash Chunk - ' + file_path + ' - ' + str(intOffset))
+    chunk_hash = new_hash(sHashAlgorithm)
+
+    fs_hash_range(file_path, chunk_hash, intOffset, intLength)
+
+    return chunk_hash.digest()
+
+def fs_hash_range(file_path, hash_object, intOffset=0, intLength=None):
+    # Feeds the bytes from intOffset (to the end of the file when intLength is None) into hash_object.
+    # Reads go into reused buffers, the kernel is told the access is sequential, and
+    # pages already hashed are dropped so a big scan does not flush the page cache
+    fStart = time.perf_counter()
+    intBytes = fs_hash_range_read(file_path, hash_object, intOffset, intLength)
+
+    metrics_observe('fs_read_seconds', time.perf_counter() - fStart)
+    metrics_count('fs_read_bytes_total', intBytes)
+
+def fs_hash_range_read(file_path, hash_object, intOffset, intLength):
+    # Returns the number of bytes hashed
+    with open(file_path, 'rb', buffering=0) as file:  # Unbuffered, readinto fills our buffer directly
+        fd = file.fileno()
+        intEnd = None if intLength is None else intOffset + intLength
+
+        if intOffset:
+            file.seek(intOffset)
+
+        fs_advise(fd, intOffset, intLength or 0, 'POSIX_FADV_SEQUENTIAL')
+
+        if fs_read_ahead > 0 and (intLength is None or intLength > fs_read_buffer) and os.fstat(fd).st_size - intOffset > fs_read_buffer:
+            # More than one buffer to read, overlap the disk with the hashing
+            return fs_hash_read_ahead(file, hash_object, intOffset, intEnd)
+
+        view = memoryview(fs_get_buffers(1)[0])
+        intPos = intOffset
+
+        while intEnd is None or intPos < intEnd:
+            intRead = file.readinto(view if intEnd is None else view[:intEnd - intPos])
+            if not intRead:
+                break  # End of file
+
+            hash_object.update(view[:intRead])
+            fs_drop_pages(fd, intPos, intRead)
+            intPos += intRead
+
+        return intPos - intOffset
+
+def fs_hash_read_ahead(file, hash_object, intPos, intEnd):
+    # A reader thread fills up to fs_read_ahead buffers ahead of the hashing
+    fd = file.fileno()
+    qFree = queue.Queue()
+    qFull = queue.Queue()
+    evStop = threading.Event()
+
+    for buffer in fs_get_buffers(fs_read_ahead + 1):
+        qFree.put(buffer)
+
+    def reader():
+        try:
+            intReadPos = intPos
+
+            while not evStop.is_set() and (intEnd is None or intReadPos < intEnd):
+                buffer = qFree.get()
+                if buffer is None:
+                    break
+
+                view = memoryview(buffer)
+                intRead = file.readinto(view if intEnd is None else view[:intEnd - intReadPos])
+                if not intRead:
+                    break  # End of file
+
+                qFull.put((buffer, intRead, intReadPos))
+                intReadPos += intRead
+
+            qFull.put(None)
+        except BaseException as e:
+            qFull.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    intBytes = 0
+
+    try:
+        while True:
+            item = qFull.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+
+            buffer, intRead, intReadPos = item
+            hash_object.update(memoryview(buffer)[:intRead])
+            fs_drop_pages(fd, intReadPos, intRead)
+            qFree.put(buffer)
+            intBytes += intRead
+    finally:
+        evStop.set()
+        qFree.put(None)
+        thread.join()
+
+    return intBytes
+
+def fs_get_buffers(intCount):
+    # Each thread keeps its read buffers instead of allocating new bytes for every read
+    lBuffers = getattr(fs_thread_buffers, 'lBuffers', [])
+
+    if lBuffers and len(lBuffers[0]) != fs_read_buffer:
+        lBuffers = []
+
+    while len(lBuffers) < intCount:
+        lBuffers.append(bytearray(fs_read_buffer))
+
+    fs_thread_buffers.lBuffers = lBuffers
+    return lBuffers[:intCount]
+
+def fs_advise(fd, intOffset, intLength, sAdvice):
+    # posix_fadvise is only a hint and is not there on every platform
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, intOffset, intLength, getattr(os, sAdvice))
+        except OSError:
+            pass
+
+def fs_drop_pages(fd, intOffset, intLength):
+    if fs_drop_cache:
+        fs_advise(fd, intOffset, intLength, 'POSIX_FADV_DONTNEED')
+
+#endregion
+
+#region Tree Hash
+
+# Format 2 hashes every file in fixed-size chunks, each chunk on its own:
+#   file hash = hash(chunk hash 1 + chunk hash 2 + ...)
+#   contents hash = hash over the files sorted by relative path of
+#                   (8 byte big endian path length + utf-8 path + file hash)
+# An empty file is a single empty chunk.  The chunk size is part of the format.
+# Every hash in the tree uses the record's hash algorithm.
+
+def tree_hash_leaves(iterLeaves, fnHashChunk, sHashAlgorithm='sha256', lManifest=None):
+    # iterLeaves yields (relative path, source reference, size, cache key) sorted by relative path,
+    # fnHashChunk(source reference, offset, length, algorithm) returns the chunk digest.
+    # Leaves are taken a batch at a time so memory does not grow with the number of files,
+    # unless lManifest is given, it gets (relative path, size, file hash) for every leaf
+    root_hash = new_hash(sHashAlgorithm)
+    sLastPath = None
+    executor = None
+    intFileWorkers = s3_pool_size(file_workers) if source_type == 2 else file_workers
+
+    if intFileWorkers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=intFileWorkers)
+
+    try:
+        for lBatch in batched(iterLeaves, TREE_BATCH_SIZE):
+            for leaf, (sPath, file_hash) in zip(lBatch, tree_hash_batch(lBatch, fnHashChunk, sHashAlgorithm, executor)):
+                if sLastPath is not None and sPath <= sLastPath:
+                    raise ValueError('Tree leaves out of order - ' + sLastPath + ' - ' + sPath)
+                sLastPath = sPath
+
+                if lManifest is not None:
+                    lManifest.append((sPath, leaf[2], file_hash))
+
+                bPath = sPath.encode('utf-8')
+                root_hash.update(len(bPath).to_bytes(8, 'big') + bPath + file_hash)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return root_hash.hexdigest()
+
+def tree_hash_batch(lLeaves, fnHashChunk, sHashAlgorithm, executor):
+    # Returns (relative path, file hash) for each leaf, reading only what is not cached
+    # and not already hashed in this run for another copy of the same content
+    lRefs = []
+    lOffsets = []
+    lLengths = []
+    lCounts = []
+    lWaits = []
+    lOwned = []
+    lFileHashes = cache_get_file_hashes([leaf[3] for leaf in lLeaves])
+    lCached = [bool(file_hash) for file_hash in lFileHashes]
+
+    try:
+        for intLeaf, (sPath, ref, intSize, sCacheKey) in enumerate(lLeaves):
+            lCounts.append(0)
+
+            if lFileHashes[intLeaf]:
+                # Unchanged since it was last hashed, nothing to read
+                logger.debug('Cache - Hit - ' + sPath)
+                metrics_count('cache_hits_total')
+                continue
+
+            if hash_cache_path:
+                metrics_count('cache_misses_total')
+
+            file_hash, event, bOwn = dedup_claim(sCacheKey, intSize)
+
+            if file_hash:
+                logger.debug('Dedup - Hit - ' + sPath)
+                lFileHashes[intLeaf] = file_hash
+                continue
+
+            if event is not None:
+                # Another dir is reading a copy right now
+                lWaits.append((intLeaf, event))
+                continue
+
+            if bOwn:
+                lOwned.append(sCacheKey)
+
+            intOffset = 0
+            intCount = 0
+
+            while True:
+                lRefs.append(ref)
+                lOffsets.append(intOffset)
+                lLengths.append(min(TREE_CHUNK_SIZE, intSize - intOffset))
+                intCount += 1
+                intOffset += TREE_CHUNK_SIZE
+
+                if intOffset >= intSize:
+                    break
+
+            lCounts[-1] = intCount
+
+        if executor is not None and len(lRefs) > 1:
+            lDigests = list(executor.map(bind_dir_context(fnHashChunk), lRefs, lOffsets, lLengths, itertools.repeat(sHashAlgorithm)))
+        else:
+            lDigests = list(map(fnHashChunk, lRefs, lOffsets, lLengths, itertools.repeat(sHashAlgorithm)))
+
+        intPos = 0
+        dDone = {}
+
+        for intLeaf, intCount in enumerate(lCounts):
+            if intCount:
+                file_hash = new_hash(sHashAlgorithm)
+                file_hash.update(b''.join(lDigests[intPos:intPos + intCount]))
+                lFileHashes[intLeaf] = dDone[lLeaves[intLeaf][3]] = file_hash.digest()
+                intPos += intCount
+
+        # What this batch hashed is handed over before it waits on anyone else's,
+        # so two dirs waiting on each other's copies can not block
+        while lOwned:
+            sCacheKey = lOwned.pop()
+            dedup_release(sCacheKey, dDone[sCacheKey])
+    finally:
+        for sCacheKey in lOwned:
+            dedup_release(sCacheKey, None)
+
+    for intLeaf, event in lWaits:
+        sPath, ref, intSize, sCacheKey = lLeaves[intLeaf]
+        event.wait()
+        file_hash = dedup_lookup(sCacheKey)
+
+        if file_hash is None:
+            # The other copy failed, this one is read after all
+            file_hash = tree_hash_file(ref, intSize, fnHashChunk, sHashAlgorithm)
+
+        lFileHashes[intLeaf] = file_hash
+
+    cache_put_file_hashes([(leaf[3], file_hash) for leaf, file_hash, bCached in zip(lLeaves, lFileHashes, lCached) if not bCached])
+
+    return [(leaf[0], file_hash) for leaf, file_hash in zip(lLeaves, lFileHashes)]
+
+def tree_hash_file(ref, intSize, fnHashChunk, sHashAlgorithm):
+    # One file's hash, its chunks read one after another
+    file_hash = new_hash(sHashAlgorithm)
+
+    for intOffset in range(0, max(intSize, 1), TREE_CHUNK_SIZE):
+        file_hash.update(fnHashChunk(ref, intOffset, min(TREE_CHUNK_SIZE, intSize - intOffset), sHashAlgorithm))
+
+    return file_hash.digest()
+
+#endregion
+
+#region Cache
+
+# Per-file hashes of the tree format, keyed by what identifies an unchanged file:
+#   filesystem - device, inode, size, mtime_ns, ctime_ns
+#   S3 - bucket, key, ETag, size, LastModified (ETag and size with --dedup-etag)
+
+def cache_key(sHashAlgorithm, *parts):
+    # The chunk size and algorithm change every file hash, so they are part of every key
+    return '|'.join(str(part) for part in (HASH_FORMAT_TREE, TREE_CHUNK_SIZE, sHashAlgorithm) + parts)
+
+def cache_connect():
+    global cache_conn, cache_pid
+
+    if not hash_cache_path:
+        return None
+
+    # A connection is not carried over into a worker process
+    if cache_conn is None or cache_pid != os.getpid():
+        cache_conn = sqlite3.connect(hash_cache_path, timeout=60, check_same_thread=False)
+        cache_conn.execute('PRAGMA journal_mode=WAL')
+        cache_conn.execute('CREATE TABLE IF NOT EXISTS FileHash (CacheKey TEXT PRIMARY KEY, FileHash BLOB NOT NULL, LastUsed REAL)')
+        cache_conn.commit()
+        cache_pid = os.getpid()
+
+    return cache_conn
+
+def cache_get_file_hashes(lCacheKeys):
+    # Returns the cached file hash (or None) for each key
+    lFound = [None] * len(lCacheKeys)
+
+    if not hash_cache_paranoid:
+        with cache_lock:
+            conn = cache_connect()
+            if conn is not None:
+                lFound = cache_select(conn, 'SELECT CacheKey, FileHash FROM FileHash WHERE CacheKey IN ', lCacheKeys)
+
+    if checkpoint_path and not all(lFound):
+        # Files this run hashed before it was restarted, even a paranoid run read them
+        lProgress = checkpoint_get_file_hashes(lCacheKeys)
+        lFound = [file_hash or progress_hash for file_hash, progress_hash in zip(lFound, lProgress)]
+
+    return lFound
+
+def cache_select(conn, sQuery, lCacheKeys, lParams=()):
+    # Runs sQuery + (?, ?, ...) over the keys 500 at a time, the rows are (key, file hash)
+    dFound = {}
+
+    for intStart in range(0, len(lCacheKeys), 500):
+        lBatch = lCacheKeys[intStart:intStart + 500]
+        for sCacheKey, file_hash in conn.execute(sQuery + '(' + ','.join('?' * len(lBatch)) + ')', list(lParams) + lBatch):
+            dFound[sCacheKey] = bytes(file_hash)
+
+    return [dFound.get(sCacheKey) for sCacheKey in lCacheKeys]
+
+def cache_put_file_hashes(lEntries):
+    if not lEntries:
+        return
+
+    checkpoint_put_file_hashes(lEntries)
+
+    with cache_lock:
+        conn = cache_connect()
+        if conn is None:
+            return
+
+        fNow = get_EpochTime()
+        conn.executemany('INSERT OR REPLACE INTO FileHash (CacheKey, FileHash, LastUsed) VALUES (?, ?, ?)',
+                         [(sCacheKey, file_hash, fNow) for sCacheKey, file_hash in lEntries])
+        conn.commit()
+
+#endregion
+
+#region Dedup
+
+# The same content is only hashed once in a run, tree format only.  Copies are found by
+# the cache key, which does not name the file's path:
+#   filesystem - device and inode, so hard links of one file (always on)
+#   S3 - ETag and size with --dedup-etag, a trust in ETags some setups do not allow
+# The first dir to reach the content hashes it, others copying it at the same time wait
+# for its file hash.  Across runs the same keys are found in --cache.  Files smaller
+# than DEDUP_MIN_SIZE are not worth the bookkeeping.  Local dirs hashed by different
+# worker processes only share their file hashes through --cache.
+
+def dedup_claim(sCacheKey, intSize):
+    # Returns (file hash, event, owned):
+    #   the file hash when a copy was hashed earlier in the run,
+    #   an event to wait on when a copy is being hashed now,
+    #   owned when the caller is to hash it, and dedup_release it after
+    if hash_cache_paranoid or intSize < DEDUP_MIN_SIZE:
+        return None, None, False
+
+    with dedup_lock:
+        file_hash = dedup_hashes.get(sCacheKey)
+        event = dedup_pending.get(sCacheKey)
+
+        if file_hash is not None or event is not None:
+            metrics_count('dedup_hits_total')
+            metrics_count('dedup_bytes_total', intSize)
+            return file_hash, event, False
+
+        dedup_pending[sCacheKey] = threading.Event()
+
+    return None, None, True
+
+def dedup_release(sCacheKey, file_hash):
+    # file_hash None is a failed read, whoever waits on it reads its own copy
+    with dedup_lock:
+        if file_hash is not None:
+            dedup_hashes[sCacheKey] = file_hash
+
+        event = dedup_pending.pop(sCacheKey)
+
+    event.set()
+
+def dedup_lookup(sCacheKey):
+    with dedup_lock:
+        return dedup_hashes.get(sCacheKey)
+
+#endregion
+
+#region Manifest
+
+# With --manifest-store each dir also gets a manifest, its files' (path, size, digest),
+# so a failed validation names the files that were added, removed or modified without
+# a second scan.  A manifest is gzipped text, one line per file sorted by relative path:
+#   ObjectValidator manifest 1 <hash format> <hash algorithm>
+#   <hex digest> <size> <json path>
+# The digest is the file hash of the tree format, or in the stream format a hash of the
+# file fed the same bytes as the contents hash, so nothing is read twice.  Manifests are
+# kept content addressed in a local dir or under s3://bucket/prefix, the record's
+# ManifestHash is their sha256, so a manifest changed in the store is not trusted.
+
+class HashTee:
+    # Feeds the same bytes to several hash objects, and counts them
+    def __init__(self, *hash_objects):
+        self.hash_objects = hash_objects
+        self.intBytes = 0
+
+    def update(self, data):
+        for hash_object in self.hash_objects:
+            hash_object.update(data)
+
+        self.intBytes += len(data)
+
+def manifest_build(lEntries, intHashFormat, sHashAlgorithm):
+    # lEntries holds (relative path, size, digest) sorted by relative path
+    lLines = ['ObjectValidator manifest 1 ' + str(intHashFormat) + ' ' + sHashAlgorithm]
+
+    for sPath, intSize, digest in lEntries:
+        lLines.append(digest.hex() + ' ' + str(intSize) + ' ' + json.dumps(sPath))
+
+    # mtime=0 so the same files always give the same bytes, and the same ManifestHash
+    return gzip.compress(('\n'.join(lLines) + '\n').encode('utf-8'), mtime=0)
+
+def manifest_parse(bManifest):
+    # Returns ((hash format, hash algorithm), {relative path: (size, hex digest)})
+    lLines = gzip.decompress(bManifest).decode('utf-8').splitlines()
+    lHeader = lLines[0].split(' ')
+    dFiles = {}
+
+    for sLine in lLines[1:]:
+        sDigest, sSize, sPath = sLine.split(' ', 2)
+        dFiles[json.loads(sPath)] = (int(sSize), sDigest)
+
+    return (int(lHeader[3]), lHeader[4]), dFiles
+
+def manifest_location(sManifestHash):
+    # (bucket, key) in an S3 store, the file path in a local one, 256 sub dirs either way
+    sName = sManifestHash[:2] + '/' + sManifestHash + '.gz'
+
+    if manifest_store.startswith('s3://'):
+        sBucket, _, sPrefix = manifest_store[5:].partition('/')
+        return sBucket, (sPrefix.rstrip('/') + '/' if sPrefix.strip('/') else '') + sName
+
+    return os.path.join(manifest_store, sName)
+
+def manifest_put(bManifest):
+    # Returns the ManifestHash, '' when it could not be stored
+    sManifestHash = hashlib.sha256(bManifest).hexdigest()
+
+    try:
+        with metrics_timer('manifest_put_seconds'):
+            if manifest_store.startswith('s3://'):
+                sBucket, sKey = manifest_location(sManifestHash)
+                (manifest_s3_client or s3_client).put_object(Bucket=sBucket, Key=sKey, Body=bManifest)
+            else:
+                sPath = manifest_location(sManifestHash)
+
+                # Content addressed, a manifest already there is the same one
+                if not os.path.exists(sPath):
+                    os.makedirs(os.path.dirname(sPath), exist_ok=True)
+                    sTemp = sPath + '.' + str(os.getpid()) + '.tmp'
+                    with open(sTemp, 'wb') as file:
+                        file.write(bManifest)
+                    os.replace(sTemp, sPath)
+    except (OSError, ClientError) as e:
+        logger.error('Manifest not stored - ' + sManifestHash + ' - ' + str(e))
+        metrics_count('manifest_errors_total', op='put')
+        return ''
+
+    metrics_count('manifest_bytes_total', len(bManifest))
+    return sManifestHash
+
+def manifest_get(sManifestHash):
+    # Returns the manifest, None when it is not in the store or not the one the record has
+    try:
+        if manifest_store.startswith('s3://'):
+            sBucket, sKey = manifest_location(sManifestHash)
+            bManifest = (manifest_s3_client or s3_client).get_object(Bucket=sBucket, Key=sKey)['Body'].read()
+        else:
+            with open(manifest_location(sManifestHash), 'rb') as file:
+                bManifest = file.read()
+    except (OSError, ClientError) as e:
+        logger.error('Manifest not found - ' + sManifestHash + ' - ' + str(e))
+        metrics_count('manifest_errors_total', op='get')
+        return None
+
+    if hashlib.sha256(bManifest).hexdigest() != sManifestHash:
+        logger.critical('Manifest does not match its record, not used - ' + sManifestHash)
+        metrics_count('manifest_errors_total', op='mismatch')
+        return None
+
+    return bManifest
+
+def manifest_store_dir(sdir, state=None):
+    # Stores the manifest just made for sdir, returns its ManifestHash or ''
+    bManifest = (state or run_state).manifests.pop(sdir, None)
+
+    if bManifest is None:
+        return ''
+
+    return manifest_put(bManifest)
+
+def manifest_compare(sdir, sNameHashRecord, state=None):
+    # Logs the files of a failed dir that differ from the record's manifest,
+    # they also go in the summary.  Nothing is read again, the manifest came with the hash
+    state = state or run_state
+    bCurrent = state.manifests.pop(sdir, None)
+    sManifestHash = sNameHashRecord.get('ManifestHash') if sNameHashRecord else ''
+
+    if bCurrent is None or not sManifestHash:
+        if bCurrent is not None:
+            logger.warning('Record has no manifest, changed files not known - ' + sdir)
+        return
+
+    bStored = manifest_get(sManifestHash)
+    if bStored is None:
+        return
+
+    stored_spec, dStored = manifest_parse(bStored)
+    current_spec, dCurrent = manifest_parse(bCurrent)
+
+    if stored_spec != current_spec:
+        logger.warning('Manifest is ' + W_HashSpecName(*stored_spec) + ', not ' + W_HashSpecName(*current_spec) + ', changed files not known - ' + sdir)
+        return
+
+    changes = {
+        'added': sorted(sPath for sPath in dCurrent if sPath not in dStored),
+        'removed': sorted(sPath for sPath in dStored if sPath not in dCurrent),
+        'modified': sorted(sPath for sPath in dCurrent if sPath in dStored and dCurrent[sPath] != dStored[sPath])
+    }
+
+    for sChange, lPaths in changes.items():
+        metrics_count('manifest_changed_files_total', len(lPaths), change=sChange)
+
+        for sPath in lPaths[:MANIFEST_LOG_LIMIT]:
+            logger.critical('File ' + sChange + ' - ' + sdir + ' - ' + sPath)
+
+        if len(lPaths) > MANIFEST_LOG_LIMIT:
+            logger.critical('File ' + sChange + ' - ' + sdir + ' - ' + str(len(lPaths) - MANIFEST_LOG_LIMIT) + ' more, see the summary')
+
+    state.changes[sdir] = changes
+
+#endregion
+
+#region Watch
+
+# Watch mode keeps running and rehashes only the top level dirs that change.
+# Local roots are watched with inotify (a watch on every dir under the root), where
+# inotify is not there or runs out of watches the dirs are scanned every watch_interval.
+# S3 roots are listed every watch_interval, a dir has changed when a key under it came,
+# went, or has another ETag, LastModified or Size.  A changed dir is rehashed once it has
+# been quiet for watch_debounce seconds, or has kept changing for 10 times that.
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+class InotifyTree:
+    # inotify watches on a dir and every dir under it, read() gives the paths that changed.
+    # Raises OSError when inotify is not there or the watch limit is reached
+    def __init__(self, sRoot):
+        sLibc = ctypes.util.find_library('c') if sys.platform.startswith('linux') else None
+        if not sLibc:
+            raise OSError(errno.ENOSYS, 'inotify is only there on Linux')
+
+        self.libc = ctypes.CDLL(sLibc, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.dPaths = {}
+        self.add_tree(sRoot)
+
+    def add_tree(self, sPath):
+        for dirpath, dirnames, filenames in os.walk(sPath):
+            intWd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK | IN_ONLYDIR)
+
+            if intWd < 0:
+                intErrno = ctypes.get_errno()
+                if intErrno in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # Gone again already
+                if intErrno == errno.ENOSPC:
+                    raise OSError(intErrno, 'inotify watch limit reached, raise fs.inotify.max_user_watches')
+                raise OSError(intErrno, 'inotify_add_watch failed - ' + dirpath)
+
+            self.dPaths[intWd] = dirpath
+
+    def read(self, fTimeout):
+        # Returns the paths with events, None in the list means events were lost
+        if not select.select([self.fd], [], [], fTimeout)[0]:
+            return []
+
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+
+        lPaths = []
+        intPos = 0
+
+        while intPos < len(data):
+            intWd, intMask, intCookie, intLength = struct.unpack_from('iIII', data, intPos)
+            sName = os.fsdecode(data[intPos + 16:intPos + 16 + intLength].rstrip(b'\0'))
+            intPos += 16 + intLength
+
+            if intMask & IN_Q_OVERFLOW:
+                lPaths.append(None)
+                continue
+
+            sDir = self.dPaths.get(intWd)
+            if sDir is None:
+                continue
+
+            if intMask & IN_IGNORED:
+                del self.dPaths[intWd]
+                continue
+
+            sPath = os.path.join(sDir, sName) if sName else sDir
+            lPaths.append(sPath)
+
+            if intMask & IN_ISDIR and intMask & (IN_CREATE | IN_MOVED_TO):
+                # A new dir, with whatever was made in it before it was watched
+                self.add_tree(sPath)
+
+        return lPaths
+
+    def close(self):
+        os.close(self.fd)
+
+def watch_top_dir(sPath):
+    # The top level dir under the root a path is in, None for the root itself
+    sRel = os.path.relpath(sPath, source_root)
+    if sRel == '.' or sRel.startswith('..'):
+        return None
+
+    return sRel.split(os.sep)[0]
+
+def watch_snapshot():
+    # {dir: digest of what is under it}, from file metadata or the S3 listing, nothing is read
+    dSnapshot = {}
+
+    if source_type == 1:
+        for sdir in get_dir_list():
+            dir_digest = hashlib.sha256()
+
+            for dirpath, dirnames, filenames in os.walk(os.path.join(source_root, sdir)):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    sPath = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.lstat(sPath)
+                    except FileNotFoundError:
+                        continue
+                    dir_digest.update((sPath + '|' + str(stat.st_ino) + '|' + str(stat.st_size) + '|' + str(stat.st_mtime_ns) + '|' + str(stat.st_ctime_ns) + '\n').encode('utf-8', 'surrogateescape'))
+
+            dSnapshot[sdir] = dir_digest.hexdigest()
+
+    elif source_type == 2:
+        intBase = len(source_root) + 1
+        sLastDir = None
+        dir_digest = None
+
+        # Keys come in order, so each dir's keys are together
+        for obj in s3_list_objects(s3_client, s3_bucket, source_root + '/'):
+            sdir = obj['Key'][intBase:].split('/', 1)[0]
+            if '/' not in obj['Key'][intBase:]:
+                continue  # An object at the root, not in a dir
+
+            if sdir != sLastDir:
+                if sLastDir is not None:
+                    dSnapshot[sLastDir] = dir_digest.hexdigest()
+                sLastDir = sdir
+                dir_digest = hashlib.sha256()
+
+            dir_digest.update((obj['Key'] + '|' + str(obj.get('ETag')) + '|' + str(obj.get('LastModified')) + '|' + str(obj.get('Size')) + '\n').encode('utf-8'))
+
+        if sLastDir is not None:
+            dSnapshot[sLastDir] = dir_digest.hexdigest()
+
+    return dSnapshot
+
+def watch_run(setKnown):
+    # Runs until SIGTERM or SIGINT, returns 1 if any dir failed while it was watched
+    global walacor_NameHash_Index
+
+    evStop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda intSignal, frame: evStop.set())
+    signal.signal(signal.SIGINT, lambda intSignal, frame: evStop.set())
+
+    # Records change while we run, the prefetched ones would go stale
+    walacor_NameHash_Index = None
+
+    tree = None
+    if source_type == 1:
+        try:
+            tree = InotifyTree(source_root)
+            logger.warning('Watching with inotify - ' + source_root + ' - ' + str(len(tree.dPaths)) + ' dirs')
+        except OSError as e:
+            logger.error('inotify not available, scanning every ' + str(watch_interval) + 's instead - ' + str(e))
+
+    dSnapshot = None
+    fNextPoll = 0.0
+    if tree is None:
+        dSnapshot = watch_snapshot()
+        fNextPoll = time.monotonic() + watch_interval
+        logger.warning('Watching by polling every ' + str(watch_interval) + 's - ' + source_root + ' - ' + str(len(dSnapshot)) + ' dirs')
+
+    dDirty = {}  # dir -> (first change, last change)
+    intRet = 0
+
+    def mark(sdir):
+        if sdir and (shard_count <= 1 or shard_of(sdir, shard_count) == shard_index):
+            fNow = time.monotonic()
+            dDirty[sdir] = (dDirty.get(sdir, (fNow,))[0], fNow)
+            metrics_count('watch_changes_total')
+
+    try:
+        while not evStop.is_set():
+            if tree is not None:
+                for sPath in tree.read(1.0):
+                    if sPath is None:
+                        logger.warning('inotify events were lost, rehashing every dir')
+                        for sdir in setKnown | set(get_dir_list()):
+                            mark(sdir)
+                    else:
+                        mark(watch_top_dir(sPath))
+            else:
+                evStop.wait(max(0.0, min(1.0, fNextPoll - time.monotonic())))
+
+                if time.monotonic() >= fNextPoll:
+                    dNew = watch_snapshot()
+                    for sdir in set(dSnapshot) | set(dNew):
+                        if dSnapshot.get(sdir) != dNew.get(sdir):
+                            mark(sdir)
+                    dSnapshot = dNew
+                    fNextPoll = time.monotonic() + watch_interval
+
+            fNow = time.monotonic()
+            lReady = sorted(sdir for sdir, (fFirst, fLast) in dDirty.items() if fNow - fLast >= watch_debounce or fNow - fFirst >= watch_debounce * 10)
+
+            if lReady:
+                for sdir in lReady:
+                    del dDirty[sdir]
+
+                if watch_process(lReady, setKnown) != 0:
+                    intRet = 1
+    finally:
+        if tree is not None:
+            tree.close()
+
+    logger.warning('Watch stopped')
+    return intRet
+
+def watch_process(ldirs, setKnown):
+    # Rehashes the changed dirs and updates or validates their records, returns 1 if any failed
+    intRet = 0
+    lHash = []
+
+    for sdir in ldirs:
+        if dir_exists(sdir):
+            lHash.append(sdir)
+            setKnown.add(sdir)
+        elif sdir in setKnown:
+            setKnown.discard(sdir)
+            set_dir_context(sdir)
+            if prog_mode == 2:
+                logger.critical('Dir removed, Validation Failed - ' + sdir)
+                dir_done(sdir, hash_string(sdir), '', 1)
+                intRet = 1
+            else:
+                logger.warning('Dir removed - ' + sdir)
+            set_dir_context('')
+
+    if not lHash:
+        return intRet
+
+    logger.info('Changed dirs - ' + ', '.join(lHash))
+    metrics_count('watch_dirs_processed_total', len(lHash))
+
+    if prog_mode == 1:
+        for sdir, dir_hash, dir_contents_hash in hash_dirs(lHash, workers, [(hash_format, hash_algorithm)] * len(lHash)):
+            set_dir_context(sdir)
+            W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash, hash_format, hash_algorithm, manifest_store_dir(sdir))
+            dir_done(sdir, dir_hash, dir_contents_hash, 0)
+            set_dir_context('')
+
+    elif prog_mode == 2:
+        dRecords = {sdir: W_GetNameHash(hash_string(sdir)) for sdir in lHash}
+        lHash, lHashSpecs, lFailed = W_RecordHashSpecs(lHash, dRecords)
+
+        for sdir in lFailed:
+            dir_done(sdir, hash_string(sdir), '', 1)
+            intRet = 1
+
+        for sdir, dir_hash, dir_contents_hash in hash_dirs(lHash, workers, lHashSpecs):
+            set_dir_context(sdir)
+            intOutcome = W_ManageValidation(sdir, dir_hash, dir_contents_hash, dRecords[sdir])
+            dir_done(sdir, dir_hash, dir_contents_hash, intOutcome)
+            if intOutcome != 0:
+                intRet = 1
+            set_dir_context('')
+
+    W_WaitForWrites()
+
+    return intRet
+
+#endregion
+
+#region Checkpoint
+
+# A journal of the run in progress, so a restart does not start again from the first dir:
+#   Run - one row per run key, Finished is set when the run gets to its end
+#   DirDone - each dir whose outcome is known, and whose record (if any) Walacor has stored
+#   FileHash - tree format file hashes made by the run, so a big dir resumes at file granularity
+# The run key is everything that decides what a run hashes and checks, a run with
+# other parameters, or one after a finished run, starts a new journal.
+
+def checkpoint_make_run_key():
+    # The dirs a run does are part of it, a resumed run must pick the same ones
+    lParts = [prog_mode, source_type, source_root, s3_bucket, s3_endpoint, hash_format, hash_algorithm, shard_index, shard_count, focus_model, sample_window, sample_size]
+
+    if spool_path:
+        # Hashing into a spool is not the same run as hashing into Walacor
+        lParts.append('spool')
+    return hashlib.sha256(json.dumps(lParts).encode('utf-8')).hexdigest()
+
+def checkpoint_connect():
+    global checkpoint_conn, checkpoint_pid
+
+    # A connection is not carried over into a worker process
+    if checkpoint_conn is None or checkpoint_pid != os.getpid():
+        checkpoint_conn = sqlite3.connect(checkpoint_path, timeout=60, check_same_thread=False)
+        checkpoint_conn.execute('PRAGMA journal_mode=WAL')
+        checkpoint_conn.execute('CREATE TABLE IF NOT EXISTS Run (RunKey TEXT PRIMARY KEY, Started REAL, Finished REAL)')
+        checkpoint_conn.execute('CREATE TABLE IF NOT EXISTS DirDone (RunKey TEXT, Dir TEXT, NameHash TEXT, ContentsHash TEXT, Outcome INTEGER, Finished REAL, PRIMARY KEY (RunKey, Dir))')
+        checkpoint_conn.execute('CREATE TABLE IF NOT EXISTS FileHash (RunKey TEXT, CacheKey TEXT, FileHash BLOB NOT NULL, PRIMARY KEY (RunKey, CacheKey))')
+        checkpoint_conn.commit()
+        checkpoint_pid = os.getpid()
+
+    return checkpoint_conn
+
+def checkpoint_open():
+    # Returns {dir: outcome} of the dirs an unfinished run with the same key got through
+    with checkpoint_lock:
+        conn = checkpoint_connect()
+        row = conn.execute('SELECT Started, Finished FROM Run WHERE RunKey = ?', (checkpoint_run_key,)).fetchone()
+
+        if row is not None and row[1] is None:
+            dDone = dict(conn.execute('SELECT Dir, Outcome FROM DirDone WHERE RunKey = ?', (checkpoint_run_key,)))
+            logger.warning('Resuming run started ' + time.strftime('%Y%m%d - %H:%M:%S', time.localtime(row[0])) + ' - ' + str(len(dDone)) + ' dirs already done')
+            return dDone
+
+        conn.execute('DELETE FROM DirDone WHERE RunKey = ?', (checkpoint_run_key,))
+        conn.execute('DELETE FROM FileHash WHERE RunKey = ?', (checkpoint_run_key,))
+        conn.execute('INSERT OR REPLACE INTO Run (RunKey, Started, Finished) VALUES (?, ?, NULL)', (checkpoint_run_key, get_EpochTime()))
+        conn.commit()
+
+    return {}
+
+def checkpoint_finish():
+    # The run got to its end, the next one starts over
+    with checkpoint_lock:
+        conn = checkpoint_connect()
+        conn.execute('UPDATE Run SET Finished = ? WHERE RunKey = ?', (get_EpochTime(), checkpoint_run_key))
+        conn.execute('DELETE FROM FileHash WHERE RunKey = ?', (checkpoint_run_key,))
+        conn.commit()
+
+def checkpoint_dir_done(sdir, dir_hash, dir_contents_hash, intOutcome):
+    # A dir is only journaled once the record it queued (if any) has been stored,
+    # until then it waits in checkpoint_waiting
+    if not checkpoint_path:
+        return
+
+    with checkpoint_lock:
+        if sdir in checkpoint_in_flight:
+            checkpoint_waiting[sdir] = (dir_hash, dir_contents_hash, intOutcome)
+            return
+
+        checkpoint_write_dir(sdir, dir_hash, dir_contents_hash, intOutcome)
+
+def checkpoint_record_queued(sdir):
+    if checkpoint_path:
+        with checkpoint_lock:
+            checkpoint_in_flight[sdir] = checkpoint_in_flight.get(sdir, 0) + 1
+
+def checkpoint_records_sent(ldirs, bStored):
+    # A dir whose record was not stored is not journaled, a restart does it again
+    if not checkpoint_path:
+        return
+
+    with checkpoint_lock:
+        for sdir in ldirs:
+            checkpoint_in_flight[sdir] -= 1
+            if checkpoint_in_flight[sdir] > 0:
+                continue
+
+            del checkpoint_in_flight[sdir]
+            waiting = checkpoint_waiting.pop(sdir, None)
+
+            if waiting is not None and bStored:
+                checkpoint_write_dir(sdir, *waiting)
+
+def checkpoint_write_dir(sdir, dir_hash, dir_contents_hash, intOutcome):
+    # Called with checkpoint_lock held
+    conn = checkpoint_connect()
+    conn.execute('INSERT OR REPLACE INTO DirDone (RunKey, Dir, NameHash, ContentsHash, Outcome, Finished) VALUES (?, ?, ?, ?, ?, ?)',
+                 (checkpoint_run_key, sdir, dir_hash, dir_contents_hash, intOutcome, get_EpochTime()))
+    conn.commit()
+
+def checkpoint_get_file_hashes(lCacheKeys):
+    with checkpoint_lock:
+        return cache_select(checkpoint_connect(), 'SELECT CacheKey, FileHash FROM FileHash WHERE RunKey = ? AND CacheKey IN ', lCacheKeys, (checkpoint_run_key,))
+
+def checkpoint_put_file_hashes(lEntries):
+    if not checkpoint_path:
+        return
+
+    with checkpoint_lock:
+        conn = checkpoint_connect()
+        conn.executemany('INSERT OR REPLACE INTO FileHash (RunKey, CacheKey, FileHash) VALUES (?, ?, ?)',
+                         [(checkpoint_run_key, sCacheKey, file_hash) for sCacheKey, file_hash in lEntries])
+        conn.commit()
+
+#endregion
+
+#region Shards
+
+# The dirs under a root are split into shard_count disjoint shards by a stable hash of
+# the dir name, so N nodes can each take one.  Each run can write a result summary,
+# and the summaries of every shard merge into the overall pass/fail.
+
+def shard_of(sdir, intShardCount):
+    # sha256 rather than hash(), which is salted per process
+    return int(hashlib.sha256(sdir.encode('utf-8')).hexdigest()[:16], 16) % intShardCount
+
+def shard_filter(ldirs):
+    if shard_count <= 1:
+        return ldirs
+
+    lShard = [sdir for sdir in ldirs if shard_of(sdir, shard_count) == shard_index]
+    logger.info('Shard ' + str(shard_index) + ' of ' + str(shard_count) + ' - ' + str(len(lShard)) + ' of ' + str(len(ldirs)) + ' dirs')
+    return lShard
+
+def summary_build(intRet):
+    return {
+        'mode': prog_mode,
+        'source': source_type,
+        'root': source_root if not config_path else None,
+        'bucket': s3_bucket if source_type == 2 and not config_path else None,
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+        'started': run_started,
+        'finished': get_EpochTime(),
+        'exit_code': intRet,
+        'not_persisted': sorted(set(walacor_NotPersisted)),
+        'sample': sample_report,
+        'sources': config_report,
+        'dirs': run_results
+    }
+
+def summary_write(sPath, intRet):
+    metrics_write_file(sPath, json.dumps(summary_build(intRet), indent=2, sort_keys=True) + '\n')
+    logger.info('Summary written - ' + sPath)
+
+def summary_merge(lPaths):
+    # Returns (merged summary, exit code), 1 when a shard failed, is missing or twice, or the runs do not match
+    lSummaries = []
+
+    for sPath in lPaths:
+        with open(sPath) as file:
+            lSummaries.append(json.load(file))
+
+    intRet = 0
+    first = lSummaries[0]
+    merged = {
+        'mode': first['mode'],
+        'source': first['source'],
+        'root': first['root'],
+        'bucket': first['bucket'],
+        'shard_count': first['shard_count'],
+        'shards': [],
+        'not_persisted': [],
+        'dirs': {}
+    }
+
+    for sPath, summary in zip(lPaths, lSummaries):
+        for sKey in ('mode', 'source', 'root', 'bucket', 'shard_count'):
+            if summary[sKey] != first[sKey]:
+                logger.critical('Summary is from a different run, ' + sKey + ' is ' + str(summary[sKey]) + ' not ' + str(first[sKey]) + ' - ' + sPath)
+                intRet = 1
+
+        if summary['shard_index'] in [shard['shard_index'] for shard in merged['shards']]:
+            logger.critical('Shard ' + str(summary['shard_index']) + ' is there twice - ' + sPath)
+            intRet = 1
+
+        if summary['exit_code'] != 0:
+            logger.critical('Shard ' + str(summary['shard_index']) + ' failed - ' + sPath)
+            intRet = 1
+
+        merged['shards'].append({'shard_index': summary['shard_index'], 'exit_code': summary['exit_code'], 'path': sPath})
+        merged['not_persisted'].extend(summary['not_persisted'])
+        merged['dirs'].update(summary['dirs'])
+
+    lMissing = sorted(set(range(first['shard_count'])) - set(shard['shard_index'] for shard in merged['shards']))
+    if lMissing:
+        logger.critical('Shards missing - ' + ', '.join(str(intShard) for intShard in lMissing))
+        intRet = 1
+
+    lFailed = sorted(sdir for sdir, result in merged['dirs'].items() if result['outcome'] != 0)
+    if lFailed:
+        logger.critical('Dirs failed - ' + ', '.join(lFailed))
+
+    merged['exit_code'] = intRet
+    logger.warning('Merged ' + str(len(lSummaries)) + ' of ' + str(first['shard_count']) + ' shards - ' + str(len(merged['dirs'])) + ' dirs, ' + str(len(lFailed)) + ' failed - ' + ('passed' if intRet == 0 else 'failed'))
+
+    return merged, intRet
+
+#endregion
+
+#region Spool
+
+# With --spool modes 1 and 2 only hash: nothing is sent to Walacor, each dir's result goes
+# in a spool file instead, and mode 4 later publishes (a mode 1 spool) or verifies (a mode 2
+# spool) it wherever Walacor can be reached.  A spool is JSON lines, written as dirs finish:
+#   a header - the run (mode, source, root, bucket, hash format and algorithm, shard, host)
+#   a line per dir - name hash, contents hash, format, algorithm, trust, when hashed, seconds, bytes
+#   an end line - the number of dirs, a spool without it was cut short
+# Each line has an HMAC-SHA256, with the --spool-key, over the line and the MAC before it,
+# so a line that is changed, dropped or moved fails the lines after it.
+
+def spool_load_key():
+    if not spool_key_path:
+        raise ValueError('A spool is signed, --spool-key is needed')
+
+    with open(spool_key_path, 'rb') as file:
+        bKey = file.read().strip()
+
+    if len(bKey) < 16:
+        raise ValueError('Spool key is too short, 16 bytes at least - ' + spool_key_path)
+
+    return bKey
+
+def spool_mac(sLastMac, record):
+    bLine = json.dumps(record, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hmac.new(spool_key, sLastMac.encode('ascii') + bLine, hashlib.sha256).hexdigest()
+
+def spool_read(sPath):
+    # Yields (record, offset after it, its MAC) for every line, in order.
+    # Raises ValueError at the first line that is cut short or does not check out
+    sLastMac = ''
+    intOffset = 0
+    intLine = 0
+
+    with open(sPath, 'rb') as file:
+        for bLine in file:
+            intLine += 1
+
+            if not bLine.endswith(b'\n'):
+                raise ValueError('Spool line ' + str(intLine) + ' is cut short - ' + sPath)
+
+            record = json.loads(bLine)
+            sMac = record.pop('mac', '')
+
+            if not hmac.compare_digest(sMac, spool_mac(sLastMac, record)):
+                raise ValueError('Spool line ' + str(intLine) + ' does not match its signature - ' + sPath)
+
+            intOffset += len(bLine)
+            sLastMac = sMac
+            yield record, intOffset, sMac
+
+def spool_write(record):
+    global spool_last_mac
+
+    sMac = spool_mac(spool_last_mac, record)
+    spool_file.write((json.dumps(dict(record, mac=sMac), sort_keys=True) + '\n').encode('utf-8'))
+    spool_file.flush()
+    spool_last_mac = sMac
+
+def spool_open(bResume):
+    # A run resumed from its checkpoint carries on the spool it was writing,
+    # past its last good line.  Any other run starts a new spool
+    global spool_file, spool_last_mac, spool_count
+
+    sRunKey = checkpoint_make_run_key()
+
+    if bResume:
+        if not os.path.exists(spool_path):
+            raise ValueError('Spool of the resumed run is not there, dirs done before the restart would be missing - ' + spool_path)
+
+        intKeep = 0
+        try:
+            for record, intOffset, sMac in spool_read(spool_path):
+                if record['type'] == 'header' and record['run_key'] != sRunKey:
+                    raise ValueError('Spool is from another run - ' + spool_path)
+                if record['type'] == 'end':
+                    break
+
+                intKeep = intOffset
+                spool_last_mac = sMac
+                spool_count += record['type'] == 'dir'
+        except ValueError as e:
+            if intKeep == 0 or 'another run' in str(e):
+                raise
+            # Cut short when the run stopped, the good lines are kept
+            logger.warning(str(e) + ', carrying on from the line before')
+
+        spool_file = open(spool_path, 'r+b')
+        spool_file.truncate(intKeep)
+        spool_file.seek(intKeep)
+        logger.info('Spool resumed - ' + spool_path + ' - ' + str(spool_count) + ' dirs')
+        return
+
+    spool_file = open(spool_path, 'wb')
+    spool_write({
+        'type': 'header',
+        'version': 1,
+        'run_key': sRunKey,
+        'mode': prog_mode,
+        'source': source_type,
+        'root': source_root,
+        'bucket': s3_bucket if source_type == 2 else None,
+        'hash_format': hash_format,
+        'hash_algorithm': hash_algorithm,
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+        'host': socket.gethostname(),
+        'started': run_started
+    })
+
+def spool_write_dir(sdir, dir_hash, dir_contents_hash, sManifestHash):
+    global spool_count
+
+    spool_write({
+        'type': 'dir',
+        'dir': sdir,
+        'name_hash': dir_hash,
+        'contents_hash': dir_contents_hash,
+        'hash_format': hash_format,
+        'hash_algorithm': hash_algorithm,
+        'manifest_hash': sManifestHash,
+        'trust': dir_trust.get(sdir, 'bytes'),
+        'hashed': get_EpochTime(),
+        'seconds': metrics_dir_total(sdir, 'dir_hash_seconds'),
+        'bytes': metrics_dir_total(sdir, 'fs_read_bytes_total') + metrics_dir_total(sdir, 's3_get_bytes_total')
+    })
+    spool_count += 1
+
+def spool_close():
+    spool_write({'type': 'end', 'dirs': spool_count, 'finished': get_EpochTime()})
+    spool_file.close()
+    logger.info('Spool written - ' + spool_path + ' - ' + str(spool_count) + ' dirs')
+
+def spool_apply(sPath):
+    # Mode 4, returns 1 if the spool does not check out or a dir failed.
+    # Records are queued as the spool is read, so it is never all in memory
+    intRet = 0
+    header = None
+    intDirs = 0
+    bEnd = False
+
+    try:
+        for record, intOffset, sMac in spool_read(sPath):
+            if record['type'] == 'header':
+                header = record
+                logger.info('Spool - mode ' + str(header['mode']) + ' - ' + str(header['root']) + ' - hashed on ' + header['host'])
+            elif header is None or bEnd:
+                raise ValueError('Spool is out of order - ' + sPath)
+            elif record['type'] == 'end':
+                if record['dirs'] != intDirs:
+                    raise ValueError('Spool end has ' + str(record['dirs']) + ' dirs, ' + str(intDirs) + ' were read - ' + sPath)
+                bEnd = True
+            else:
+                intDirs += 1
+                if spool_apply_dir(header['mode'], record) != 0:
+                    intRet = 1
+    except (OSError, ValueError, KeyError) as e:
+        logger.critical('Spool not applied past here - ' + str(e))
+        return 1
+
+    if not bEnd:
+        # The dirs that are there were applied, the rest never got to the spool
+        logger.critical('Spool has no end, the run that wrote it did not finish - ' + sPath)
+        return 1
+
+    return intRet
+
+def spool_apply_dir(intMode, entry):
+    sdir = entry['dir']
+    set_dir_context(sdir)
+
+    try:
+        if intMode == 1:
+            W_ManageDirHashRecord(sdir, entry['name_hash'], entry['contents_hash'], entry['hash_format'], entry['hash_algorithm'], entry['manifest_hash'], entry['hashed'])
+            intOutcome = 0
+        else:
+            sNameHashRecord = W_GetNameHash(entry['name_hash'])
+            spec = (entry['hash_format'], entry['hash_algorithm'])
+
+            if sNameHashRecord and W_RecordHashSpec(sNameHashRecord) != spec:
+                # A hash in another format or algorithm says nothing about this record
+                logger.critical('Spool hash is ' + W_HashSpecName(*spec) + ', record is ' + W_HashSpecName(*W_RecordHashSpec(sNameHashRecord)) + ', Validation Failed - ' + sdir)
+                intOutcome = 1
+            else:
+                if entry['manifest_hash'] and manifest_store:
+                    # The manifest this dir had when it was hashed, to name the changed files
+                    dir_manifests[sdir] = manifest_get(entry['manifest_hash'])
+                    if dir_manifests[sdir] is None:
+                        del dir_manifests[sdir]
+
+                intOutcome = W_ManageValidation(sdir, entry['name_hash'], entry['contents_hash'], sNameHashRecord, entry['hashed'])
+
+        dir_trust[sdir] = entry.get('trust', 'bytes')  # Spools from before trust was kept
+        dir_done(sdir, entry['name_hash'], entry['contents_hash'], intOutcome)
+    finally:
+        set_dir_context('')
+
+    return intOutcome
+
+#endregion
+
+#region Metrics
+
+# Counters and histograms, each series is keyed by (dir, name, labels).
+# The dir is the one the thread is working on (dir_context), '' is the run itself,
+# the run totals are the sum over every dir.  Histograms ending in _bytes use byte
+# buckets, the others are durations in seconds.
+
+def metrics_key(sName, dLabels):
+    return (getattr(dir_context, 'sdir', ''), sName, tuple(sorted(dLabels.items())))
+
+def metrics_count(sName, value=1, **labels):
+    key = metrics_key(sName, labels)
+
+    with metrics_lock:
+        metrics_counters[key] = metrics_counters.get(key, 0) + value
+
+def metrics_observe(sName, value, **labels):
+    lBuckets = METRICS_BYTE_BUCKETS if sName.endswith('_bytes') else METRICS_TIME_BUCKETS
+    key = metrics_key(sName, labels)
+    intBucket = bisect.bisect_left(lBuckets, value)
+
+    with metrics_lock:
+        histogram = metrics_histograms.get(key)
+        if histogram is None:
+            # count, sum, count per bucket (the last one is +Inf)
+            histogram = metrics_histograms[key] = [0, 0, [0] * (len(lBuckets) + 1)]
+
+        histogram[0] += 1
+        histogram[1] += value
+        histogram[2][intBucket] += 1
+
+@contextlib.contextmanager
+def metrics_timer(sName, **labels):
+    fStart = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        metrics_observe(sName, time.perf_counter() - fStart, **labels)
+
+def metrics_take_dir(sdir):
+    # Removes and returns the series of one dir, so a worker process can hand them back
+    with metrics_lock:
+        lCounters = [(key, value) for key, value in metrics_counters.items() if key[0] == sdir]
+        lHistograms = [(key, value) for key, value in metrics_histograms.items() if key[0] == sdir]
+
+        for key, value in lCounters:
+            del metrics_counters[key]
+        for key, value in lHistograms:
+            del metrics_histograms[key]
+
+    return lCounters, lHistograms
+
+def metrics_merge(taken):
+    lCounters, lHistograms = taken
+
+    with metrics_lock:
+        for key, value in lCounters:
+            metrics_counters[key] = metrics_counters.get(key, 0) + value
+
+        for key, (intCount, fSum, lBucketCounts) in lHistograms:
+            histogram = metrics_histograms.setdefault(key, [0, 0, [0] * len(lBucketCounts)])
+            histogram[0] += intCount
+            histogram[1] += fSum
+            histogram[2] = [a + b for a, b in zip(histogram[2], lBucketCounts)]
+
+def metrics_dir_total(sdir, sName):
+    # A dir's counter, or the sum of its histogram, over every label
+    with metrics_lock:
+        value = sum(value for key, value in metrics_counters.items() if key[0] == sdir and key[1] == sName)
+        value += sum(histogram[1] for key, histogram in metrics_histograms.items() if key[0] == sdir and key[1] == sName)
+
+    return value
+
+def metrics_series_name(sName, labels):
+    if not labels:
+        return sName
+
+    return sName + '{' + ','.join(sLabel + '="' + metrics_escape(sValue) + '"' for sLabel, sValue in labels) + '}'
+
+def metrics_escape(sValue):
+    return str(sValue).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def metrics_run_totals():
+    # Every series summed over the dirs
+    dCounters = {}
+    dHistograms = {}
+
+    with metrics_lock:
+        for (sdir, sName, labels), value in metrics_counters.items():
+            dCounters[(sName, labels)] = dCounters.get((sName, labels), 0) + value
+
+        for (sdir, sName, labels), (intCount, fSum, lBucketCounts) in metrics_histograms.items():
+            histogram = dHistograms.setdefault((sName, labels), [0, 0, [0] * len(lBucketCounts)])
+            histogram[0] += intCount
+            histogram[1] += fSum
+            histogram[2] = [a + b for a, b in zip(histogram[2], lBucketCounts)]
+
+    return dCounters, dHistograms
+
+def metrics_buckets(sName, lBucketCounts):
+    # Cumulative counts per upper bound, as Prometheus has them
+    lBuckets = METRICS_BYTE_BUCKETS if sName.endswith('_bytes') else METRICS_TIME_BUCKETS
+    return list(zip([str(bound) for bound in lBuckets] + ['+Inf'], itertools.accumulate(lBucketCounts)))
+
+def metrics_summary(intRet):
+    dCounters, dHistograms = metrics_run_totals()
+
+    summary = {
+        'mode': prog_mode,
+        'source': source_type,
+        'root': source_root,
+        'started': run_started,
+        'wall_s': round(get_EpochTime() - run_started, 4),
+        'exit_code': intRet,
+        'run': {
+            'counters': {metrics_series_name(sName, labels): value for (sName, labels), value in sorted(dCounters.items())},
+            'histograms': {metrics_series_name(sName, labels): {'count': intCount, 'sum': round(fSum, 6), 'buckets': dict(metrics_buckets(sName, lBucketCounts))}
+                           for (sName, labels), (intCount, fSum, lBucketCounts) in sorted(dHistograms.items())}
+        },
+        'dirs': {}
+    }
+
+    # Per dir only the totals, the buckets are in the run histograms
+    with metrics_lock:
+        for (sdir, sName, labels), value in sorted(metrics_counters.items()):
+            if sdir:
+                summary['dirs'].setdefault(sdir, {'counters': {}, 'histograms': {}})['counters'][metrics_series_name(sName, labels)] = value
+
+        for (sdir, sName, labels), (intCount, fSum, lBucketCounts) in sorted(metrics_histograms.items()):
+            if sdir:
+                summary['dirs'].setdefault(sdir, {'counters': {}, 'histograms': {}})['histograms'][metrics_series_name(sName, labels)] = {'count': intCount, 'sum': round(fSum, 6)}
+
+    if tracemalloc.is_tracing():
+        intCurrent, intPeak = tracemalloc.get_traced_memory()
+        summary['tracemalloc'] = {
+            'current_bytes': intCurrent,
+            'peak_bytes': intPeak,
+            'top': [{'site': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                    for stat in tracemalloc.take_snapshot().statistics('lineno')[:20]]
+        }
+
+    return summary
+
+def metrics_prometheus(summary):
+    # Text exposition format, for the node_exporter textfile collector
+    dCounters, dHistograms = metrics_run_totals()
+    lLines = []
+
+    lLines.append('# TYPE objectvalidator_run_wall_seconds gauge')
+    lLines.append(metrics_series_name('objectvalidator_run_wall_seconds', (('mode', summary['mode']),)) + ' ' + str(summary['wall_s']))
+    lLines.append('# TYPE objectvalidator_run_exit_code gauge')
+    lLines.append(metrics_series_name('objectvalidator_run_exit_code', (('mode', summary['mode']),)) + ' ' + str(summary['exit_code']))
+    lLines.append('# TYPE objectvalidator_run_finished_timestamp_seconds gauge')
+    lLines.append(metrics_series_name('objectvalidator_run_finished_timestamp_seconds', (('mode', summary['mode']),)) + ' ' + str(round(get_EpochTime(), 3)))
+
+    # Counters for the whole run, one series per dir only with --metrics-prom-dirs,
+    # a tree of many dirs would make too many series.  The JSON summary has them per dir
+    dByName = {}
+    if metrics_prom_dirs:
+        with metrics_lock:
+            for (sdir, sName, labels), value in metrics_counters.items():
+                lDirLabel = (('dir', sdir),) if sdir else ()
+                dByName.setdefault(sName, []).append((lDirLabel + labels, value))
+    else:
+        for (sName, labels), value in dCounters.items():
+            dByName.setdefault(sName, []).append((labels, value))
+
+    for sName in sorted(dByName):
+        lLines.append('# TYPE objectvalidator_' + sName + ' counter')
+        for labels, value in sorted(dByName[sName]):
+            lLines.append(metrics_series_name('objectvalidator_' + sName, labels) + ' ' + str(value))
+
+    # Histograms for the whole run
+    sLastName = None
+    for (sName, labels), (intCount, fSum, lBucketCounts) in sorted(dHistograms.items()):
+        if sName != sLastName:
+            lLines.append('# TYPE objectvalidator_' + sName + ' histogram')
+            sLastName = sName
+
+        for sBound, intCumulative in metrics_buckets(sName, lBucketCounts):
+            lLines.append(metrics_series_name('objectvalidator_' + sName + '_bucket', labels + (('le', sBound),)) + ' ' + str(intCumulative))
+        lLines.append(metrics_series_name('objectvalidator_' + sName + '_sum', labels) + ' ' + str(round(fSum, 6)))
+        lLines.append(metrics_series_name('objectvalidator_' + sName + '_count', labels) + ' ' + str(intCount))
+
+    return '\n'.join(lLines) + '\n'
+
+def metrics_write_file(sPath, sText):
+    # Written to a temp file and renamed, so a collector never reads half a file
+    sTemp = sPath + '.tmp'
+
+    with open(sTemp, 'w') as file:
+        file.write(sText)
+
+    os.replace(sTemp, sPath)
+
+def run_finish(intRet):
+    # Writes the metrics and profiles asked for, then exits with intRet
+    if checkpoint_path:
+        checkpoint_finish()
+
+    if summary_path:
+        summary_write(summary_path, intRet)
+
+    if run_profiler is not None:
+        run_profiler.disable()
+        run_profiler.dump_stats(profile_path)
+        logger.info('Profile written - ' + profile_path)
+
+    if metrics_json_path or metrics_prom_path or tracemalloc.is_tracing():
+        summary = metrics_summary(intRet)
+
+        if 'tracemalloc' in summary:
+            logger.info('Peak traced memory - ' + str(summary['tracemalloc']['peak_bytes']))
+
+        if metrics_json_path:
+            metrics_write_file(metrics_json_path, json.dumps(summary, indent=2) + '\n')
+            logger.info('Metrics written - ' + metrics_json_path)
+
+        if metrics_prom_path:
+            metrics_write_file(metrics_prom_path, metrics_prometheus(summary))
+            logger.info('Metrics written - ' + metrics_prom_path)
+
+    sys.exit(intRet)
+
+#endregion
+
+#region Utility
+
+def split_argv():
+    # Options are --name or --name=value.  A literal -- ends them, everything after it
+    # is positional, so a parameter that starts with -- (a password) can still be given
+    lOptions = []
+    lParms = sys.argv[:1]
+
+    for intPos, arg in enumerate(sys.argv[1:], 1):
+        if arg == '--':
+            lParms.extend(sys.argv[intPos + 1:])
+            break
+
+        if arg.startswith('--'):
+            lOptions.append(arg)
+        else:
+            lParms.append(arg)
+
+    return lOptions, lParms
+
+def get_parameter(intParmPos):
+    # Options (--name=value) are not counted as positional parameters
+    lParms = split_argv()[1]
+
+    if (len(lParms) - 1) < intParmPos or lParms[intParmPos] is None:
+        return None  # Return None if the parameter is not provided
+    else:
+        return lParms[intParmPos]  # Return the parameter if it exists
+
+def get_option(strName, default=None):
+    strOption = '--' + strName
+
+    for arg in split_argv()[0]:
+        if arg == strOption:
+            return True  # A bare option is a switch
+        if arg.startswith(strOption + '='):
+            return arg[len(strOption) + 1:]
+
+    return default
+
+def yenc_encode(string):
+    encoded = bytearray()
+    for char in string:
+        encoded.append((ord(char) + 42) % 256)
+    return encoded
+
+def yenc_decode(encoded):
+    decoded = ""
+    for byte in encoded:
+        decoded += chr((byte - 42) % 256)
+    return decoded
+
+class DirContextFilter(logging.Filter):
+    # Tags each log record with the directory the current thread/process is working on
+    def filter(self, record):
+        sdir = getattr(dir_context, 'sdir', '')
+        record.dirtag = '[' + sdir + '] ' if sdir else ''
+        return True
+
+def set_dir_context(sdir):
+    dir_context.sdir = sdir
+
+def bind_dir_context(fn):
+    # Work handed to another thread still logs, and is measured, as the dir that handed it over
+    sdir = getattr(dir_context, 'sdir', '')
+
+    def bound(*args):
+        set_dir_context(sdir)
+        try:
+            return fn(*args)
+        finally:
+            set_dir_context('')
+
+    return bound
+
+def setup_logger(log_file, log_level):
+    intLogLevel = int(log_level)
+
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(intLogLevel)
+
+    # Setup can run again in a worker process, do not double up the handlers
+    logger.handlers.clear()
+    logger.filters.clear()
+    logger.addFilter(DirContextFilter())
+
+    # Create file handler
+    if log_file != '':
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setLevel(intLogLevel)
+
+    # Create console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(intLogLevel)
+
+    # Create formatter
+    formatter = logging.Formatter('%(asctime)s.%(msecs)03d - %(levelname)s - %(dirtag)s%(message)s', '%Y%m%d - %H:%M:%S')
+
+    # Add formatter to handlers
+    if log_file != '':
+        file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+
+    # Add handlers to the logger
+    if log_file != '':
+        logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+
+    return logger
+
+def batched(iterable, intSize):
+    # Yields lists of up to intSize items
+    lBatch = []
+
+    for item in iterable:
+        lBatch.append(item)
+
+        if len(lBatch) >= intSize:
+            yield lBatch
+            lBatch = []
+
+    if lBatch:
+        yield lBatch
+
+def get_EpochTime():
+    return time.time()
+
+def new_hash(sHashAlgorithm='sha256'):
+    # Contents hash algorithms, all give an object with update/digest/hexdigest
+    if sHashAlgorithm == 'sha256':
+        return hashlib.sha256()
+    elif sHashAlgorithm == 'sha512_256':
+        return hashlib.new('sha512_256')
+    elif sHashAlgorithm == 'blake2b':
+        return hashlib.blake2b()
+    elif sHashAlgorithm == 'blake3':
+        if blake3 is None:
+            raise ValueError('Hash algorithm blake3 needs the blake3 package (pip install blake3)')
+        return blake3.blake3(max_threads=blake3.blake3.AUTO)
+
+    raise ValueError('Unknown hash algorithm - ' + str(sHashAlgorithm))
+
+def hash_string(strIn):
+    # The name hash is the key records are found by, it stays sha256 whatever the contents algorithm
+    sha2_dir_hash = hashlib.sha256()
+    sha2_dir_hash.update(yenc_encode(strIn))
+    return sha2_dir_hash.hexdigest()
+
+#endregion
+
+#region Processing
+
+def get_dir_list():
+    if focus_model:
+        return focus_dir_list(focus_model, focus_missing)
+
+    if source_type == 1:
+        # local file system, every dir under the root
+        return [d for d in os.listdir(source_root) if os.path.isdir(os.path.join(source_root, d))]
+    elif source_type == 2:
+        # s3 source, every prefix under the root
+        return s3_list_directories(s3_client, s3_bucket, source_root)
+
+    return []
+
+def focus_dir_list(sFocus, lMissing):
+    # The dirs named by sFocus (parameter 9), names or glob patterns separated by commas,
+    # the ones that find nothing go in lMissing. Names are looked for on their own and
+    # patterns only list the dirs that start with their literal start, the root is never listed in full
+    ldirs = []
+    focus_check(sFocus)
+
+    for sName in sFocus.split(','):
+        sName = sName.strip().strip('/')
+        if not sName:
+            continue
+
+        if not any(sChar in sName for sChar in '*?['):
+            lFound = [sName] if dir_exists(sName) else []
+        elif source_type == 1:
+            lFound = sorted(d for d in os.listdir(source_root) if fnmatch.fnmatchcase(d, sName) and os.path.isdir(os.path.join(source_root, d)))
+        else:
+            sLiteral = re.split(r'[*?\[]', sName, maxsplit=1)[0]
+            lFound = sorted(d for d in s3_list_directories(s3_client, s3_bucket, source_root, sLiteral) if fnmatch.fnmatchcase(d, sName))
+
+        if not lFound:
+            # A gate asked about this one, not finding it is a failure
+            logger.critical('Dir not found - ' + sName)
+            lMissing.append(sName)
+
+        ldirs.extend(sdir for sdir in lFound if sdir not in ldirs)
+
+    logger.info('Focus - ' + str(len(ldirs)) + ' dirs - ' + sFocus)
+    return ldirs
+
+def focus_check(sFocus):
+    # Raises ValueError for a name or pattern of sFocus that is not one dir of the root,
+    # .. or a/b would reach past it, and so would a local link to somewhere else
+    for sName in sFocus.split(','):
+        sName = sName.strip().strip('/')
+        if not sName:
+            continue
+
+        if sName in ('.', '..') or any(sChar in sName for sChar in '/\\\0'):
+            raise ValueError('Dirs are names of dirs in the root, not paths - ' + sName)
+
+        if source_type == 1:
+            sRoot = os.path.realpath(source_root)
+            if os.path.commonpath([sRoot, os.path.realpath(os.path.join(sRoot, sName))]) != sRoot:
+                raise ValueError('Dir is outside the root - ' + sName)
+
+def dir_exists(sdir):
+    if source_type == 1:
+        return os.path.isdir(os.path.join(source_root, sdir))
+
+    return next(s3_list_objects(s3_client, s3_bucket, source_root + '/' + sdir + '/'), None) is not None
+
+class RunState:
+    # What a pass learns about its dirs as it goes. The command line run uses run_state,
+    # each library call and service job has its own, so passes running at once keep apart
+    def __init__(self):
+        self.results = {}         # dir -> outcome and contents hash, as --summary has them
+        self.trust = {}           # dir -> what a format 3 contents hash was made from
+        self.manifests = {}       # dir -> manifest made this pass, until stored or compared
+        self.changes = {}         # dir -> files changed, when a failed dir's manifest was compared
+        self.not_persisted = []   # dirs whose records Walacor did not store
+
+def dir_done(sdir, dir_hash, dir_contents_hash, intOutcome, state=None):
+    # The outcome of a dir, 0 is passed, goes in the summary and the checkpoint journal
+    state = state or run_state
+    result = {'outcome': intOutcome, 'contents_hash': dir_contents_hash}
+
+    if dir_contents_hash:
+        # What the hash was made from, only format 3 takes anything on trust
+        result['trust'] = state.trust.pop(sdir, 'bytes')
+
+    # The changed files, when a failed dir's manifest could be compared
+    if sdir in state.changes:
+        result['changes'] = state.changes.pop(sdir)
+    state.manifests.pop(sdir, None)
+
+    state.results[sdir] = result
+    checkpoint_dir_done(sdir, dir_hash, dir_contents_hash, intOutcome)
+
+    return result
+
+def sample_dirs(ldirs, dRecords):
+    # The dirs this run validates, so each is validated at least once every sample_window days.
+    # Dirs never verified (or without a record) go first, then the longest since verified,
+    # ties are broken by the name hash so every run picks the same. A picked dir is read in full,
+    # files are not sampled even with --manifest-store
+    global sample_report
+
+    fNow = get_EpochTime()
+    fWindow = sample_window * 86400
+
+    def last_verified(sdir):
+        return W_RecordEpoch(dRecords[sdir].get('LastVerification')) if dRecords[sdir] else 0.0
+
+    lOrder = sorted(ldirs, key=lambda sdir: (last_verified(sdir), hash_string(sdir)))
+    intDue = len([sdir for sdir in lOrder if fNow - last_verified(sdir) >= fWindow])
+    intSize = sample_size or -(-len(ldirs) // max(1, int(sample_window)))
+    setSample = set(lOrder[:max(intDue, intSize)])
+
+    fOldest = fNow - last_verified(lOrder[0]) if lOrder else 0.0
+    sample_report = {
+        'window_days': sample_window,
+        'dirs': len(ldirs),
+        'sampled': len(setSample),
+        'due': intDue,
+        'oldest_days': None if lOrder and not last_verified(lOrder[0]) else round(fOldest / 86400, 2)
+    }
+
+    logger.warning('Sample - ' + str(len(setSample)) + ' of ' + str(len(ldirs)) + ' dirs, ' + str(intDue) + ' not verified in ' + str(sample_window) + ' days')
+    metrics_count('sample_dirs_due_total', intDue)
+    metrics_count('sample_dirs_skipped_total', len(ldirs) - len(setSample))
+
+    if intDue > intSize:
+        logger.warning('Sample - more dirs are due than --sample-size, raise it or run more often to keep to the window')
+
+    return [sdir for sdir in ldirs if sdir in setSample]
+
+def sample_coverage(ldirs, dRecords):
+    # Share of the dirs verified within the window once this run is done, and the ones that are not
+    fNow = get_EpochTime()
+    fWindow = sample_window * 86400
+    lStale = []
+
+    for sdir in ldirs:
+        if sdir in run_results:
+            if run_results[sdir]['outcome'] != 0 or sdir in walacor_NotPersisted:
+                lStale.append(sdir)
+        elif not dRecords[sdir] or fNow - W_RecordEpoch(dRecords[sdir].get('LastVerification')) >= fWindow:
+            lStale.append(sdir)
+
+    fCoverage = 1.0 if not ldirs else (len(ldirs) - len(lStale)) / len(ldirs)
+    sample_report['coverage'] = round(fCoverage, 4)
+    sample_report['not_covered'] = sorted(lStale)
+
+    logger.warning('Sample - ' + str(round(fCoverage * 100, 2)) + '% of dirs verified in the last ' + str(sample_window) + ' days')
+
+def hash_dir(sdir, intHashFormat=1, sHashAlgorithm='sha256', state=None):
+    state = state or run_state
+    set_dir_context(sdir)
+
+    try:
+        logger.info('Starting - ' + sdir)
+        dir_hash = hash_string(sdir)
+
+        logger.info('Dir Hash - ' + sdir + ' - ' + dir_hash)
+
+        # Hash the dir contents
+        dir_contents_hash = ''
+        lManifest = [] if manifest_store else None
+        with metrics_timer('dir_hash_seconds'):
+            if intHashFormat == HASH_FORMAT_CHECKSUM and source_type != 2:
+                raise ValueError('Hash format 3 is made from S3 checksums, it is for S3 only')
+
+            if source_type == 1:
+                dir_contents_hash = fs_hash_files_in_dir(source_root + '/' + sdir, intHashFormat, sHashAlgorithm, lManifest)
+            elif intHashFormat == HASH_FORMAT_CHECKSUM:
+                dir_contents_hash, state.trust[sdir] = checksum_hash_dir_contents(s3_client, s3_bucket, [source_root + '/' + sdir], sHashAlgorithm, lManifest)
+            elif source_type == 2:
+                dir_contents_hash = s3_hash_dir_contents(s3_client, s3_bucket, [source_root + '/' + sdir], intHashFormat, sHashAlgorithm, lManifest)
+
+        if lManifest is not None:
+            # Picked up by the main thread, to store or to compare
+            state.manifests[sdir] = manifest_build(lManifest, intHashFormat, sHashAlgorithm)
+
+        metrics_count('dirs_hashed_total')
+
+        logger.info('Dir Contents Hash - ' + sdir + ' - ' + dir_contents_hash)
+    finally:
+        set_dir_context('')
+
+    return sdir, dir_hash, dir_contents_hash
+
+def hash_dir_pool_init(settings):
+    # Runs once in each worker process, globals from __main__ are not there under spawn
+    global source_type, source_root, file_workers, hash_cache_path, hash_cache_paranoid, logger
+    global fs_read_buffer, fs_read_ahead, fs_drop_cache, fs_scan_workers, checkpoint_path, checkpoint_run_key, manifest_store
+
+    source_type = settings['source_type']
+    source_root = settings['source_root']
+    file_workers = settings['file_workers']
+    hash_cache_path = settings['hash_cache_path']
+    hash_cache_paranoid = settings['hash_cache_paranoid']
+    fs_read_buffer = settings['fs_read_buffer']
+    fs_read_ahead = settings['fs_read_ahead']
+    fs_drop_cache = settings['fs_drop_cache']
+    fs_scan_workers = settings['fs_scan_workers']
+    checkpoint_path = settings['checkpoint_path']
+    checkpoint_run_key = settings['checkpoint_run_key']
+    manifest_store = settings['manifest_store']
+    logger = setup_logger(settings['log_filename'], settings['log_level'])
+
+def hash_dir_process(sdir, intHashFormat, sHashAlgorithm):
+    # Runs in a worker process, the dir's metrics and manifest go back with its hashes
+    result = hash_dir(sdir, intHashFormat, sHashAlgorithm)
+    return result, metrics_take_dir(sdir), dir_manifests.pop(sdir, None)
+
+def hash_dirs(ldirs, intWorkers, lHashSpecs, state=None):
+    # Yields (sdir, dir_hash, dir_contents_hash) in the same order as ldirs,
+    # lHashSpecs holds the (hash format, hash algorithm) to use for each dir
+    state = state or run_state
+    lHashFormats = [spec[0] for spec in lHashSpecs]
+    lHashAlgorithms = [spec[1] for spec in lHashSpecs]
+
+    if intWorkers <= 1 or len(ldirs) <= 1:
+        for sdir, intHashFormat, sHashAlgorithm in zip(ldirs, lHashFormats, lHashAlgorithms):
+            yield hash_dir(sdir, intHashFormat, sHashAlgorithm, state)
+        return
+
+    if source_type == 1:
+        # Local hashing is CPU bound, use processes to get past the GIL
+        settings = {
+            'source_type': source_type,
+            'source_root': source_root,
+            'file_workers': file_workers,
+            'hash_cache_path': hash_cache_path,
+            'hash_cache_paranoid': hash_cache_paranoid,
+            'fs_read_buffer': fs_read_buffer,
+            'fs_read_ahead': fs_read_ahead,
+            'fs_drop_cache': fs_drop_cache,
+            'fs_scan_workers': fs_scan_workers,
+            'checkpoint_path': checkpoint_path,
+            'checkpoint_run_key': checkpoint_run_key,
+            'manifest_store': manifest_store,
+            'log_filename': log_filename,
+            'log_level': log_level
+        }
+        # Spawned, not forked: a fork of this threaded process (the service, the Walacor writer)
+        # could copy a lock some other thread holds, and hang on it.  The settings are all a child needs
+        mp_context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=intWorkers, mp_context=mp_context, initializer=pool_module.hash_dir_pool_init, initargs=(settings,)) as executor:
+            for result, taken, bManifest in executor.map(pool_module.hash_dir_process, ldirs, lHashFormats, lHashAlgorithms):
+                metrics_merge(taken)
+                if bManifest is not None:
+                    state.manifests[result[0]] = bManifest
+                yield result
+        return
+
+    # S3 hashing waits on the network, threads share the one (thread safe) client
+    with concurrent.futures.ThreadPoolExecutor(max_workers=intWorkers) as executor:
+        yield from executor.map(hash_dir, ldirs, lHashFormats, lHashAlgorithms, itertools.repeat(state))
+
+#endregion
+
+#region Library
+
+# The validator for use from another program. The module keeps its state in globals, so
+# each ObjectValidator runs in a copy of the module of its own: its settings, S3 client,
+# Walacor session and token, schema check and per-file hash cache are not another's, and
+# stay warm from one call to the next.  Worker processes import the module by its name.
+
+LIBRARY_SETTINGS = (
+    'workers', 'hash_format', 'hash_algorithm', 'file_workers', 'hash_cache_path', 'hash_cache_paranoid',
+    'checksum_deep_audit', 's3_dedup_etag', 's3_range_size', 's3_range_workers', 's3_range_buffer',
+    'walacor_batch_size', 'walacor_pool_size', 'walacor_timeout', 'walacor_retries',
+    'fs_read_buffer', 'fs_read_ahead', 'fs_drop_cache', 'fs_scan_workers', 'manifest_store', 'schema_cache_path'
+)
+
+class ObjectValidator:
+    # settings are the module globals in LIBRARY_SETTINGS, in their own units (bytes, not MB)
+    def __init__(self, walacor_endpoint, walacor_user, walacor_password, source_type=1, source_root='',
+                 s3_endpoint=None, s3_access=None, s3_secret=None, s3_region=None, s3_bucket=None,
+                 log_filename='', log_level=20, **settings):
+        for sName in settings:
+            if sName not in LIBRARY_SETTINGS:
+                raise TypeError('Unknown ObjectValidator setting - ' + sName)
+
+        self.module = library_namespace()
+        self.module.library_setup(walacor_endpoint, walacor_user, walacor_password, source_type, source_root,
+                                  s3_endpoint, s3_access, s3_secret, s3_region, s3_bucket, log_filename, log_level, settings)
+
+    def generate(self, dirs=''):
+        # Makes or updates the records of dirs, see library_run
+        return self.module.library_run(1, dirs)
+
+    def validate(self, dirs=''):
+        # Validates dirs against their records, see library_run
+        return self.module.library_run(2, dirs)
+
+    def list_dirs(self):
+        return self.module.get_dir_list()
+
+    def metrics(self):
+        # The metrics since start up, as --metrics-json has them
+        return self.module.metrics_summary(0)
+
+    def close(self):
+        # Waits for the records still being written
+        self.module.W_WaitForWrites()
+
+    def serve(self, sAddress, intJobs=2, intQueue=16):
+        # Runs the HTTP service until SIGTERM or SIGINT, see service_run
+        return self.module.service_run(sAddress, intJobs, intQueue)
+
+def library_namespace():
+    # A fresh copy of this module, with globals of its own
+    sName = 'ObjectValidator-' + str(next(library_ids))
+    spec = importlib.util.spec_from_file_location(sName, __file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    # The copy cannot be imported by a worker process, its pool runs this module's functions
+    module.pool_module = pool_module
+    module.logger_name = sName
+    return module
+
+def library_setup(sEndpoint, sUser, sPassword, intSourceType, sRoot, sS3Endpoint, sS3Access, sS3Secret, sS3Region, sS3Bucket, sLogFilename, intLogLevel, settings):
+    # Runs in the ObjectValidator's own copy of the module, the globals are its own
+    global walacor_endpoint, walacor_user, walacor_password, source_type, source_root
+    global s3_endpoint, s3_access, s3_secret, s3_region, s3_bucket, log_filename, log_level
+    global logger, s3_client, walacor_writer, run_started
+
+    walacor_endpoint = sEndpoint
+    walacor_user = sUser
+    walacor_password = sPassword
+    source_type = intSourceType
+    source_root = sRoot
+    s3_endpoint = sS3Endpoint
+    s3_access = sS3Access
+    s3_secret = sS3Secret
+    s3_region = sS3Region
+    s3_bucket = sS3Bucket
+    log_filename = sLogFilename
+    log_level = intLogLevel
+    globals().update(settings)
+
+    # Fail now rather than on the first call
+    new_hash(hash_algorithm)
+    if hash_format == HASH_FORMAT_CHECKSUM and source_type != 2:
+        raise ValueError('Hash format 3 is made from S3 checksums, it is for S3 only')
+
+    logger = setup_logger(log_filename, log_level)
+    run_started = get_EpochTime()
+
+    # Calls made at the same time wait only for their own records through the one writer
+    walacor_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    if source_type == 2 or manifest_store.startswith('s3://'):
+        s3_client = s3_setup()
+
+    with metrics_timer('phase_seconds', phase='schema'):
+        W_EnsureSchema()
+
+def library_run(intMode, dirs=''):
+    # One generation (1) or validation (2) pass over dirs, names or glob patterns as parameter 9
+    # takes them (a string or a list), every dir under the root when empty. Passes can run at
+    # the same time, so each returns its own results, in the form --summary has them
+    if intMode not in (1, 2):
+        raise ValueError('A job is generation (1) or validation (2) - ' + str(intMode))
+
+    ldirs, lMissing = library_dirs(dirs)
+    return library_process(intMode, ldirs, lMissing)
+
+def library_dirs(dirs):
+    # (the dirs, the names and patterns that found nothing)
+    sFocus = library_focus(dirs)
+    lMissing = []
+    ldirs = focus_dir_list(sFocus, lMissing) if sFocus else get_dir_list()
+
+    return shard_filter(ldirs), lMissing
+
+def library_focus(dirs):
+    # dirs, a string or a list, as parameter 9 has them
+    return ','.join(dirs) if isinstance(dirs, (list, tuple)) else (dirs or '')
+
+def library_process(intMode, ldirs, lFailed=()):
+    # The pass itself, the dirs in lFailed fail without being hashed
+    state = RunState()
+    dResults = {sName: {'outcome': 1, 'contents_hash': None} for sName in lFailed}
+
+    if intMode == 1:
+        dRecords = {}
+        lHashSpecs = [(hash_format, hash_algorithm)] * len(ldirs)
+    else:
+        # Each record is checked with the hash format and algorithm that created it
+        dRecords = {sdir: W_GetNameHash(hash_string(sdir)) for sdir in ldirs}
+        ldirs, lHashSpecs, lUnhashable = W_RecordHashSpecs(ldirs, dRecords)
+
+        for sdir in lUnhashable:
+            dResults[sdir] = dir_done(sdir, hash_string(sdir), '', 1, state)
+
+    for sdir, dir_hash, dir_contents_hash in hash_dirs(ldirs, workers, lHashSpecs, state):
+        set_dir_context(sdir)
+
+        if intMode == 1:
+            W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash, hash_format, hash_algorithm, manifest_store_dir(sdir, state), state=state)
+            intOutcome = 0
+        else:
+            intOutcome = W_ManageValidation(sdir, dir_hash, dir_contents_hash, dRecords[sdir], state=state)
+
+        dResults[sdir] = dir_done(sdir, dir_hash, dir_contents_hash, intOutcome, state)
+
+        logger.info('Finished - ' + sdir)
+        set_dir_context('')
+
+    with metrics_timer('phase_seconds', phase='walacor_wait'):
+        W_WaitForWrites()
+
+    lNotPersisted = sorted(set(state.not_persisted))
+    for sdir in lNotPersisted:
+        # A validation stands, only its verification date is missing
+        if intMode == 1:
+            dResults[sdir]['outcome'] = 1
+
+    if lNotPersisted:
+        logger.error('Not persisted to Walacor - ' + ', '.join(lNotPersisted))
+
+    return {
+        'mode': intMode,
+        'exit_code': 1 if any(result['outcome'] for result in dResults.values()) else 0,
+        'not_persisted': lNotPersisted,
+        'dirs': dResults
+    }
+
+#endregion
+
+#region Config
+
+# One run over many sources, listed in the TOML (or YAML) file given with --config.
+# They share the Walacor login, the schema check and the prefetched records. Sources on
+# the same S3 endpoint with the same keys share one client and its connection pool, and
+# the run writes one summary. The module keeps the source in globals, so the sources are
+# done one at a time, each --workers dirs at once, and never run side by side.  Sources
+# that should run in parallel go in separate processes, each with its own --config.
+#
+#   [walacor]                        # optional, parameters 3 to 5 otherwise
+#   endpoint = "https://walacor.example/api"
+#   user = "user"
+#   password = "XXXX"
+#
+#   [[sources]]
+#   name = "models"                  # optional, the bucket and root otherwise
+#   type = "s3"                      # s3 or local
+#   root = "ai-ml-model-artifacts"   # the prefix the dirs are under, needed
+#   bucket = "ultra-walacor"
+#   endpoint = ""                    # optional, an S3 compatible endpoint
+#   access_key = "..."               # optional, the boto3 default credentials otherwise
+#   secret_key = "..."
+#   region = "us-gov-west-1"
+#   dirs = "attention_*"             # optional, as parameter 9
+#   hash_format = 2                  # optional, --hash-format and --hash-algorithm otherwise
+#   hash_algorithm = "blake3"
+
+CONFIG_WALACOR_KEYS = ('endpoint', 'user', 'password')
+CONFIG_SOURCE_KEYS = ('name', 'type', 'root', 'bucket', 'endpoint', 'access_key', 'secret_key', 'region', 'dirs', 'hash_format', 'hash_algorithm')
+CONFIG_SOURCE_TYPES = {'local': 1, 's3': 2, 1: 1, 2: 2}
+
+def config_load(sPath):
+    # Returns (the walacor table, the sources), raises ValueError when the file is not right
+    with open(sPath, 'rb') as file:
+        data = file.read()
+
+    if sPath.endswith(('.yaml', '.yml')):
+        if yaml is None:
+            raise ValueError('A YAML --config needs the optional PyYAML package (pip install pyyaml)')
+        try:
+            config = yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            raise ValueError('Config is not valid YAML - ' + sPath + ' - ' + str(e))
+    else:
+        if tomllib is None:
+            raise ValueError('A TOML --config needs Python 3.11 or later, or use YAML')
+        try:
+            config = tomllib.loads(data.decode('utf-8'))
+        except (tomllib.TOMLDecodeError, UnicodeDecodeError) as e:
+            raise ValueError('Config is not valid TOML - ' + sPath + ' - ' + str(e))
+
+    if not isinstance(config, dict) or not isinstance(config.get('sources'), list) or not config['sources']:
+        raise ValueError('Config has no sources - ' + sPath)
+
+    dWalacor = config.get('walacor') or {}
+    for sKey in dWalacor:
+        if sKey not in CONFIG_WALACOR_KEYS:
+            raise ValueError('Config walacor has an unknown key - ' + sKey)
+
+    lSources = []
+    for intSource, dSource in enumerate(config['sources']):
+        sWhere = 'Config source ' + str(intSource + 1)
+
+        if not isinstance(dSource, dict):
+            raise ValueError(sWhere + ' is not a table')
+        for sKey in dSource:
+            if sKey not in CONFIG_SOURCE_KEYS:
+                raise ValueError(sWhere + ' has an unknown key - ' + sKey)
+
+        source = dict(dSource)
+        sType = source.get('type')
+        source['type'] = CONFIG_SOURCE_TYPES.get(sType.lower() if isinstance(sType, str) else sType)
+        source['root'] = str(source.get('root') or '')
+        source['hash_format'] = int(source.get('hash_format') or hash_format)
+        source['hash_algorithm'] = source.get('hash_algorithm') or hash_algorithm
+        source['dirs'] = source.get('dirs') or ''
+
+        if source['type'] is None:
+            raise ValueError(sWhere + ' needs a type, s3 or local')
+        if source['type'] == 2 and not source.get('bucket'):
+            raise ValueError(sWhere + ' is s3 and needs a bucket')
+        if not (source['root'].strip('/') if source['type'] == 2 else source['root']):
+            # Dirs are listed under root + '/', an empty root would list nothing and pass
+            raise ValueError(sWhere + ' needs a root, the prefix (s3) or path (local) its dirs are in')
+        if source['hash_format'] == HASH_FORMAT_CHECKSUM and source['type'] != 2:
+            raise ValueError(sWhere + ' - hash format 3 is made from S3 checksums, it is for S3 only')
+        new_hash(source['hash_algorithm'])
+
+        source['name'] = str(source.get('name') or (source['bucket'] + '/' + source['root'] if source['type'] == 2 else source['root']))
+        if source['name'] in [other['name'] for other in lSources]:
+            raise ValueError(sWhere + ' has the name of another source - ' + source['name'])
+
+        lSources.append(source)
+
+    return dWalacor, lSources
+
+def config_use_source(source):
+    # Points the module's source globals at source
+    global source_type, source_root, s3_bucket, s3_endpoint, s3_access, s3_secret, s3_region, s3_client, hash_format, hash_algorithm
+
+    source_type = source['type']
+    source_root = source['root']
+    hash_format = source['hash_format']
+    hash_algorithm = source['hash_algorithm']
+    s3_bucket = source.get('bucket')
+
+    if source_type != 2:
+        s3_client = None
+        return
+
+    s3_endpoint = source.get('endpoint') or None
+    s3_access = source.get('access_key') or None
+    s3_secret = source.get('secret_key') or None
+    s3_region = source.get('region') or None
+
+    # One client, and its connection pool, per endpoint and keys
+    client_key = (s3_endpoint, s3_region, s3_access, s3_secret)
+    if client_key not in config_s3_clients:
+        config_s3_clients[client_key] = s3_setup()
+    s3_client = config_s3_clients[client_key]
+
+def config_run(intMode, lSources):
+    # Does every source in turn, returns 1 if any failed. A source that cannot be
+    # done (no access to its bucket, a root that is not there) fails on its own
+    global config_report
+
+    config_report = {}
+    dSeen = {}
+    intRet = 0
+
+    for source in lSources:
+        logger.info('Source - ' + source['name'])
+        report = {'type': source['type'], 'root': source['root'], 'bucket': source.get('bucket')}
+
+        try:
+            config_use_source(source)
+
+            with metrics_timer('phase_seconds', phase='list'):
+                ldirs, lFailed = library_dirs(source['dirs'])
+
+            # Records are found by the dir name alone, the same name in two sources would share one
+            for sdir in [sdir for sdir in ldirs if sdir in dSeen]:
+                logger.critical('Dir is also in source ' + dSeen[sdir] + ', not done - ' + source['name'] + ' - ' + sdir)
+                ldirs.remove(sdir)
+                lFailed.append(sdir)
+            dSeen.update((sdir, source['name']) for sdir in ldirs)
+
+            report.update(library_process(intMode, ldirs, lFailed))
+
+            # Nothing to validate is not a pass, the root or the dirs are wrong
+            if intMode == 2 and not ldirs and not lFailed:
+                logger.critical('No dirs found, Validation Failed - ' + source['name'])
+                report.update({'exit_code': 1, 'error': 'No dirs found'})
+        except Exception as e:
+            logger.exception('Source failed - ' + source['name'])
+            report.update({'exit_code': 1, 'error': str(e)})
+
+        config_report[source['name']] = report
+        logger.info('Source finished - ' + source['name'] + ' - ' + str(report['exit_code']))
+
+        if report['exit_code'] != 0:
+            intRet = 1
+
+    return intRet
+
+#endregion
+
+#region Service
+
+# A long running process that takes jobs over HTTP, so a check does not pay for the start
+# up, the boto3 import, a Walacor login and the schema check each time.  Jobs wait in a
+# bounded queue and service_job_workers of them run at once, a job that finds the queue
+# full is turned away with a 429 rather than piling up.
+#
+#   POST /jobs         {"mode": 1 or 2, "dirs": "names,or*globs" or [...], "wait": false}
+#   GET  /jobs/<id>    the job, its status (queued, running, done, failed, cancelled) and its result
+#   GET  /metrics      Prometheus text of the metrics since start up
+#   GET  /health       the jobs queued and running
+
+def service_run(sAddress, intJobs, intQueue):
+    # Serves on host:port until SIGTERM or SIGINT, returns 0
+    global service_queue
+
+    sHost, _, sPort = sAddress.rpartition(':')
+    service_queue = queue.Queue(maxsize=max(1, intQueue))
+
+    lWorkers = [threading.Thread(target=service_worker, name='service-job-' + str(intWorker), daemon=True) for intWorker in range(max(1, intJobs))]
+    for worker in lWorkers:
+        worker.start()
+
+    server = http.server.ThreadingHTTPServer((sHost or '127.0.0.1', int(sPort)), ServiceHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='service-http', daemon=True).start()
+
+    evStop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda intSignal, frame: evStop.set())
+    signal.signal(signal.SIGINT, lambda intSignal, frame: evStop.set())
+
+    logger.warning('Serving - ' + sHost + ':' + str(server.server_address[1]) + ' - ' + str(len(lWorkers)) + ' jobs at once, ' + str(service_queue.maxsize) + ' queued')
+
+    # Wakes up now and then, Python only runs signal handlers between waits
+    while not evStop.wait(1.0):
+        pass
+
+    server.shutdown()
+    server.server_close()
+
+    # Running jobs finish, queued ones are cancelled. Nothing is queued once the flag
+    # is up, so there is room for the workers' stop markers
+    lCancelled = []
+    with service_lock:
+        service_stopping.set()
+        with contextlib.suppress(queue.Empty):
+            while True:
+                lCancelled.append(service_queue.get_nowait())
+
+    for job in lCancelled:
+        service_job_finished(job, 'cancelled')
+
+    for worker in lWorkers:
+        service_queue.put(None)
+    for worker in lWorkers:
+        worker.join()
+
+    logger.warning('Service stopped')
+    return 0
+
+def service_submit(intMode, dirs):
+    # Returns the new job, or None when the queue is full
+    job = {
+        'id': str(next(service_ids)),
+        'mode': intMode,
+        'dirs': dirs,
+        'status': 'queued',
+        'queued': get_EpochTime(),
+        'started': None,
+        'finished': None,
+        'result': None,
+        'error': None
+    }
+
+    with service_lock:
+        if service_stopping.is_set():
+            return None
+
+        try:
+            service_queue.put_nowait(job)
+        except queue.Full:
+            metrics_count('service_jobs_rejected_total')
+            return None
+
+        service_jobs[job['id']] = job
+        service_done[job['id']] = threading.Event()
+
+        # Finished jobs are kept for a while to be picked up, then dropped
+        while len(service_jobs) > SERVICE_JOBS_KEPT:
+            sOldest = next(iter(service_jobs))
+            if service_jobs[sOldest]['finished'] is None:
+                break
+            del service_jobs[sOldest]
+            del service_done[sOldest]
+
+    metrics_count('service_jobs_total', mode=str(intMode))
+    return job
+
+def service_worker():
+    while True:
+        job = service_queue.get()
+        if job is None:
+            return
+
+        job['started'] = get_EpochTime()
+        job['status'] = 'running'
+        metrics_observe('service_queue_seconds', job['started'] - job['queued'])
+        logger.info('Job started - ' + job['id'] + ' - mode ' + str(job['mode']))
+
+        try:
+            job['result'] = library_run(job['mode'], job['dirs'])
+            sStatus = 'done'
+        except Exception as e:
+            # One bad job does not take the service down
+            logger.exception('Job failed - ' + job['id'])
+            metrics_count('service_jobs_failed_total')
+            job['error'] = str(e)
+            sStatus = 'failed'
+
+        metrics_observe('service_job_seconds', get_EpochTime() - job['started'], mode=str(job['mode']))
+        service_job_finished(job, sStatus)
+
+def service_job_finished(job, sStatus):
+    # Done, failed or cancelled, a caller waiting on the job gets its answer
+    job['status'] = sStatus
+    job['finished'] = get_EpochTime()
+    logger.info('Job finished - ' + job['id'] + ' - ' + sStatus)
+
+    with service_lock:
+        evDone = service_done.get(job['id'])
+    if evDone is not None:
+        evDone.set()
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug('Service - ' + self.address_string() + ' - ' + (format % args))
+
+    def send_body(self, intStatus, body, sContentType='application/json', dHeaders=None):
+        self.send_response(intStatus)
+        self.send_header('Content-Type', sContentType)
+        self.send_header('Content-Length', str(len(body)))
+        for sName, sValue in (dHeaders or {}).items():
+            self.send_header(sName, sValue)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, intStatus, payload, dHeaders=None):
+        self.send_body(intStatus, (json.dumps(payload, sort_keys=True) + '\n').encode('utf-8'), dHeaders=dHeaders)
+
+    def do_GET(self):
+        sPath = urllib.parse.urlparse(self.path).path.rstrip('/')
+
+        if sPath == '/health':
+            with service_lock:
+                lStatus = [job['status'] for job in service_jobs.values()]
+            self.send_json(200, {'queued': lStatus.count('queued'), 'running': lStatus.count('running'), 'queue_size': service_queue.maxsize})
+
+        elif sPath == '/metrics':
+            self.send_body(200, metrics_prometheus(metrics_summary(0)).encode('utf-8'), 'text/plain; version=0.0.4')
+
+        elif sPath.startswith('/jobs/'):
+            with service_lock:
+                job = service_jobs.get(sPath[len('/jobs/'):])
+            if job is None:
+                self.send_json(404, {'error': 'Job not found'})
+            else:
+                self.send_json(200, job)
+
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        sPath = urllib.parse.urlparse(self.path).path.rstrip('/')
+        intLength = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(intLength) if intLength else b''
+
+        if sPath != '/jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+
+        try:
+            payload = json.loads(body) if body.strip() else {}
+            intMode = int(payload.get('mode', 0))
+            dirs = payload.get('dirs', '')
+        except (ValueError, TypeError, AttributeError):
+            self.send_json(400, {'error': 'The body is a JSON object with mode and dirs'})
+            return
+
+        if intMode not in (1, 2) or not isinstance(dirs, (str, list)) or not all(isinstance(sName, str) for sName in dirs):
+            self.send_json(400, {'error': 'mode is 1 (generate) or 2 (validate), dirs is a string or a list'})
+            return
+
+        # Nothing outside the root is hashed or recorded for a caller
+        try:
+            focus_check(library_focus(dirs))
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+
+        job = service_submit(intMode, dirs)
+        if job is None and service_stopping.is_set():
+            self.send_json(503, {'error': 'The service is stopping'})
+            return
+        if job is None:
+            self.send_json(429, {'error': 'The job queue is full'}, {'Retry-After': '5'})
+            return
+
+        if payload.get('wait'):
+            # Held until the job is done, for callers that would only poll for it
+            service_done[job['id']].wait()
+            self.send_json(200, job)
+        else:
+            self.send_json(202, job, {'Location': '/jobs/' + job['id']})
+
+#endregion
+
+logger_name = 'my_logger'
+logger = logging.getLogger(logger_name)
+log_filename = ''
+log_level = 20
+walacor_endpoint = ''
+walacor_user = ''
+walacor_password = ''
+walacor_Bearer = ''
+walacor_Bearer_Expiration = 0.0
+walacor_NameHash_Index = None
+walacor_Pending = []
+walacor_batch_size = 1
+walacor_page_size = 1000
+walacor_session = None
+walacor_pool_size = 10
+walacor_timeout = 60
+walacor_retries = 5
+walacor_writer = None
+walacor_writes = []
+walacor_lock = threading.Lock()
+walacor_pending_lock = threading.Lock()
+walacor_login_lock = threading.Lock()
+dir_context = threading.local()
+s3_range_size = 1024 * 1024 * 8
+s3_range_workers = 4
+s3_range_buffer = 1024 * 1024 * 64
+file_workers = 1
+HASH_FORMAT_STREAM = 1
+HASH_FORMAT_TREE = 2
+HASH_FORMAT_CHECKSUM = 3
+TREE_CHUNK_SIZE = 1024 * 1024 * 64
+TREE_BATCH_SIZE = 1000
+hash_cache_path = ''
+hash_cache_paranoid = False
+cache_conn = None
+cache_pid = 0
+cache_lock = threading.Lock()
+fs_read_buffer = 1024 * 1024 * 10
+fs_read_ahead = 2
+fs_drop_cache = True
+fs_thread_buffers = threading.local()
+fs_scan_workers = 1
+metrics_counters = {}
+metrics_histograms = {}
+metrics_lock = threading.Lock()
+METRICS_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+METRICS_BYTE_BUCKETS = tuple(1024 * 4 ** intPower for intPower in range(16))  # 1 KB to 1 TB
+metrics_json_path = ''
+metrics_prom_path = ''
+metrics_prom_dirs = False
+profile_path = ''
+run_profiler = None
+run_started = 0.0
+prog_mode = 0
+source_type = 0
+source_root = ''
+s3_bucket = None
+s3_endpoint = None
+s3_access = None
+s3_secret = None
+s3_region = None
+s3_client = None
+hash_format = 1
+hash_algorithm = 'sha256'
+checkpoint_path = ''
+checkpoint_run_key = ''
+checkpoint_conn = None
+checkpoint_pid = 0
+checkpoint_lock = threading.Lock()
+checkpoint_in_flight = {}
+checkpoint_waiting = {}
+shard_index = 0
+shard_count = 1
+workers = 1
+s3_inventory_path = ''
+sample_window = 0.0
+sample_size = 0
+sample_report = None
+s3_limiter = None
+S3_THROTTLE_CODES = ('SlowDown', '503', 'ServiceUnavailable', 'RequestLimitExceeded', 'TooManyRequests')
+s3_bandwidth = 0
+s3_bandwidth_next = 0.0
+s3_bandwidth_lock = threading.Lock()
+inventory_db_path = ''
+inventory_dirs = set()
+inventory_thread = threading.local()
+watch_debounce = 30.0
+watch_interval = 300.0
+summary_path = ''
+manifest_store = ''
+MANIFEST_LOG_LIMIT = 100
+s3_dedup_etag = False
+dedup_hashes = {}
+dedup_pending = {}
+dedup_lock = threading.Lock()
+DEDUP_MIN_SIZE = 1024 * 1024 * 8
+spool_path = ''
+spool_key_path = ''
+spool_key = b''
+spool_file = None
+spool_last_mac = ''
+spool_count = 0
+hash_only = False
+focus_model = ''
+focus_missing = []
+schema_cache_path = ''
+SCHEMA_CACHE_SECONDS = 24 * 3600
+checksum_deep_audit = False
+run_state = RunState()
+run_results = run_state.results
+dir_trust = run_state.trust
+dir_manifests = run_state.manifests
+manifest_changes = run_state.changes
+walacor_NotPersisted = run_state.not_persisted
+manifest_s3_client = None
+config_path = ''
+config_report = None
+config_s3_clients = {}
+library_ids = itertools.count(1)
+pool_module = sys.modules.get(__name__)
+service_queue = None
+service_jobs = collections.OrderedDict()
+service_done = {}
+service_ids = itertools.count(1)
+service_lock = threading.Lock()
+service_stopping = threading.Event()
+SERVICE_JOBS_KEPT = 1000
+
+if __name__ == "__main__":
+
+    if get_option('merge-summaries'):
+        # Merging the shard summaries needs no source and no Walacor
+        logger = setup_logger('', 20)
+        merged, intRet = summary_merge(get_option('merge-summaries').split(','))
+
+        if get_option('summary'):
+            metrics_write_file(get_option('summary'), json.dumps(merged, indent=2, sort_keys=True) + '\n')
+
+        sys.exit(intRet)
+
+    prog_mode = int(get_parameter(1))
+    source_type = int(get_parameter(2))
+    walacor_endpoint = get_parameter(3)
+    walacor_user = get_parameter(4)
+    walacor_password = get_parameter(5)
+    log_filename = get_parameter(6)
+    log_level = int(get_parameter(7))
+    source_root = get_parameter(8)
+    focus_model = get_parameter(9) or ''
     s3_endpoint = get_parameter(10)
     s3_access = get_parameter(11)
     s3_secret = get_parameter(12)
     s3_region= get_parameter(13)
     s3_bucket = get_parameter(14)
 
+    workers = int(get_option('workers', 1))
+    s3_range_size = int(get_option('s3-range-size', 8)) * 1024 * 1024
+    s3_range_workers = int(get_option('s3-range-workers', 4))
+    s3_range_buffer = int(get_option('s3-range-buffer', 64)) * 1024 * 1024
+    hash_format = int(get_option('hash-format', HASH_FORMAT_STREAM))
+    hash_algorithm = get_option('hash-algorithm', 'sha256')
+    file_workers = int(get_option('file-workers', 1))
+    hash_cache_path = get_option('cache', '')
+    hash_cache_paranoid = bool(get_option('paranoid', False))
+    walacor_batch_size = max(1, int(get_option('walacor-batch', 100)))
+    walacor_page_size = int(get_option('walacor-page-size', 1000))
+    walacor_pool_size = int(get_option('walacor-pool', 10))
+    walacor_timeout = float(get_option('walacor-timeout', 60))
+    walacor_retries = int(get_option('walacor-retries', 5))
+    fs_read_buffer = int(float(get_option('read-buffer', 10)) * 1024 * 1024)
+    fs_read_ahead = int(get_option('read-ahead', 2))
+    fs_drop_cache = not get_option('keep-page-cache', False)
+    fs_scan_workers = int(get_option('scan-workers', 1))
+    metrics_json_path = get_option('metrics-json', '')
+    metrics_prom_path = get_option('metrics-prom', '')
+    metrics_prom_dirs = bool(get_option('metrics-prom-dirs', False))
+    profile_path = get_option('profile', '')
+    checkpoint_path = get_option('checkpoint', '')
+    shard_count = int(get_option('shard-count', 1))
+    shard_index = int(get_option('shard-index', 0))
+    summary_path = get_option('summary', '')
+    watch = bool(get_option('watch', False))
+    s3_inventory_path = get_option('s3-inventory', '')
+    sample_window = float(get_option('sample-window', 0))
+    sample_size = int(get_option('sample-size', 0))
+    s3_bandwidth = float(get_option('s3-bandwidth', 0)) * 1024 * 1024
+    manifest_store = get_option('manifest-store', '')
+    s3_dedup_etag = bool(get_option('dedup-etag', False))
+    spool_path = get_option('spool', '')
+    schema_cache_path = get_option('schema-cache', '')
+    checksum_deep_audit = bool(get_option('deep-audit', False))
+    spool_key_path = get_option('spool-key', '')
+    serve_address = get_option('serve', '')
+    config_path = get_option('config', '')
+
+    if get_option('s3-adaptive', False):
+        # Starts where a fixed setup would be, and finds its way from there
+        s3_limiter = AdaptiveLimiter(max(workers, s3_range_workers, file_workers), int(get_option('s3-max-inflight', 64)))
+    watch_debounce = float(get_option('watch-debounce', 30))
+    watch_interval = float(get_option('watch-interval', 300))
+    run_started = get_EpochTime()
+
+    if get_option('tracemalloc', False):
+        tracemalloc.start()
+
+    if profile_path:
+        run_profiler = cProfile.Profile()
+        run_profiler.enable()
+
+    # Jobs of the service wait only for their own records through the one writer
+    if get_option('walacor-async', False) or serve_address:
+        walacor_writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
     logger = setup_logger(log_filename,log_level)
 
-    W_EnsureSchema()
+    if not 0 <= shard_index < shard_count:
+        logger.critical('Shard index must be 0 to ' + str(shard_count - 1) + ' - ' + str(shard_index))
+        sys.exit(2)
+
+    if watch and prog_mode not in (1, 2):
+        logger.critical('Watch mode is for generation (1) and validation (2) only')
+        sys.exit(2)
+
+    if watch and s3_inventory_path:
+        logger.critical('Watch mode lists S3 itself, it does not take an S3 Inventory')
+        sys.exit(2)
+
+    if hash_format == HASH_FORMAT_CHECKSUM and source_type != 2 and (prog_mode in (1, 3) or serve_address) and not config_path:
+        logger.critical('Hash format 3 is made from S3 checksums, it is for S3 only')
+        sys.exit(2)
+
+    if focus_model:
+        try:
+            focus_check(focus_model)
+        except ValueError as e:
+            logger.critical(str(e))
+            sys.exit(2)
+
+    if watch and focus_model:
+        logger.critical('Watch mode watches the whole root, it does not take dirs to focus on')
+        sys.exit(2)
+
+    if spool_path and (prog_mode not in (1, 2, 4) or watch or sample_window):
+        logger.critical('A spool is for generation (1) and validation (2) without --watch or --sample-window, and publishing (4)')
+        sys.exit(2)
+
+    if serve_address and (spool_path or watch or sample_window or checkpoint_path or focus_model or shard_count > 1):
+        logger.critical('The service takes its dirs from each job, it does not take --spool, --watch, --sample-window, --checkpoint, --shard-count or parameter 9')
+        sys.exit(2)
+
+    if config_path and (prog_mode not in (1, 2) or spool_path or watch or serve_address or sample_window or checkpoint_path or focus_model or s3_inventory_path):
+        logger.critical('A --config is for generation (1) and validation (2) without --spool, --watch, --serve, --sample-window, --checkpoint, --s3-inventory or parameter 9')
+        sys.exit(2)
+
+    if config_path:
+        try:
+            walacor_config, config_sources = config_load(config_path)
+        except (OSError, ValueError) as e:
+            logger.critical(str(e))
+            sys.exit(2)
+
+        # Every source shares the one Walacor login
+        walacor_endpoint = walacor_config.get('endpoint', walacor_endpoint)
+        walacor_user = walacor_config.get('user', walacor_user)
+        walacor_password = walacor_config.get('password', walacor_password)
+        logger.info('Config - ' + config_path + ' - ' + str(len(config_sources)) + ' sources')
+
+    if prog_mode == 4 and not spool_path:
+        logger.critical('Mode 4 publishes a --spool')
+        sys.exit(2)
+
+    if spool_path:
+        try:
+            spool_key = spool_load_key()
+        except (OSError, ValueError) as e:
+            logger.critical(str(e))
+            sys.exit(2)
+
+    # Hashing into a spool does not talk to Walacor at all
+    hash_only = bool(spool_path) and prog_mode != 4
+
+    # Fail now rather than after the first directory
+    new_hash(hash_algorithm)
+
+    if not hash_only:
+        with metrics_timer('phase_seconds', phase='schema'):
+            W_EnsureSchema()
+
+    # A focused run looks up only its own records, the service's records change as it runs
+    if not hash_only and not focus_model and not serve_address and not get_option('no-prefetch', False):
+        with metrics_timer('phase_seconds', phase='prefetch'):
+            W_PrefetchNameHashes()
+
+    s3_client = None
+
+    if source_type == 2 or manifest_store.startswith('s3://'):
+        # login to s3
+        s3_client = s3_setup()
+
+    if prog_mode == 4:
+        logger.info('*******  Publish Spool *******')
+        intRet = spool_apply(spool_path)
+
+        with metrics_timer('phase_seconds', phase='walacor_wait'):
+            W_WaitForWrites()
+
+        if walacor_NotPersisted:
+            logger.critical('Not persisted to Walacor - ' + ', '.join(walacor_NotPersisted))
+            for sdir in walacor_NotPersisted:
+                run_results[sdir]['outcome'] = 1
+            intRet = 1
 
-    ldirs = []
+        run_finish(intRet)
 
-    if prog_mode == 1:
-        logger.info('*******  Generation *******')
-        if source_type == 1:
-            # we are generating for local file system
-            ldirs = [d for d in os.listdir(source_root) if os.path.isdir(os.path.join(source_root, d))]
+    if config_path:
+        # The manifest store keeps the client of parameters 10 to 13, the sources get their own
+        manifest_s3_client = s3_client
+        logger.info('*******  Config *******')
+        run_finish(config_run(prog_mode, config_sources))
 
-        elif source_type == 2:
-            # we are generating for an s3 source
-             # login to s3
-            s3_client = s3_setup()        
-            # Get dir list from root
-            ldirs = s3_list_directories(s3_client, s3_bucket, source_root)       
+    if serve_address:
+        logger.info('*******  Service *******')
+        run_finish(service_run(serve_address, int(get_option('serve-jobs', 2)), int(get_option('serve-queue', 16))))
 
-        for sdir in ldirs:
-            # Hash the dir name
-            sha2_dir_hash = hashlib.sha256()
+    if source_type == 2 and s3_inventory_path:
+        with metrics_timer('phase_seconds', phase='inventory'):
+            inventory_dirs = inventory_load(s3_inventory_path, source_root)
 
-            logger.info('Starting - ' + sdir)
-            dir_hash = hash_string(sdir)
+    # Get dir list from root
+    with metrics_timer('phase_seconds', phase='list'):
+        ldirs = shard_filter(get_dir_list())
 
-            logger.info('Dir Hash - ' + sdir + ' - ' + dir_hash)
+    # Dirs finished before a restart are not done again, their outcomes still count
+    dDone = {}
+    if checkpoint_path:
+        checkpoint_run_key = checkpoint_make_run_key()
+        dDone = checkpoint_open()
+        metrics_count('dirs_resumed_total', len([sdir for sdir in ldirs if sdir in dDone]))
+        run_results.update({sdir: {'outcome': intOutcome, 'contents_hash': None} for sdir, intOutcome in dDone.items() if sdir in ldirs})
+        ldirs = [sdir for sdir in ldirs if sdir not in dDone]
 
-            # Hash the dir contents
-            dir_contents_hash = ''
-            if source_type == 1:
-                dir_contents_hash = fs_hash_files_in_dir(source_root + '/' + sdir)
-            elif source_type == 2:
-                dir_contents_hash = s3_hash_dir_contents(s3_client, s3_bucket, [source_root + '/' + sdir])
+    intDoneRet = 1 if any(dDone.values()) or focus_missing else 0
+
+    for sName in focus_missing:
+        run_results[sName] = {'outcome': 1, 'contents_hash': None}
+
+    if hash_only:
+        logger.info('*******  Hash to Spool *******')
 
-            logger.info('Dir Contents Hash - ' + sdir + ' - ' + dir_contents_hash)
+        try:
+            spool_open(bool(dDone))
+        except (OSError, ValueError) as e:
+            logger.critical(str(e))
+            sys.exit(2)
 
-            W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash)
+        for sdir, dir_hash, dir_contents_hash in hash_dirs(ldirs, workers, [(hash_format, hash_algorithm)] * len(ldirs)):
+            set_dir_context(sdir)
+            spool_write_dir(sdir, dir_hash, dir_contents_hash, manifest_store_dir(sdir))
+            dir_done(sdir, dir_hash, dir_contents_hash, 0)
 
             logger.info('Finished - ' + sdir)
+            set_dir_context('')
+
+        spool_close()
+        run_finish(intDoneRet)
+
+    if watch:
+        logger.info('*******  Watch *******')
+        run_finish(watch_run(set(ldirs)))
+
+    if prog_mode == 1:
+        logger.info('*******  Generation *******')
+
+        for sdir, dir_hash, dir_contents_hash in hash_dirs(ldirs, workers, [(hash_format, hash_algorithm)] * len(ldirs)):
+            set_dir_context(sdir)
+            W_ManageDirHashRecord(sdir, dir_hash, dir_contents_hash, hash_format, hash_algorithm, manifest_store_dir(sdir))
+            dir_done(sdir, dir_hash, dir_contents_hash, 0)
+
+            logger.info('Finished - ' + sdir)
+            set_dir_context('')
+
+        with metrics_timer('phase_seconds', phase='walacor_wait'):
+            W_WaitForWrites()
+
+        if walacor_NotPersisted:
+            logger.critical('Not persisted to Walacor - ' + ', '.join(walacor_NotPersisted))
+            for sdir in walacor_NotPersisted:
+                run_results[sdir]['outcome'] = 1
+            run_finish(1)
+
+        run_finish(intDoneRet)
 
     elif prog_mode == 2:
         logger.info('*******  Validation *******')
         # we are verfifying existing hashes
-        if source_type == 1:
-            # we are generating for local file system
-            ldirs = [d for d in os.listdir(source_root) if os.path.isdir(os.path.join(source_root, d))]
+        intRet = intDoneRet
 
-        elif source_type == 2:
-            # we are generating new and updated hashes from an s3 source
-             # login to s3
-            s3_client = s3_setup()        
-            # Get dir list from root
-            ldirs = s3_list_directories(s3_client, s3_bucket, source_root)    
+        # Each record is checked with the hash format and algorithm that created it
+        dRecords = {sdir: W_GetNameHash(hash_string(sdir)) for sdir in ldirs}
+        lAllDirs = ldirs
 
-        intRet = 0
+        if sample_window:
+            ldirs = sample_dirs(ldirs, dRecords)
+
+        ldirs, lHashSpecs, lFailed = W_RecordHashSpecs(ldirs, dRecords)
+
+        for sdir in lFailed:
+            dir_done(sdir, hash_string(sdir), '', 1)
+            intRet = 1
 
         # Process the directories
-        for sdir in ldirs:
+        for sdir, dir_hash, dir_contents_hash in hash_dirs(ldirs, workers, lHashSpecs):
+            set_dir_context(sdir)
+            intOutcome = W_ManageValidation(sdir, dir_hash, dir_contents_hash, dRecords[sdir])
+            dir_done(sdir, dir_hash, dir_contents_hash, intOutcome)
 
-            logger.info('Starting - ' + sdir)
-            dir_hash = hash_string(sdir)
+            if intOutcome != 0:
+                intRet = 1
 
-            logger.info('Dir Hash - ' + sdir + ' - ' + dir_hash)
+            logger.info('Finished - ' + sdir)
+            set_dir_context('')
 
-            # Hash the dir contents
-            dir_contents_hash = ''
-            if source_type == 1:
-                dir_contents_hash = fs_hash_files_in_dir(source_root + '/' + sdir)
-            elif source_type == 2:
-                dir_contents_hash = s3_hash_dir_contents(s3_client, s3_bucket, [source_root + '/' + sdir])
+        with metrics_timer('phase_seconds', phase='walacor_wait'):
+            W_WaitForWrites()
+
+        if walacor_NotPersisted:
+            # Validation results stand, only the verification dates are missing
+            logger.error('Verification date not persisted to Walacor - ' + ', '.join(walacor_NotPersisted))
+
+        if sample_window:
+            sample_coverage(lAllDirs, dRecords)
+
+        run_finish(intRet)
+
+    elif prog_mode == 3:
+        logger.info('*******  Migration *******')
+        # we are moving existing records to --hash-format/--hash-algorithm, only after they validate
+        intRet = intDoneRet
+        new_spec = (hash_format, hash_algorithm)
 
-            logger.info('Dir Contents Hash - ' + sdir + ' - ' + dir_contents_hash)
+        dRecords = {sdir: W_GetNameHash(hash_string(sdir)) for sdir in ldirs}
+        lMigrate = [sdir for sdir in ldirs if W_RecordHashSpec(dRecords[sdir]) != new_spec or not dRecords[sdir]]
 
-            if W_ManageValidation(sdir, dir_hash, dir_contents_hash) != 0:
+        for sdir in ldirs:
+            if sdir not in lMigrate:
+                logger.info('Already ' + W_HashSpecName(*new_spec) + ', nothing to migrate - ' + sdir)
+
+        lMigrate, lOldSpecs, lFailed = W_RecordHashSpecs(lMigrate, dRecords, 'Migration')
+
+        for sdir in lFailed:
+            dir_done(sdir, hash_string(sdir), '', 1)
+            intRet = 1
+
+        # Hash with the new format and algorithm first, keeping each dir's new manifest
+        lHave = [sdir for sdir in lMigrate if dRecords[sdir]]
+        dNew = {}
+        for sdir, dir_hash, new_contents_hash in hash_dirs(lHave, workers, [new_spec] * len(lHave)):
+            dNew[sdir] = (new_contents_hash, dir_manifests.pop(sdir, None))
+
+        # Then validate with the old ones.  This read comes after the new one, so a dir
+        # that changed in between no longer matches its record and is not migrated
+        for sdir, dir_hash, dir_contents_hash in hash_dirs(lMigrate, workers, lOldSpecs):
+            set_dir_context(sdir)
+            new_contents_hash, bManifest = dNew.get(sdir, ('', None))
+            sManifestHash = ''
+
+            if dRecords[sdir] and dRecords[sdir]['ContentsHash'] == dir_contents_hash:
+                # The old format's manifest is only wanted to show what changed
+                dir_manifests.pop(sdir, None)
+                if bManifest is not None:
+                    sManifestHash = manifest_put(bManifest)
+
+            intOutcome = W_ManageMigration(sdir, dir_hash, dir_contents_hash, new_contents_hash, hash_format, hash_algorithm, dRecords[sdir], sManifestHash)
+            dir_done(sdir, dir_hash, new_contents_hash if intOutcome == 0 else dir_contents_hash, intOutcome)
+
+            if intOutcome != 0:
                 intRet = 1
 
             logger.info('Finished - ' + sdir)
+            set_dir_context('')
+
+        with metrics_timer('phase_seconds', phase='walacor_wait'):
+            W_WaitForWrites()
+
+        if walacor_NotPersisted:
+            logger.critical('Not persisted to Walacor - ' + ', '.join(walacor_NotPersisted))
+            for sdir in walacor_NotPersisted:
+                run_results[sdir]['outcome'] = 1
+            intRet = 1
 
-        sys.exit(intRet)
\ No newline at end of file
+        run_finish(intRet)
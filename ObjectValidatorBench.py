@@ -0,0 +1,566 @@
+#    Copyright 2024 Walacor Corporation
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#    limitations under the License.
+
+# Benchmark harness for ObjectValidator.py
+#
+# Builds synthetic directory trees, serves them through a local S3 compatible
+# stand-in, answers Walacor calls with a mock server, runs ObjectValidator.py
+# (generation then validation) against both the filesystem and S3, and writes
+# the throughput, wall time and peak RSS of every phase as JSON.
+#
+# Needs nothing beyond what ObjectValidator.py needs.  Linux/macOS only (os.wait4).
+
+import argparse
+import base64
+import bisect
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+#region Synthetic Trees
+
+# Each profile is (top level dirs, builder), sizes and counts are multiplied by --scale
+PROFILES = {
+    'tiny': 'Many tiny files - 4 dirs of 2000 files of 1 KB',
+    'huge': 'A few huge files - 2 dirs of 2 files of 128 MB',
+    'deep': 'Deep nesting - 4 dirs nested 16 deep, 5 files of 16 KB per level'
+}
+
+def scaled(intValue, fScale):
+    return max(1, int(intValue * fScale))
+
+def write_random_file(file_path, intSize, rng):
+    with open(file_path, 'wb') as file:
+        while intSize > 0:
+            intBlock = min(intSize, 1024 * 1024 * 8)
+            file.write(rng.randbytes(intBlock))
+            intSize -= intBlock
+
+def build_tree(sRoot, sProfile, fScale):
+    # Trees are deterministic, and reused when one of the same profile and scale is there
+    sMarker = os.path.join(sRoot, '.bench_' + sProfile + '_' + str(fScale))
+    if os.path.exists(sMarker):
+        return
+
+    rng = random.Random(sProfile + str(fScale))
+    os.makedirs(sRoot, exist_ok=True)
+
+    if sProfile == 'tiny':
+        for intDir in range(4):
+            sDir = os.path.join(sRoot, 'd%04d' % intDir)
+            os.makedirs(sDir, exist_ok=True)
+            for intFile in range(scaled(2000, fScale)):
+                write_random_file(os.path.join(sDir, 'f%06d.bin' % intFile), 1024, rng)
+
+    elif sProfile == 'huge':
+        for intDir in range(2):
+            sDir = os.path.join(sRoot, 'd%04d' % intDir)
+            os.makedirs(sDir, exist_ok=True)
+            for intFile in range(2):
+                write_random_file(os.path.join(sDir, 'f%06d.bin' % intFile), scaled(128 * 1024 * 1024, fScale), rng)
+
+    elif sProfile == 'deep':
+        for intDir in range(4):
+            sDir = os.path.join(sRoot, 'd%04d' % intDir)
+            for intLevel in range(16):
+                sDir = os.path.join(sDir, 'l%02d' % intLevel)
+                os.makedirs(sDir, exist_ok=True)
+                for intFile in range(scaled(5, fScale)):
+                    write_random_file(os.path.join(sDir, 'f%06d.bin' % intFile), 16 * 1024, rng)
+
+    else:
+        raise ValueError('Unknown profile - ' + sProfile)
+
+    open(sMarker, 'w').close()
+
+def tree_stats(sRoot):
+    intFiles = 0
+    intBytes = 0
+
+    for dirpath, dirnames, filenames in os.walk(sRoot):
+        for filename in filenames:
+            if filename.startswith('.bench_'):
+                continue
+            intFiles += 1
+            intBytes += os.path.getsize(os.path.join(dirpath, filename))
+
+    return intFiles, intBytes
+
+#endregion
+
+#region Mock Walacor
+
+class MockWalacorHandler(BaseHTTPRequestHandler):
+    # Answers the calls ObjectValidator.py makes, with server.latency seconds added to each
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are separate writes on a kept-alive connection
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, intStatus, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(intStatus)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        intLength = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(intLength) if intLength else b''
+        return json.loads(body) if body.strip() else {}
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        if self.path.startswith('/schemas/envelopeTypes/'):
+            if self.server.schema:
+                self.send_json(200, {'success': True, 'data': self.server.schema})
+            else:
+                self.send_json(404, {'success': False, 'error': 'Schema not found'})
+            return
+
+        self.send_json(404, {'success': False, 'error': 'Not found'})
+
+    def do_POST(self):
+        time.sleep(self.server.latency)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        payload = self.read_json()
+
+        if url.path == '/auth/login':
+            self.send_json(200, {'api_token': 'Bearer bench'})
+
+        elif url.path.rstrip('/') == '/schemas':
+            self.server.schema = payload
+            self.send_json(200, {'success': True, 'data': {'UID': [str(uuid.uuid4())]}})
+
+        elif url.path == '/query/get':
+            with self.server.lock:
+                lRecords = [record for record in self.server.records.values()
+                            if all(record.get(sField) == value for sField, value in payload.items())]
+
+            if 'pageSize' in query:
+                intPageSize = int(query['pageSize'][0])
+                intPage = int(query.get('pageNo', ['1'])[0])
+                lRecords = lRecords[(intPage - 1) * intPageSize:intPage * intPageSize]
+
+            self.send_json(200, {'success': True, 'data': lRecords})
+
+        elif url.path == '/envelopes/submit':
+            lUIDs = []
+
+            with self.server.lock:
+                for record in payload.get('Data', []):
+                    sUID = record.get('UID') or str(uuid.uuid4())
+                    self.server.records.setdefault(sUID, {'UID': sUID}).update(record)
+                    lUIDs.append(sUID)
+
+            self.send_json(200, {'success': True, 'data': {'UID': lUIDs}})
+
+        else:
+            self.send_json(404, {'success': False, 'error': 'Not found'})
+
+def start_mock_walacor(fLatency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockWalacorHandler)
+    server.daemon_threads = True
+    server.latency = fLatency
+    server.schema = None
+    server.records = {}
+    server.lock = threading.Lock()
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#endregion
+
+#region S3 Stand-in
+
+class S3StandInHandler(BaseHTTPRequestHandler):
+    # Path style ListObjectsV2, GetObject (with Range and If-Match) and HeadObject over a local dir.
+    # Every bucket maps to server.root, requests are not authenticated
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # Headers and body are separate writes on a kept-alive connection
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, intStatus, body, sContentType='application/xml', dHeaders=None):
+        self.send_response(intStatus)
+        self.send_header('Content-Type', sContentType)
+        self.send_header('Content-Length', str(len(body)))
+        for sName, sValue in (dHeaders or {}).items():
+            self.send_header(sName, sValue)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_xml(self, intStatus, sCode):
+        body = ('<?xml version="1.0" encoding="UTF-8"?><Error><Code>' + sCode + '</Code><Message>' + sCode + '</Message></Error>').encode('utf-8')
+        self.send_body(intStatus, body)
+
+    def split_path(self):
+        url = urllib.parse.urlparse(self.path)
+        lParts = url.path.lstrip('/').split('/', 1)
+        sKey = urllib.parse.unquote(lParts[1]) if len(lParts) > 1 else ''
+        return lParts[0], sKey, urllib.parse.parse_qs(url.query, keep_blank_values=True)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        sBucket, sKey, query = self.split_path()
+
+        if not sKey:
+            self.list_objects_v2(sBucket, query)
+        else:
+            self.get_object(sKey)
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        sBucket, sKey, query = self.split_path()
+        self.get_object(sKey)
+
+    def list_objects_v2(self, sBucket, query):
+        sPrefix = query.get('prefix', [''])[0]
+        sDelimiter = query.get('delimiter', [''])[0]
+        intMaxKeys = int(query.get('max-keys', ['1000'])[0])
+        sToken = query.get('continuation-token', [''])[0]
+        sStartAfter = urllib.parse.unquote(sToken) if sToken else query.get('start-after', [''])[0]
+
+        lKeys = self.server.keys
+        intPos = bisect.bisect_left(lKeys, sPrefix)
+        if sStartAfter:
+            intPos = max(intPos, bisect.bisect_right(lKeys, sStartAfter))
+
+        lContents = []
+        lPrefixes = []
+        sLast = ''
+        bTruncated = False
+
+        while intPos < len(lKeys) and lKeys[intPos].startswith(sPrefix):
+            if len(lContents) + len(lPrefixes) >= intMaxKeys:
+                bTruncated = True
+                break
+
+            sKey = lKeys[intPos]
+            intDelim = sKey.find(sDelimiter, len(sPrefix)) if sDelimiter else -1
+
+            if intDelim >= 0:
+                # Everything under a common prefix counts once
+                sCommon = sKey[:intDelim + len(sDelimiter)]
+                lPrefixes.append(sCommon)
+                sLast = sCommon + '\U0010ffff'
+                intPos = bisect.bisect_left(lKeys, sLast)
+            else:
+                lContents.append(sKey)
+                sLast = sKey
+                intPos += 1
+
+        lXml = ['<?xml version="1.0" encoding="UTF-8"?>',
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                '<Name>' + escape(sBucket) + '</Name>',
+                '<Prefix>' + escape(sPrefix) + '</Prefix>',
+                '<KeyCount>' + str(len(lContents) + len(lPrefixes)) + '</KeyCount>',
+                '<MaxKeys>' + str(intMaxKeys) + '</MaxKeys>',
+                '<IsTruncated>' + ('true' if bTruncated else 'false') + '</IsTruncated>']
+
+        if sDelimiter:
+            lXml.append('<Delimiter>' + escape(sDelimiter) + '</Delimiter>')
+        if sToken:
+            lXml.append('<ContinuationToken>' + escape(sToken) + '</ContinuationToken>')
+        if bTruncated:
+            lXml.append('<NextContinuationToken>' + escape(urllib.parse.quote(sLast)) + '</NextContinuationToken>')
+
+        for sKey in lContents:
+            info = self.server.objects[sKey]
+            lXml.append('<Contents><Key>' + escape(sKey) + '</Key><LastModified>' + info['LastModified'] +
+                        '</LastModified><ETag>&quot;' + info['ETag'] + '&quot;</ETag><Size>' + str(info['Size']) +
+                        '</Size><StorageClass>STANDARD</StorageClass></Contents>')
+
+        for sCommon in lPrefixes:
+            lXml.append('<CommonPrefixes><Prefix>' + escape(sCommon) + '</Prefix></CommonPrefixes>')
+
+        lXml.append('</ListBucketResult>')
+        self.send_body(200, ''.join(lXml).encode('utf-8'))
+
+    def get_object(self, sKey):
+        info = self.server.objects.get(sKey)
+        if info is None:
+            self.send_error_xml(404, 'NoSuchKey')
+            return
+
+        sIfMatch = self.headers.get('If-Match')
+        if sIfMatch and sIfMatch.strip('"') != info['ETag']:
+            self.send_error_xml(412, 'PreconditionFailed')
+            return
+
+        intSize = info['Size']
+        intStart = 0
+        intEnd = intSize - 1
+        intStatus = 200
+        dHeaders = {'ETag': '"' + info['ETag'] + '"', 'Last-Modified': info['HttpDate'], 'Accept-Ranges': 'bytes'}
+
+        if self.headers.get('x-amz-checksum-mode', '').upper() == 'ENABLED' and info.get('ChecksumSHA256') and not self.headers.get('Range'):
+            dHeaders['x-amz-checksum-sha256'] = info['ChecksumSHA256']
+            dHeaders['x-amz-checksum-type'] = 'FULL_OBJECT'
+
+        sRange = self.headers.get('Range')
+        if sRange and sRange.startswith('bytes='):
+            sStart, sEnd = sRange[6:].split('-', 1)
+            intStart = int(sStart)
+            intEnd = min(int(sEnd), intSize - 1) if sEnd else intSize - 1
+            if intStart >= intSize:
+                self.send_error_xml(416, 'InvalidRange')
+                return
+            intStatus = 206
+            dHeaders['Content-Range'] = 'bytes ' + str(intStart) + '-' + str(intEnd) + '/' + str(intSize)
+
+        if self.command == 'HEAD':
+            self.send_response(intStatus)
+            self.send_header('Content-Length', str(intEnd - intStart + 1))
+            for sName, sValue in dHeaders.items():
+                self.send_header(sName, sValue)
+            self.end_headers()
+            return
+
+        self.send_response(intStatus)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(intEnd - intStart + 1))
+        for sName, sValue in dHeaders.items():
+            self.send_header(sName, sValue)
+        self.end_headers()
+
+        # Stream the range from disk
+        with open(info['Path'], 'rb') as file:
+            file.seek(intStart)
+            intLeft = intEnd - intStart + 1
+            while intLeft > 0:
+                chunk = file.read(min(intLeft, 1024 * 1024))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                intLeft -= len(chunk)
+
+def start_s3_standin(sRoot, fLatency):
+    # The listing, ETags (md5, like a single part upload) and SHA-256 checksums (like an
+    # upload with additional checksums) are worked out up front, so they do not count
+    # against the run being measured
+    dObjects = {}
+
+    for dirpath, dirnames, filenames in os.walk(sRoot):
+        for filename in filenames:
+            if filename.startswith('.bench_'):
+                continue
+
+            sPath = os.path.join(dirpath, filename)
+            sKey = os.path.relpath(sPath, sRoot).replace(os.sep, '/')
+            md5 = hashlib.md5()
+            sha2_hash = hashlib.sha256()
+
+            with open(sPath, 'rb') as file:
+                for chunk in iter(lambda: file.read(1024 * 1024 * 8), b''):
+                    md5.update(chunk)
+                    sha2_hash.update(chunk)
+
+            stat = os.stat(sPath)
+            dObjects[sKey] = {
+                'Path': sPath,
+                'Size': stat.st_size,
+                'ETag': md5.hexdigest(),
+                'ChecksumSHA256': base64.b64encode(sha2_hash.digest()).decode('ascii'),
+                'LastModified': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stat.st_mtime)),
+                'HttpDate': formatdate(stat.st_mtime, usegmt=True)
+            }
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), S3StandInHandler)
+    server.daemon_threads = True
+    server.latency = fLatency
+    server.objects = dObjects
+    server.keys = sorted(dObjects)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+#endregion
+
+#region Runner
+
+def run_phase(lCommand, sLogFile):
+    # Runs one ObjectValidator.py process, returns wall time, exit code and its own peak RSS
+    fStart = time.perf_counter()
+
+    with open(sLogFile, 'ab') as log:
+        process = subprocess.Popen(lCommand, stdout=log, stderr=subprocess.STDOUT)
+        pid, intStatus, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(intStatus)
+
+    fWall = time.perf_counter() - fStart
+
+    # ru_maxrss is KB on Linux and bytes on macOS
+    intRssBytes = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+
+    return {
+        'wall_s': round(fWall, 4),
+        'user_s': round(rusage.ru_utime, 4),
+        'sys_s': round(rusage.ru_stime, 4),
+        'peak_rss_mb': round(intRssBytes / 1024 / 1024, 2),
+        'exit_code': process.returncode
+    }
+
+def add_throughput(phase, intFiles, intBytes):
+    fWall = max(phase['wall_s'], 1e-9)
+    phase['mb_s'] = round(intBytes / 1024 / 1024 / fWall, 2)
+    phase['files_s'] = round(intFiles / fWall, 2)
+    return phase
+
+def git_version(sPath):
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(sPath)),
+                              capture_output=True, text=True, timeout=10).stdout.strip() or 'unknown'
+    except (OSError, subprocess.SubprocessError):
+        return 'unknown'
+
+def run_benchmark(args, lValidatorArgs):
+    sTrees = os.path.join(args.workdir, 'trees')
+    sLogFile = os.path.join(args.workdir, 'bench_validator_log.txt')
+    lProfiles = [sProfile for sProfile in args.profiles.split(',') if sProfile]
+    lSources = [sSource for sSource in args.sources.split(',') if sSource]
+
+    for sProfile in lProfiles:
+        print('Preparing tree - ' + sProfile, file=sys.stderr)
+        build_tree(os.path.join(sTrees, sProfile), sProfile, args.scale)
+
+    walacor = start_mock_walacor(args.walacor_latency)
+    s3 = start_s3_standin(sTrees, args.s3_latency) if 's3' in lSources else None
+    sWalacorUrl = 'http://127.0.0.1:' + str(walacor.server_address[1])
+
+    lResults = []
+
+    for sProfile in lProfiles:
+        intFiles, intBytes = tree_stats(os.path.join(sTrees, sProfile))
+
+        for sSource in lSources:
+            lCommon = [sys.executable, args.validator]
+
+            if sSource == 'fs':
+                lTail = [sWalacorUrl, 'bench', 'bench', '', str(args.log_level), os.path.join(sTrees, sProfile), '']
+                sSourceType = '1'
+            else:
+                sS3Url = 'http://127.0.0.1:' + str(s3.server_address[1])
+                lTail = [sWalacorUrl, 'bench', 'bench', '', str(args.log_level), sProfile, '', sS3Url, 'bench', 'bench', 'us-east-1', 'bench']
+                sSourceType = '2'
+
+            result = {'profile': sProfile, 'source': sSource, 'files': intFiles, 'bytes': intBytes, 'phases': {}}
+
+            # Profiles share dir names, every generation starts from an empty Walacor
+            with walacor.lock:
+                walacor.records.clear()
+
+            for sPhase, sMode in (('generate', '1'), ('validate', '2')):
+                print('Running - ' + sProfile + ' - ' + sSource + ' - ' + sPhase, file=sys.stderr)
+                lCommand = lCommon + [sMode, sSourceType] + lTail + lValidatorArgs
+                result['phases'][sPhase] = add_throughput(run_phase(lCommand, sLogFile), intFiles, intBytes)
+
+            lResults.append(result)
+
+    walacor.shutdown()
+    if s3 is not None:
+        s3.shutdown()
+
+    return {
+        'version': git_version(args.validator),
+        'validator': os.path.abspath(args.validator),
+        'validator_args': lValidatorArgs,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'settings': {
+            'scale': args.scale,
+            'walacor_latency_s': args.walacor_latency,
+            's3_latency_s': args.s3_latency,
+            'log_level': args.log_level
+        },
+        'results': lResults
+    }
+
+def compare_results(sOld, sNew, fThreshold):
+    # Prints wall time per phase of two result files, returns 1 if any phase got slower than fThreshold allows
+    with open(sOld) as file:
+        old = json.load(file)
+    with open(sNew) as file:
+        new = json.load(file)
+
+    dOld = {(r['profile'], r['source'], sPhase): phase for r in old['results'] for sPhase, phase in r['phases'].items()}
+    intRet = 0
+
+    print('%-8s %-4s %-9s %10s %10s %8s' % ('profile', 'src', 'phase', old['version'][:10], new['version'][:10], 'ratio'))
+
+    for r in new['results']:
+        for sPhase, phase in r['phases'].items():
+            previous = dOld.get((r['profile'], r['source'], sPhase))
+            if previous is None:
+                continue
+
+            fRatio = phase['wall_s'] / max(previous['wall_s'], 1e-9)
+            sFlag = ''
+            if fRatio > 1 + fThreshold:
+                sFlag = ' REGRESSION'
+                intRet = 1
+
+            print('%-8s %-4s %-9s %9.3fs %9.3fs %7.2fx%s' % (r['profile'], r['source'], sPhase, previous['wall_s'], phase['wall_s'], fRatio, sFlag))
+
+    return intRet
+
+#endregion
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark ObjectValidator.py. Options that are not listed here are passed on to ObjectValidator.py, I.E. --workers=8', allow_abbrev=False)  # --profile goes to ObjectValidator.py, not --profiles
+    parser.add_argument('--profiles', default='tiny,huge,deep', help='Comma separated tree profiles: ' + '; '.join(k + ' = ' + v for k, v in PROFILES.items()))
+    parser.add_argument('--sources', default='fs,s3', help='Comma separated sources to run, fs and/or s3')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier on file counts and sizes')
+    parser.add_argument('--workdir', default='bench_work', help='Where trees and logs are kept, trees are reused between runs')
+    parser.add_argument('--validator', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ObjectValidator.py'), help='ObjectValidator.py to run, I.E. an older checkout to compare against')
+    parser.add_argument('--walacor-latency', type=float, default=0.005, help='Seconds added to every mock Walacor call')
+    parser.add_argument('--s3-latency', type=float, default=0.0, help='Seconds added to every S3 stand-in call')
+    parser.add_argument('--log-level', type=int, default=30, help='Log level passed to ObjectValidator.py')
+    parser.add_argument('--output', default='', help='Write the JSON results here as well as to stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Slow down allowed by --compare before a phase is a regression')
+
+    args, lValidatorArgs = parser.parse_known_args()
+
+    if args.compare:
+        sys.exit(compare_results(args.compare[0], args.compare[1], args.threshold))
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = run_benchmark(args, lValidatorArgs)
+
+    sJson = json.dumps(results, indent=2)
+    print(sJson)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(sJson + '\n')
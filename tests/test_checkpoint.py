@@ -0,0 +1,80 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sRepo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sRepo)
+
+import ObjectValidator
+import ObjectValidatorBench
+
+
+class CheckpointKeyTest(unittest.TestCase):
+
+    def test_key_changes_with_every_setting_of_the_run(self):
+        sBase = ObjectValidator.checkpoint_make_run_key()
+        self.assertEqual(ObjectValidator.checkpoint_make_run_key(), sBase)
+
+        dKeys = {}
+        for sName, value in (('prog_mode', 2), ('source_type', 2), ('source_root', '/other'), ('s3_bucket', 'bucket'),
+                             ('hash_format', 2), ('hash_algorithm', 'blake2b'), ('shard_index', 1), ('shard_count', 4),
+                             ('focus_model', 'model_a'), ('sample_window', 7.0), ('sample_size', 10), ('spool_path', 'run.spool')):
+            with mock.patch.object(ObjectValidator, sName, value):
+                dKeys[sName] = ObjectValidator.checkpoint_make_run_key()
+
+        # Each setting gives a key of its own
+        self.assertNotIn(sBase, dKeys.values())
+        self.assertEqual(len(set(dKeys.values())), len(dKeys))
+
+
+class CheckpointResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sRoot = os.path.join(self.tempdir.name, 'root')
+        for sdir in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.sRoot, sdir))
+            with open(os.path.join(self.sRoot, sdir, 'file.bin'), 'w') as file:
+                file.write(sdir)
+
+        self.sCheckpoint = os.path.join(self.tempdir.name, 'checkpoint.db')
+        self.sMetrics = os.path.join(self.tempdir.name, 'metrics.json')
+        self.walacor = ObjectValidatorBench.start_mock_walacor(0.0)
+
+    def tearDown(self):
+        self.walacor.shutdown()
+        self.tempdir.cleanup()
+
+    def run_validator(self, sFocus):
+        # (exit code, dirs taken from the journal)
+        sEndpoint = 'http://127.0.0.1:' + str(self.walacor.server_address[1])
+        process = subprocess.run([sys.executable, os.path.join(sRepo, 'ObjectValidator.py'), '1', '1', sEndpoint, 'u', 'p', '', '20', self.sRoot, sFocus,
+                                  '--checkpoint=' + self.sCheckpoint, '--metrics-json=' + self.sMetrics], capture_output=True, text=True)
+
+        with open(self.sMetrics) as file:
+            return process.returncode, json.load(file)['run']['counters'].get('dirs_resumed_total', 0)
+
+    def unfinish(self):
+        # As if the run had died before its end
+        conn = sqlite3.connect(self.sCheckpoint)
+        conn.execute('UPDATE Run SET Finished = NULL')
+        conn.commit()
+        conn.close()
+
+    def test_run_of_other_dirs_does_not_resume_the_journal(self):
+        self.assertEqual(self.run_validator('a,b'), (0, 0))
+        self.unfinish()
+
+        # Other dirs are another run, the same dirs pick up where it stopped
+        self.assertEqual(self.run_validator('b,c'), (0, 0))
+        self.unfinish()
+        self.assertEqual(self.run_validator('a,b'), (0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
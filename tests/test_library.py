@@ -0,0 +1,112 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sRepo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sRepo)
+
+import ObjectValidator
+import ObjectValidatorBench
+
+
+class LibraryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.TemporaryDirectory()
+        cls.sRoot = os.path.join(cls.tempdir.name, 'root')
+        for sdir in ('a', 'b'):
+            os.makedirs(os.path.join(cls.sRoot, sdir))
+            for sName in ('one.bin', 'two.bin'):
+                with open(os.path.join(cls.sRoot, sdir, sName), 'w') as file:
+                    file.write(sdir + sName)
+
+        cls.walacor = ObjectValidatorBench.start_mock_walacor(0.01)
+        cls.ov = ObjectValidator.ObjectValidator('http://127.0.0.1:' + str(cls.walacor.server_address[1]), 'u', 'p', 1, cls.sRoot,
+                                                 log_level=50, hash_format=2, manifest_store=os.path.join(cls.tempdir.name, 'manifests'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.ov.close()
+        cls.walacor.shutdown()
+        cls.tempdir.cleanup()
+
+    def test_concurrent_calls_keep_their_own_results(self):
+        self.assertEqual(self.ov.generate()['exit_code'], 0)
+
+        with open(os.path.join(self.sRoot, 'a', 'one.bin'), 'w') as file:
+            file.write('changed')
+
+        lResults = [None] * 4
+        def validate(intCall):
+            lResults[intCall] = self.ov.validate(['a', 'b'])
+
+        lThreads = [threading.Thread(target=validate, args=(intCall,)) for intCall in range(len(lResults))]
+        for thread in lThreads:
+            thread.start()
+        for thread in lThreads:
+            thread.join()
+
+        # Every call gets the changed file of its own pass, none takes another's
+        for result in lResults:
+            self.assertEqual(result['exit_code'], 1)
+            self.assertEqual(result['dirs']['a']['changes']['modified'], ['one.bin'])
+            self.assertEqual(result['dirs']['b']['outcome'], 0)
+            self.assertEqual(result['not_persisted'], [])
+
+        # The command line run's results are not touched
+        self.assertEqual(ObjectValidator.run_results, {})
+
+
+class TwoValidatorsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.dRoots = {}
+        self.dWalacors = {}
+        self.dValidators = {}
+
+        for sName, lDirs in (('first', ('a1', 'a2')), ('second', ('b1',))):
+            self.dRoots[sName] = os.path.join(self.tempdir.name, sName)
+            for sdir in lDirs:
+                os.makedirs(os.path.join(self.dRoots[sName], sdir))
+                with open(os.path.join(self.dRoots[sName], sdir, 'file.bin'), 'w') as file:
+                    file.write(sdir)
+
+            self.dWalacors[sName] = ObjectValidatorBench.start_mock_walacor(0.0)
+
+        # Made one after the other, the second must not take over the first
+        for sName in ('first', 'second'):
+            self.dValidators[sName] = ObjectValidator.ObjectValidator('http://127.0.0.1:' + str(self.dWalacors[sName].server_address[1]), 'u', 'p', 1,
+                                                                      self.dRoots[sName], log_level=50, workers=2)
+
+    def tearDown(self):
+        for ov in self.dValidators.values():
+            ov.close()
+        for walacor in self.dWalacors.values():
+            walacor.shutdown()
+        self.tempdir.cleanup()
+
+    def name_hashes(self, sName):
+        with self.dWalacors[sName].lock:
+            return sorted(record['NameHash'] for record in self.dWalacors[sName].records.values() if 'NameHash' in record)
+
+    def test_each_validator_uses_its_own_root_and_walacor(self):
+        self.assertEqual(self.dValidators['first'].list_dirs(), ['a1', 'a2'])
+        self.assertEqual(self.dValidators['second'].list_dirs(), ['b1'])
+
+        self.assertEqual(self.dValidators['first'].generate()['exit_code'], 0)
+        self.assertEqual(self.dValidators['second'].generate()['exit_code'], 0)
+
+        self.assertEqual(self.name_hashes('first'), sorted(ObjectValidator.hash_string(sdir) for sdir in ('a1', 'a2')))
+        self.assertEqual(self.name_hashes('second'), [ObjectValidator.hash_string('b1')])
+
+        self.assertEqual(sorted(self.dValidators['first'].validate()['dirs']), ['a1', 'a2'])
+        self.assertEqual(sorted(self.dValidators['second'].validate()['dirs']), ['b1'])
+        self.assertIsNot(self.dValidators['first'].module.walacor_session, self.dValidators['second'].module.walacor_session)
+
+
+if __name__ == '__main__':
+    unittest.main()
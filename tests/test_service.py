@@ -0,0 +1,117 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+sRepo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sRepo)
+
+import ObjectValidatorBench
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ServiceTestCase(unittest.TestCase):
+    fLatency = 0.0
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sRoot = os.path.join(self.tempdir.name, 'root')
+        for sdir in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.sRoot, sdir))
+            with open(os.path.join(self.sRoot, sdir, 'file.bin'), 'w') as file:
+                file.write(sdir)
+
+        self.walacor = ObjectValidatorBench.start_mock_walacor(self.fLatency)
+        self.intPort = free_port()
+
+    def tearDown(self):
+        self.walacor.shutdown()
+        self.tempdir.cleanup()
+
+    def post_job(self, payload=None):
+        request = urllib.request.Request('http://127.0.0.1:' + str(self.intPort) + '/jobs', data=json.dumps(payload or {'mode': 1}).encode('utf-8'), method='POST')
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def start_service(self, *lOptions):
+        sEndpoint = 'http://127.0.0.1:' + str(self.walacor.server_address[1])
+        process = subprocess.Popen([sys.executable, os.path.join(sRepo, 'ObjectValidator.py'), '0', '1', sEndpoint, 'u', 'p', '', '20', self.sRoot, '',
+                                    '--serve=127.0.0.1:' + str(self.intPort)] + list(lOptions),
+                                   stderr=subprocess.PIPE, text=True)
+
+        for intTry in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.intPort), 1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        return process
+
+    def stop_service(self, process):
+        try:
+            process.send_signal(signal.SIGTERM)
+            return process.communicate(timeout=60)[1]
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.communicate()
+
+
+
+class ServiceShutdownTest(ServiceTestCase):
+    # Slow Walacor calls keep the jobs running while the queue fills
+    fLatency = 0.5
+
+    def test_stops_with_a_full_queue(self):
+        process = self.start_service('--serve-jobs=2', '--serve-queue=1')
+        try:
+            # Two jobs running, one queued, then the queue is full
+            lStatus = [self.post_job() for intJob in range(5)]
+            self.assertIn(429, lStatus)
+        finally:
+            sErr = self.stop_service(process)
+
+        self.assertEqual(process.returncode, 0)
+        self.assertIn('cancelled', sErr)
+        self.assertIn('Service stopped', sErr)
+
+
+class ServiceDirsTest(ServiceTestCase):
+
+    def test_refuses_dirs_outside_the_root(self):
+        sOutside = os.path.join(self.tempdir.name, 'outside')
+        os.makedirs(sOutside)
+        os.symlink(sOutside, os.path.join(self.sRoot, 'link'))
+
+        process = self.start_service()
+        try:
+            for dirs in ('..', '../etc', 'a/../../x', '.', ['a', '..'], 'a,..', 'link', [1]):
+                self.assertEqual(self.post_job({'mode': 1, 'dirs': dirs}), 400, dirs)
+
+            self.assertEqual(self.post_job({'mode': 1, 'dirs': 'a', 'wait': True}), 200)
+        finally:
+            self.stop_service(process)
+
+        # Only the one good job wrote a record
+        with self.walacor.lock:
+            self.assertEqual(len([record for record in self.walacor.records.values() if 'NameHash' in record]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sRepo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sRepo)
+
+import ObjectValidator
+import ObjectValidatorBench
+
+
+class ShardSplitTest(unittest.TestCase):
+
+    def test_split_is_stable_and_disjoint(self):
+        lDirs = ['model_' + str(intDir) for intDir in range(200)]
+
+        for intCount in (1, 2, 3, 8):
+            dShards = {sdir: ObjectValidator.shard_of(sdir, intCount) for sdir in lDirs}
+
+            # Each dir is in one shard, whatever order the dirs are listed in
+            lShuffled = list(lDirs)
+            random.Random(intCount).shuffle(lShuffled)
+            self.assertEqual({sdir: ObjectValidator.shard_of(sdir, intCount) for sdir in lShuffled}, dShards)
+            self.assertTrue(all(0 <= intShard < intCount for intShard in dShards.values()))
+
+        # The split does not depend on the process, hash() is salted per process
+        sCode = 'import ObjectValidator; print(ObjectValidator.shard_of("model_7", 8), ObjectValidator.shard_of("model_42", 8))'
+        lOut = {subprocess.run([sys.executable, '-c', sCode], cwd=sRepo, capture_output=True, text=True).stdout for intRun in range(2)}
+        self.assertEqual(lOut, {str(ObjectValidator.shard_of('model_7', 8)) + ' ' + str(ObjectValidator.shard_of('model_42', 8)) + '\n'})
+
+
+class ShardMergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sRoot = os.path.join(self.tempdir.name, 'root')
+        self.lDirs = ['d' + str(intDir) for intDir in range(8)]
+        for sdir in self.lDirs:
+            os.makedirs(os.path.join(self.sRoot, sdir))
+            with open(os.path.join(self.sRoot, sdir, 'file.bin'), 'w') as file:
+                file.write(sdir)
+
+        self.walacor = ObjectValidatorBench.start_mock_walacor(0.0)
+
+    def tearDown(self):
+        self.walacor.shutdown()
+        self.tempdir.cleanup()
+
+    def run_validator(self, lArgs):
+        process = subprocess.run([sys.executable, os.path.join(sRepo, 'ObjectValidator.py')] + lArgs, capture_output=True, text=True)
+        return process.returncode
+
+    def run_shard(self, sMode, intIndex, intCount):
+        sEndpoint = 'http://127.0.0.1:' + str(self.walacor.server_address[1])
+        sSummary = os.path.join(self.tempdir.name, 'shard' + sMode + '_' + str(intIndex) + '.json')
+        intRet = self.run_validator([sMode, '1', sEndpoint, 'u', 'p', '', '20', self.sRoot, '',
+                                     '--shard-count=' + str(intCount), '--shard-index=' + str(intIndex), '--summary=' + sSummary])
+        return intRet, sSummary
+
+    def merge(self, lSummaries):
+        sMerged = os.path.join(self.tempdir.name, 'merged.json')
+        if os.path.exists(sMerged):
+            os.remove(sMerged)
+
+        intRet = self.run_validator(['--merge-summaries=' + ','.join(lSummaries), '--summary=' + sMerged])
+
+        with open(sMerged) as file:
+            return intRet, json.load(file)
+
+    def test_shards_cover_every_dir_once_and_merge(self):
+        lSummaries = []
+        for intIndex in range(3):
+            intRet, sSummary = self.run_shard('1', intIndex, 3)
+            self.assertEqual(intRet, 0)
+            lSummaries.append(sSummary)
+
+        lShardDirs = []
+        for sSummary in lSummaries:
+            with open(sSummary) as file:
+                lShardDirs.extend(json.load(file)['dirs'])
+        self.assertEqual(sorted(lShardDirs), self.lDirs)
+
+        intRet, merged = self.merge(lSummaries)
+        self.assertEqual(intRet, 0)
+        self.assertEqual(sorted(merged['dirs']), self.lDirs)
+
+        # A shard that is missing, or there twice, fails the merge
+        self.assertEqual(self.merge(lSummaries[:2])[0], 1)
+        self.assertEqual(self.merge(lSummaries + lSummaries[:1])[0], 1)
+
+    def test_failed_shard_fails_the_merge(self):
+        for intIndex in range(2):
+            self.assertEqual(self.run_shard('1', intIndex, 2)[0], 0)
+
+        # One dir changes, the shard it is in fails validation
+        sChanged = self.lDirs[0]
+        with open(os.path.join(self.sRoot, sChanged, 'file.bin'), 'w') as file:
+            file.write('changed')
+
+        lResults = [self.run_shard('2', intIndex, 2) for intIndex in range(2)]
+        intFailed = ObjectValidator.shard_of(sChanged, 2)
+        self.assertEqual([intRet for intRet, sSummary in lResults], [1 if intIndex == intFailed else 0 for intIndex in range(2)])
+
+        intRet, merged = self.merge([sSummary for intRet, sSummary in lResults])
+        self.assertEqual(intRet, 1)
+        self.assertEqual(merged['dirs'][sChanged]['outcome'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sRepo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sRepo)
+
+import ObjectValidatorBench
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sRoot = os.path.join(self.tempdir.name, 'root')
+        for sdir in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.sRoot, sdir))
+            with open(os.path.join(self.sRoot, sdir, 'file.bin'), 'w') as file:
+                file.write(sdir)
+
+        self.sKey = os.path.join(self.tempdir.name, 'spool.key')
+        with open(self.sKey, 'w') as file:
+            file.write('0123456789abcdef0123456789abcdef\n')
+
+        self.sSpool = os.path.join(self.tempdir.name, 'run.spool')
+        self.walacor = ObjectValidatorBench.start_mock_walacor(0.0)
+
+    def tearDown(self):
+        self.walacor.shutdown()
+        self.tempdir.cleanup()
+
+    def run_validator(self, sMode, sSpool, sSource='1', sRoot=None):
+        sEndpoint = 'http://127.0.0.1:' + str(self.walacor.server_address[1])
+        process = subprocess.run([sys.executable, os.path.join(sRepo, 'ObjectValidator.py'), sMode, sSource, sEndpoint, 'u', 'p', '', '20', sRoot or '', '',
+                                  '--spool=' + sSpool, '--spool-key=' + self.sKey], capture_output=True, text=True)
+        return process.returncode, process.stderr
+
+    def publish(self, lLines):
+        # Publishes a spool made of lLines, returns (exit code, stderr, records stored)
+        sSpool = os.path.join(self.tempdir.name, 'publish.spool')
+        with open(sSpool, 'w') as file:
+            file.write(''.join(lLines))
+
+        with self.walacor.lock:
+            self.walacor.records.clear()
+
+        intRet, sErr = self.run_validator('4', sSpool, '0')
+
+        with self.walacor.lock:
+            return intRet, sErr, len([record for record in self.walacor.records.values() if 'NameHash' in record])
+
+    def spool_lines(self):
+        self.assertEqual(self.run_validator('1', self.sSpool, sRoot=self.sRoot)[0], 0)
+
+        with open(self.sSpool) as file:
+            lLines = file.readlines()
+
+        # The header, a line per dir, the end
+        self.assertEqual([json.loads(sLine)['type'] for sLine in lLines], ['header', 'dir', 'dir', 'dir', 'end'])
+        return lLines
+
+    def test_spool_as_written_is_published(self):
+        self.assertEqual(self.publish(self.spool_lines())[::2], (0, 3))
+
+    def test_changed_line_is_rejected(self):
+        lLines = self.spool_lines()
+
+        line = json.loads(lLines[2])
+        line['contents_hash'] = json.loads(lLines[3])['contents_hash']
+        lLines[2] = json.dumps(line, sort_keys=True) + '\n'
+
+        intRet, sErr, intRecords = self.publish(lLines)
+        self.assertNotEqual(intRet, 0)
+        self.assertIn('Spool line 3 does not match its signature', sErr)
+        self.assertEqual(intRecords, 1)
+
+    def test_reordered_lines_are_rejected(self):
+        lLines = self.spool_lines()
+        lLines[1], lLines[2] = lLines[2], lLines[1]
+
+        intRet, sErr, intRecords = self.publish(lLines)
+        self.assertNotEqual(intRet, 0)
+        self.assertIn('Spool line 2 does not match its signature', sErr)
+        self.assertEqual(intRecords, 0)
+
+    def test_dropped_line_is_rejected(self):
+        lLines = self.spool_lines()
+        del lLines[2]
+
+        intRet, sErr, intRecords = self.publish(lLines)
+        self.assertNotEqual(intRet, 0)
+        self.assertIn('does not match its signature', sErr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sRepo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, sRepo)
+
+import ObjectValidator
+import ObjectValidatorBench
+
+
+class ValidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.sRoot = os.path.join(self.tempdir.name, 'root')
+        for sdir in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.sRoot, sdir))
+            with open(os.path.join(self.sRoot, sdir, 'file.bin'), 'w') as file:
+                file.write(sdir)
+
+        self.walacor = ObjectValidatorBench.start_mock_walacor(0.0)
+        self.sSummary = os.path.join(self.tempdir.name, 'summary.json')
+
+    def tearDown(self):
+        self.walacor.shutdown()
+        self.tempdir.cleanup()
+
+    def run_validator(self, sMode, *lOptions):
+        # (exit code, the outcome of each dir, stderr), the summary is kept in self.dDirs
+        sEndpoint = 'http://127.0.0.1:' + str(self.walacor.server_address[1])
+        process = subprocess.run([sys.executable, os.path.join(sRepo, 'ObjectValidator.py'), sMode, '1', sEndpoint, 'u', 'p', '', '20', self.sRoot, '',
+                                  '--summary=' + self.sSummary] + list(lOptions), capture_output=True, text=True)
+
+        with open(self.sSummary) as file:
+            self.dDirs = json.load(file)['dirs']
+
+        return process.returncode, {sdir: result['outcome'] for sdir, result in self.dDirs.items()}, process.stderr
+
+    def write_file(self, sPath, sText):
+        sPath = os.path.join(self.sRoot, sPath)
+        os.makedirs(os.path.dirname(sPath), exist_ok=True)
+        with open(sPath, 'w') as file:
+            file.write(sText)
+
+    def set_record(self, sdir, **fields):
+        sNameHash = ObjectValidator.hash_string(sdir)
+        with self.walacor.lock:
+            for record in self.walacor.records.values():
+                if record.get('NameHash') == sNameHash:
+                    record.update(fields)
+
+    def test_record_that_cannot_be_hashed_fails_only_its_dir(self):
+        self.assertEqual(self.run_validator('1')[0], 0)
+
+        # An algorithm this host does not have, and a format 3 record on a local source
+        self.set_record('a', HashAlgorithm='sha3_1024')
+        self.set_record('b', HashFormat=3)
+
+        intRet, dOutcomes, sErr = self.run_validator('2')
+
+        self.assertEqual(intRet, 1)
+        self.assertEqual(dOutcomes, {'a': 1, 'b': 1, 'c': 0})
+        self.assertIn('Unknown hash algorithm - sha3_1024, Validation Failed - a', sErr)
+        self.assertIn('it is for S3 only, Validation Failed - b', sErr)
+        self.assertNotIn('Traceback', sErr)
+
+    def test_format_1_hashes_of_the_first_version_still_validate(self):
+        # Names around '/' in sort order: the first version sorted whole paths, not each dir's names
+        for sPath in ('a/x', 'a/sub/deep', 'a-b', 'a.b/y', 'a b/z', 'a0', 'B', '_/a'):
+            self.write_file(os.path.join('c', sPath), sPath)
+        os.symlink('a0', os.path.join(self.sRoot, 'c', 'link'))
+        os.symlink('a', os.path.join(self.sRoot, 'c', 'dirlink'))
+
+        def first_version_hash(sDir):
+            lFiles = sorted(os.path.join(sDirPath, sName) for sDirPath, lDirNames, lFileNames in os.walk(sDir)
+                            for sName in lFileNames if os.path.isfile(os.path.join(sDirPath, sName)))
+            sha2_hash = hashlib.sha256()
+            for sPath in lFiles:
+                with open(sPath, 'rb') as file:
+                    sha2_hash.update(file.read())
+            return sha2_hash.hexdigest()
+
+        for lOptions in ([], ['--workers=2', '--scan-workers=4']):
+            self.assertEqual(self.run_validator('1', *lOptions)[0], 0)
+            self.assertEqual({sdir: result['contents_hash'] for sdir, result in self.dDirs.items()},
+                             {sdir: first_version_hash(os.path.join(self.sRoot, sdir)) for sdir in ('a', 'b', 'c')})
+
+        self.assertEqual(self.run_validator('2', '--scan-workers=4')[:2], (0, {'a': 0, 'b': 0, 'c': 0}))
+
+    def test_manifest_names_added_removed_and_modified_files(self):
+        sStore = os.path.join(self.tempdir.name, 'manifests')
+        for sPath in ('keep.bin', 'change.bin', 'drop.bin', 'sub/deep.bin'):
+            self.write_file(os.path.join('c', sPath), sPath)
+
+        for sFormat in ('1', '2'):
+            with self.subTest(hash_format=sFormat):
+                self.assertEqual(self.run_validator('1', '--hash-format=' + sFormat, '--manifest-store=' + sStore)[0], 0)
+
+                self.write_file(os.path.join('c', 'change.bin'), 'changed')
+                self.write_file(os.path.join('c', 'sub', 'new.bin'), 'new')
+                os.remove(os.path.join(self.sRoot, 'c', 'drop.bin'))
+
+                intRet, dOutcomes, sErr = self.run_validator('2', '--manifest-store=' + sStore)
+                self.assertEqual(intRet, 1)
+                self.assertEqual(dOutcomes, {'a': 0, 'b': 0, 'c': 1})
+                self.assertEqual(self.dDirs['c']['changes'], {'added': ['sub/new.bin'], 'modified': ['change.bin'], 'removed': ['drop.bin']})
+
+                # Back as it was for the other format
+                self.write_file(os.path.join('c', 'change.bin'), 'change.bin')
+                self.write_file(os.path.join('c', 'drop.bin'), 'drop.bin')
+                os.remove(os.path.join(self.sRoot, 'c', 'sub', 'new.bin'))
+
+
+if __name__ == '__main__':
+    unittest.main()